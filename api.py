@@ -0,0 +1,218 @@
+"""Headless JSON/HTTP API over core, for tools that drive downloads without a UI
+
+Endpoints:
+  POST   /analyze          {"url": ...}                   -> video summary and quality choices
+  POST   /jobs             {"url": ..., "quality": ...}   -> 202 {"id": ..., "status": "queued"}
+  GET    /jobs/<id>                                       -> job status and progress
+  GET    /jobs/<id>/events                                -> progress as Server-Sent Events until the job ends
+  GET    /jobs/<id>/file                                  -> the finished file (Range requests supported)
+  DELETE /jobs/<id>                                       -> cancel a job that has not started
+  GET    /healthz, /readyz, /metrics
+
+Jobs run in this process, or on the queue workers when VD_QUEUE_URL is set.
+
+Usage: python api.py [--host 0.0.0.0] [--port 8080]
+"""
+import argparse
+import json
+import mimetypes
+import os
+import re
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import core
+
+API_HOST = os.environ.get('VD_API_HOST', '0.0.0.0')
+API_PORT = int(os.environ.get('VD_API_PORT', '8080'))
+MAX_BODY = 64 * 1024
+JOB_PATH = re.compile(r'^/jobs/([0-9a-f]+)(?:/(events|file))?/?$')
+DOWNLOAD_OPTIONS = {'quality': str, 'embed_subs': bool, 'embed_thumb': bool, 'audio_format': str,
+                    'custom_filename': str, 'priority': int, 'session': str, 'sub_langs': (str, list),
+                    'auto_subs': bool}
+TYPE_NAMES = {str: 'a string', bool: 'true or false', int: 'an integer', list: 'a list'}
+
+
+def parse_download_options(payload):
+    """Get the download options of a POST /jobs body, raises ValueError naming a field of the wrong type"""
+    options = {'quality': '1080p'}
+    for key, types in DOWNLOAD_OPTIONS.items():
+        value = payload.get(key)
+        if value is None:
+            continue
+        # bool is an int subclass, so true is no priority and 1 no flag
+        if not isinstance(value, types) or isinstance(value, bool) != (types is bool):
+            names = ' or '.join(TYPE_NAMES[t] for t in (types if isinstance(types, tuple) else (types,)))
+            raise ValueError(f"'{key}' must be {names}")
+        if key == 'sub_langs':
+            if isinstance(value, list) and not all(isinstance(lang, str) for lang in value):
+                raise ValueError("'sub_langs' must be a list of language codes")
+            value = core.parse_languages(value)
+        options[key] = value
+    if options.get('audio_format', 'mp3') not in core.STREAM_AUDIO_FORMATS:
+        raise ValueError(f"'audio_format' must be one of {', '.join(sorted(core.STREAM_AUDIO_FORMATS))}")
+    return options
+
+
+def job_view(job):
+    """JSON view of a job, pointing at its file endpoint once it is done"""
+    view = job.snapshot()
+    view.pop('file_path', None)
+    view['file_url'] = f"/jobs/{job.id}/file" if job.status == 'done' else None
+    return view
+
+
+class ApiRequestHandler(BaseHTTPRequestHandler):
+    server_version = 'VideoDownloaderAPI'
+    protocol_version = 'HTTP/1.1'
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        # A HEAD response carries no body, or it would be read as the next response
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length > MAX_BODY:
+            raise ValueError("Request body too large")
+        payload = json.loads(self.rfile.read(length) or b'{}')
+        if not isinstance(payload, dict):
+            raise ValueError("Expected a JSON object")
+        if not isinstance(payload.get('url'), str) or not payload['url'].strip():
+            raise ValueError("Missing 'url'")
+        return payload
+
+    def do_POST(self):
+        path = urlsplit(self.path).path.rstrip('/')
+        try:
+            payload = self._read_json()
+        except ValueError as e:
+            self._send_json(400, {'error': str(e)})
+            return
+
+        if path == '/analyze':
+            info, error = core.get_video_info(payload['url'])
+            if error:
+                self._send_json(422, {'error': error})
+            else:
+                self._send_json(200, dict(info, site=core.detect_website(payload['url'])))
+        elif path == '/jobs':
+            try:
+                options = parse_download_options(payload)
+            except ValueError as e:
+                self._send_json(400, {'error': str(e)})
+                return
+            try:
+                job = core.submit_download(payload['url'], **options)
+            except core.QueueFullError as e:
+                self._send_json(503, {'error': str(e)})
+                return
+            self._send_json(202, job_view(job))
+        else:
+            self._send_json(404, {'error': "Not found"})
+
+    def do_GET(self):
+        self._get(send_body=True)
+
+    def do_HEAD(self):
+        self._get(send_body=False)
+
+    def _get(self, send_body):
+        path = urlsplit(self.path).path
+        if path == '/healthz':
+            self._send_json(200, {'status': 'ok'})
+            return
+        if path == '/readyz':
+            capabilities = core.get_capabilities()
+            ready = capabilities['ytdlp_version'] is not None
+            self._send_json(200 if ready else 503, dict(capabilities, status='ready' if ready else 'not ready'))
+            return
+        if path == '/metrics':
+            body = core.metrics.render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            if send_body:
+                self.wfile.write(body)
+            return
+
+        match = JOB_PATH.match(path)
+        job = match and core.get_job(match.group(1))
+        if not job:
+            self._send_json(404, {'error': "Unknown job"})
+        elif match.group(2) == 'events':
+            self._stream_events(job)
+        elif match.group(2) == 'file':
+            self._send_file(job, send_body)
+        else:
+            self._send_json(200, job_view(job))
+
+    def do_DELETE(self):
+        match = JOB_PATH.match(urlsplit(self.path).path)
+        job = match and not match.group(2) and core.get_job(match.group(1))
+        if not job:
+            self._send_json(404, {'error': "Unknown job"})
+        elif job.cancel():
+            self._send_json(200, {'id': job.id, 'status': 'cancelled'})
+        else:
+            self._send_json(409, {'error': f"Job is {job.status}, only waiting jobs can be cancelled"})
+
+    def _stream_events(self, job):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Cache-Control', 'no-store')
+        self.send_header('Connection', 'close')
+        self.end_headers()
+        self.close_connection = True
+        try:
+            for event in core.iter_job_events(job):
+                self.wfile.write(f"event: progress\ndata: {json.dumps(event.to_dict())}\n\n".encode())
+                self.wfile.flush()
+            self.wfile.write(f"event: end\ndata: {json.dumps(job_view(job), default=str)}\n\n".encode())
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def _send_file(self, job, send_body):
+        if job.status != 'done':
+            self._send_json(409, {'error': f"Job is {job.status}", 'status': job.status})
+            return
+        if not job.file_path or not os.path.exists(job.file_path):
+            self._send_json(410, {'error': "The file has expired"})
+            return
+        name = os.path.basename(job.file_path)
+        mime = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        core.send_file_response(self, job.file_path, name, mime, send_body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ApiServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default=API_HOST)
+    parser.add_argument('--port', type=int, default=API_PORT)
+    args = parser.parse_args()
+
+    core.warm_up()
+    server = ApiServer((args.host, args.port), ApiRequestHandler)
+    if not core.queue_enabled():
+        core.get_download_manager()  # resumes downloads an earlier run left unfinished
+    core.log_event('api_started', host=args.host, port=server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -4,9 +4,17 @@ Created by wanztech
 Powered by yt-dlp + ffmpeg
 """
 
+import core
+# Once per process: fork the pre-warmed engine workers before Streamlit is
+# imported here; the engine warms up while the first page renders
+core.warm_up()
+
 import streamlit as st
+import gc
 import os
-import core
+import tornado.ioloop
+import tornado.iostream
+import tornado.web
 
 # Page config
 st.set_page_config(
@@ -109,6 +117,112 @@ st.markdown("""
 </style>
 """, unsafe_allow_html=True)
 
+class FileRouteHandler(tornado.web.RequestHandler):
+    """Streams published downloads from disk on Streamlit's own port, one chunk at a time"""
+
+    def initialize(self, links):
+        self.links = links
+
+    async def get(self, path):
+        await self._serve(path, send_body=True)
+
+    async def head(self, path):
+        await self._serve(path, send_body=False)
+
+    async def _serve(self, path, send_body):
+        entry = self.links.lookup(f"/files/{path}", claim=send_body)
+        if not entry or ('stream' not in entry and not os.path.exists(entry['path'])):
+            raise tornado.web.HTTPError(404)
+        self.set_header('Content-Type', entry['mime'])
+        self.set_header('Content-Disposition', core.content_disposition(entry['name']))
+        if 'stream' in entry:
+            # Length is unknown up front: sent chunked as yt-dlp produces it
+            self.set_header('Cache-Control', 'no-store')
+            chunks = iter(entry['stream']) if send_body else iter(())
+        else:
+            size = os.path.getsize(entry['path'])
+            try:
+                byte_range = core.parse_range(self.request.headers.get('Range'), size)
+            except ValueError:
+                self.set_status(416)
+                self.set_header('Content-Range', f'bytes */{size}')
+                self.finish()
+                return
+            start, end = byte_range or (0, size - 1)
+            self.set_header('Accept-Ranges', 'bytes')
+            self.set_header('Content-Length', str(end - start + 1))
+            if byte_range:
+                self.set_status(206)
+                self.set_header('Content-Range', f'bytes {start}-{end}/{size}')
+            chunks = core.iter_file(entry['path'], start, end) if send_body and size else iter(())
+        loop = tornado.ioloop.IOLoop.current()
+        try:
+            while True:
+                # Disk reads and yt-dlp's pipe block, so they run off the event loop
+                chunk = await loop.run_in_executor(None, next, chunks, None)
+                if chunk is None:
+                    break
+                self.write(chunk)
+                await self.flush()
+        except tornado.iostream.StreamClosedError:
+            pass  # browser cancelled or will come back with a Range request
+        finally:
+            if hasattr(chunks, 'close'):
+                chunks.close()
+
+
+def serve_files_on_app_port():
+    """Route published downloads through Streamlit's own Tornado server, once per process
+
+    Single-port deploys (Docker, HF Spaces, Koyeb) then stream files from
+    disk instead of holding them in memory for st.download_button.
+    Returns False when the Tornado application cannot be found.
+    """
+    if core.file_server_enabled():
+        return True
+    app = next((obj for obj in gc.get_objects() if isinstance(obj, tornado.web.Application)), None)
+    if app is None:
+        return False
+    base = '/' + '/'.join(part for part in (st.get_option('server.baseUrlPath').strip('/'), 'vd') if part)
+    links = core.serve_files_on_app(base)
+    # Ahead of Streamlit's catch-all static route
+    app.add_handlers(r'.*', [(f'{base}/files/(.*)', FileRouteHandler, {'links': links})])
+    return True
+
+
+def offer_file(file_path, quality):
+    """Offer a finished file to the browser"""
+    file_name = os.path.basename(file_path)
+    mime = 'video/mp4' if quality != 'Audio Only' else 'audio/mpeg'
+    
+    if core.file_server_enabled():
+        # Stream from disk; the file server deletes the file when the link expires
+        st.link_button(
+            label=f"📥 Download {file_name}",
+            url=core.publish_file(file_path, mime),
+            use_container_width=True,
+            type="primary"
+        )
+        return
+    
+    # Only without a file route: read file and offer download from memory
+    with open(file_path, 'rb') as f:
+        file_data = f.read()
+    
+    st.download_button(
+        label=f"📥 Download {file_name}",
+        data=file_data,
+        file_name=file_name,
+        mime=mime,
+        use_container_width=True,
+        type="primary",
+        key=file_path
+    )
+    
+    # Cleanup
+    core.release_download(file_path)
+
+
 # Main App
 def main():
     # Header
@@ -119,8 +233,15 @@ def main():
     </div>
     """, unsafe_allow_html=True)
     
-    # Check dependencies
+    # Check dependencies (probed once per process, cheap on every rerun)
     ytdlp_version, ffmpeg_available = core.check_dependencies()
+    core.start_file_server()
+    serve_files_on_app_port()
+    core.start_metrics_server()
+    if not core.queue_enabled():
+        core.get_download_manager()  # resumes downloads an earlier run left unfinished
+    # Downloads of one browser session share one bandwidth share
+    session_id = st.session_state.setdefault('session_id', os.urandom(8).hex())
     
     if not ytdlp_version:
         st.error("❌ yt-dlp tidak dijumpai! Sila install dahulu.")
@@ -158,15 +279,28 @@ def main():
         </span>
         """, unsafe_allow_html=True)
     
-    # Quality Selection
+    # Analyzed video of this URL (kept across reruns)
+    analyzed = st.session_state.get('analyzed')
+    info = analyzed[1] if analyzed and analyzed[0] == url else None
+    
+    # Quality Selection: the video's real formats once analyzed, presets otherwise
     col_qual1, col_qual2 = st.columns([2, 1])
     
     with col_qual1:
-        quality = st.selectbox(
-            "🎯 Pilih Kualiti:",
-            ['4K (2160p)', '2K (1440p)', '1080p', '720p', '480p', 'Audio Only'],
-            help="4K/2K = Ultra HD, 1080p = Full HD, 720p = HD"
-        )
+        if info:
+            notes = {choice['label']: choice['note'] for choice in info['choices']}
+            quality = st.selectbox(
+                "🎯 Pilih Kualiti:",
+                info['formats'],
+                format_func=lambda label: notes.get(label, label),
+                help="Format sebenar video ini; tanpa 'merge' bermaksud fail siap terus tanpa diproses"
+            )
+        else:
+            quality = st.selectbox(
+                "🎯 Pilih Kualiti:",
+                ['4K (2160p)', '2K (1440p)', '1080p', '720p', '480p', 'Audio Only'],
+                help="4K/2K = Ultra HD, 1080p = Full HD, 720p = HD. Klik Analisis untuk lihat format sebenar."
+            )
     
     with col_qual2:
         audio_fmt = 'mp3'
@@ -193,6 +327,22 @@ def main():
     with col_opt2:
         embed_thumb = st.checkbox("🖼️ Embed Thumbnail", value=True, help="Letak gambar cover pada video/lagu")
     
+    if embed_subs:
+        col_sub1, col_sub2 = st.columns([3, 1])
+        with col_sub1:
+            # Defaults to the video's own language once analyzed
+            sub_langs = st.text_input(
+                "🌐 Bahasa Subtitle:",
+                value=', '.join(core.default_subtitle_languages(info)),
+                help="Kod bahasa dipisahkan dengan koma, contoh: en, ms"
+            )
+        with col_sub2:
+            auto_subs = st.checkbox("🤖 Auto-Caption", value=False, help="Guna subtitle auto-generated jika tiada subtitle asal")
+    else:
+        sub_langs, auto_subs = None, False
+    
+    batch_mode = st.checkbox("📚 Download seluruh Playlist/Channel", value=False, help="Muat turun semua video dalam playlist atau channel. Setiap video dipaparkan sebaik sahaja siap.")
+    
     # Buttons
     col1, col2 = st.columns(2)
     
@@ -213,62 +363,86 @@ def main():
         info, error = core.get_video_info(url)
         
         if info:
-            status_placeholder.empty()
-            
-            # Show video info
-            if info['thumbnail']:
-                st.image(info['thumbnail'], width=320)
-            
-            st.markdown(f"**📺 Title:** {info['title']}")
-            st.markdown(f"**⏱️ Duration:** {info['duration']}")
-            if info['uploader']:
-                st.markdown(f"**👤 Uploader:** {info['uploader']}")
-            
-            st.success("✅ Video berjaya dianalisis! Klik Download untuk mula.")
+            # Rerun so the quality list above shows the real formats
+            st.session_state['analyzed'] = (url, info)
+            st.rerun()
         else:
             status_placeholder.error(f"❌ Gagal dapatkan info: {error}")
     
+    if info:
+        # Show video info
+        # A local copy downsized to the display width, not the full-size remote image
+        thumbnail = core.get_thumbnail(info, width=320)
+        if thumbnail:
+            st.image(thumbnail, width=320)
+        
+        st.markdown(f"**📺 Title:** {info['title']}")
+        st.markdown(f"**⏱️ Duration:** {info['duration']}")
+        if info['uploader']:
+            st.markdown(f"**👤 Uploader:** {info['uploader']}")
+        
+        st.success("✅ Video berjaya dianalisis! Pilih kualiti dan klik Download untuk mula.")
+    
+    # Playlist / channel action
+    if download_btn and url and batch_mode:
+        status_text = status_placeholder.empty()
+        status_text.info("🔄 Sedang mendapatkan senarai video...")
+        
+        done_count = failed_count = 0
+        for result in core.download_batch(url, quality, embed_subs, embed_thumb, audio_fmt, session=session_id,
+                                          sub_langs=sub_langs, auto_subs=auto_subs):
+            if result['file_path']:
+                done_count += 1
+                st.markdown(f"**{result['index']}.** {result['title']}")
+                offer_file(result['file_path'], quality)
+            else:
+                failed_count += 1
+                st.warning(f"⚠️ {result['index']}. {result['title']}: {result['error']}")
+            status_text.info(f"🔄 Sedang download playlist... {done_count} siap, {failed_count} gagal.")
+        
+        if done_count or failed_count:
+            status_text.success(f"✅ Playlist selesai! {done_count} berjaya, {failed_count} gagal.")
+        else:
+            status_text.error("❌ Tiada video dijumpai dalam playlist ini.")
+    
     # Download button action
-    if download_btn and url:
+    elif download_btn and url:
         progress_bar = progress_placeholder.progress(0)
         status_text = status_placeholder.empty()
         
-        def update_progress(line):
-            # Simple progress parsing
-            status_text.text(line.strip())
-        
-        status_text.info("🔄 Sedang download... Sila tunggu.")
+        def update_progress(event):
+            if event.percent is not None:
+                progress_bar.progress(int(event.percent))
+            status_text.text(event.describe())
         
-        file_path, error = core.download_video(url, quality, embed_subs, embed_thumb, audio_fmt, custom_name, update_progress)
+        stream = None
+        if core.file_server_enabled():
+            # Single-file formats go straight to the browser while they download
+            stream = core.plan_stream(url, quality, embed_subs, embed_thumb, audio_fmt, custom_name)
         
-        if file_path:
+        if stream:
             progress_bar.progress(100)
-            status_text.success("✅ Download selesai!")
-            
-            # Read file and offer download
-            with open(file_path, 'rb') as f:
-                file_data = f.read()
-            
-            file_name = os.path.basename(file_path)
-            
-            st.download_button(
-                label=f"📥 Download {file_name}",
-                data=file_data,
-                file_name=file_name,
-                mime='video/mp4' if quality != 'Audio Only' else 'audio/mpeg',
+            status_text.success("✅ Sedia! Fail dihantar terus ke browser semasa dimuat turun.")
+            st.link_button(
+                label=f"📥 Download {stream.name}",
+                url=core.publish_stream(stream),
                 use_container_width=True,
                 type="primary"
             )
-            
-            # Cleanup
-            try:
-                os.remove(file_path)
-                os.rmdir(os.path.dirname(file_path))
-            except:
-                pass
         else:
-            progress_bar.empty()
-            status_text.error(f"❌ Download gagal: {error}")
+            status_text.info("🔄 Sedang download... Sila tunggu.")
+            
+            file_path, error = core.download_video(url, quality, embed_subs, embed_thumb, audio_fmt, custom_name, update_progress,
+                                                   session=session_id, sub_langs=sub_langs, auto_subs=auto_subs)
+            
+            if file_path:
+                progress_bar.progress(100)
+                status_text.success("✅ Download selesai!")
+                
+                offer_file(file_path, quality)
+            else:
+                progress_bar.empty()
+                status_text.error(f"❌ Download gagal: {error}")
     
     # Footer
     with st.expander("ℹ️ Lihat senarai website yang disokong"):
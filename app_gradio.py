@@ -1,16 +1,24 @@
-import gradio as gr
 import core
+# Fork the pre-warmed engine workers before Gradio is imported
+core.warm_up()
+
+import gradio as gr
+import asyncio
 import os
 
-def analyze_video(url):
-    """Wrapper for analyzing video info"""
+async def analyze_video(url, request: gr.Request):
+    """Wrapper for analyzing video info, offering the video's real formats as quality choices"""
     if not url:
-        return None, "Sila masukkan URL."
+        return None, "Sila masukkan URL.", gr.update(), gr.update()
     
-    info, error = core.get_video_info(url)
+    info, error = await core.aget_video_info(url)
     
     if error:
-        return None, f"Error: {error}"
+        return None, f"Error: {error}", gr.update(), gr.update()
+    
+    # Subtitles default to the video's language and the browser's locale
+    accept_language = request.headers.get('accept-language') if request else None
+    sub_langs = gr.update(value=', '.join(core.default_subtitle_languages(info, accept_language)))
     
     # Format output for display
     details = f"""
@@ -19,33 +27,82 @@ def analyze_video(url):
     **Tempoh:** {info['duration']}  
     **Saluran:** {info['uploader']}
     """
-    return info['thumbnail'], details
+    if info.get('subtitles'):
+        details = details.rstrip() + f"  \n    **Subtitle:** {', '.join(info['subtitles'])}\n"
+    # A local copy downsized to the display size, not the full-size remote image
+    thumbnail = await asyncio.to_thread(core.get_thumbnail, info)
+    choices = [(choice['note'], choice['label']) for choice in info['choices']]
+    if not choices:
+        return thumbnail, details, gr.update(), sub_langs
+    return thumbnail, details, gr.update(choices=choices, value=choices[0][1]), sub_langs
 
-def process_download(url, quality, audio_fmt, custom_name, embed_subs, embed_thumb, progress=gr.Progress()):
-    """Wrapper for downloading video"""
+async def process_download(url, quality, audio_fmt, custom_name, embed_subs, sub_langs, auto_subs, embed_thumb, batch,
+                           request: gr.Request, progress=gr.Progress()):
+    """Wrapper for downloading a video or a whole playlist"""
+    # Downloads of one browser session share one bandwidth share
+    session = request.session_hash if request else None
+    subtitles = {'sub_langs': sub_langs or None, 'auto_subs': auto_subs}
+    if url and batch:
+        async for update in process_batch(url, quality, audio_fmt, embed_subs, embed_thumb, session, subtitles):
+            yield update
+        return
+    yield await download_single(url, quality, audio_fmt, custom_name, embed_subs, embed_thumb, progress, session, subtitles)
+
+async def process_batch(url, quality, audio_fmt, embed_subs, embed_thumb, session=None, subtitles=None):
+    """Download a playlist/channel, listing every video as soon as it finishes"""
+    lines = []
+    files = []
+    yield None, "🔄 Sedang mendapatkan senarai video..."
+    
+    # The batch API is a blocking generator, step it off the event loop
+    results = core.download_batch(url, quality, embed_subs, embed_thumb, audio_fmt, session=session, **(subtitles or {}))
+    while True:
+        result = await asyncio.to_thread(next, results, None)
+        if result is None:
+            break
+        name = f"{result['index']}. {result['title']}"
+        if not result['file_path']:
+            lines.append(f"- ❌ {name}: {result['error']}")
+        elif core.file_server_enabled():
+            lines.append(f"- ✅ [{name}]({core.publish_file(result['file_path'])})")
+        else:
+            files.append(result['file_path'])
+            lines.append(f"- ✅ {name}")
+        yield files or None, "🔄 Sedang download playlist...\n\n" + "\n".join(lines)
+    
+    if not lines:
+        yield None, "❌ Tiada video dijumpai dalam playlist ini."
+        return
+    yield files or None, "✅ Playlist Selesai!\n\n" + "\n".join(lines)
+
+async def download_single(url, quality, audio_fmt, custom_name, embed_subs, embed_thumb, progress, session=None, subtitles=None):
+    """Download a single video"""
     if not url:
         return None, "⚠️ Sila masukkan URL."
     
     progress(0, desc="Starting download...")
     
     try:
-        def progress_callback(line):
-            # Simple parsing for progress bar
-            if '[download]' in line and '%' in line:
-                try:
-                    percent_str = line.split('%')[0].split()[-1]
-                    percent = float(percent_str)
-                    progress(percent / 100, desc=f"Downloading: {percent}%")
-                except:
-                    pass
-            elif '[download]' in line:
-                progress(0, desc="Processing...")
+        def progress_callback(event):
+            if event.phase == 'download' and event.percent is not None:
+                progress(event.percent / 100, desc=event.describe())
+            else:
+                progress(None, desc=f"Processing ({event.phase})...")
+        
+        if core.file_server_enabled():
+            # Single-file formats go straight to the browser while they download
+            stream = await asyncio.to_thread(
+                core.plan_stream, url, quality, embed_subs, embed_thumb, audio_fmt, custom_name
+            )
+            if stream:
+                return None, f"✅ Sedia! [📥 Muat turun {stream.name}]({core.publish_stream(stream)}) (dihantar terus semasa dimuat turun)"
         
         # Initial check
         progress(0, desc="Initializing yt-dlp...")
         
-        file_path, error = core.download_video(
-            url, quality, embed_subs, embed_thumb, audio_fmt, custom_name, progress_callback
+        file_path, error = await core.adownload_video(
+            url, quality, embed_subs, embed_thumb, audio_fmt, custom_name, progress_callback, session=session,
+            **(subtitles or {})
         )
         
         if error:
@@ -53,6 +110,11 @@ def process_download(url, quality, audio_fmt, custom_name, embed_subs, embed_thu
         
         if not file_path or not os.path.exists(file_path):
             return None, "❌ Ralat: Fail tidak dijumpai selepas muat turun."
+        
+        if core.file_server_enabled():
+            # Stream from disk instead of copying the file into Gradio's cache
+            file_url = core.publish_file(file_path)
+            return None, f"✅ Download Selesai! [📥 Muat turun {os.path.basename(file_path)}]({file_url})"
             
         return file_path, "✅ Download Selesai!"
         
@@ -138,14 +200,24 @@ with gr.Blocks(theme=theme, css=css, title="Universal Video Downloader Pro") as
             with gr.Row():
                 subs_check = gr.Checkbox(label="Sertakan Subtitle", value=True)
                 thumb_check = gr.Checkbox(label="Embed Thumbnail", value=True)
+                batch_check = gr.Checkbox(label="Seluruh Playlist/Channel", value=False)
+            
+            with gr.Row():
+                sub_langs_input = gr.Textbox(
+                    label="Bahasa Subtitle",
+                    value=', '.join(core.default_subtitle_languages()),
+                    placeholder="Contoh: en, ms",
+                    scale=3
+                )
+                auto_subs_check = gr.Checkbox(label="Sertakan Auto-Caption", value=False, scale=1)
 
         # Action Section
         with gr.Group():
             download_btn = gr.Button("🚀 Mula Muat Turun", variant="primary", size="lg")
             
         with gr.Row():
-            status_output = gr.Textbox(label="Status Proses", interactive=False, show_label=True, scale=2)
-            file_output = gr.File(label="Fail Siap", scale=1)
+            status_output = gr.Markdown(label="Status Proses")
+            file_output = gr.File(label="Fail Siap", file_count="multiple", scale=1)
 
         # Footer
         gr.Markdown(
@@ -168,12 +240,13 @@ with gr.Blocks(theme=theme, css=css, title="Universal Video Downloader Pro") as
     analyze_btn.click(
         analyze_video,
         inputs=[url_input],
-        outputs=[thumb_output, details_output]
+        outputs=[thumb_output, details_output, quality_dropdown, sub_langs_input]
     )
     
     download_btn.click(
         process_download,
-        inputs=[url_input, quality_dropdown, audio_fmt_dropdown, custom_name_input, subs_check, thumb_check],
+        inputs=[url_input, quality_dropdown, audio_fmt_dropdown, custom_name_input, subs_check, sub_langs_input,
+                auto_subs_check, thumb_check, batch_check],
         outputs=[file_output, status_output],
         show_progress=True
     )
@@ -182,4 +255,8 @@ if __name__ == "__main__":
     # Hugging Face Spaces usually runs the script, so queue().launch() is correct.
     # However, sometimes ssr_mode=False is needed if static assets fail.
     # Also ensuring server_name is correct for container environments.
+    core.start_file_server()
+    core.start_metrics_server()
+    if not core.queue_enabled():
+        core.get_download_manager()  # resumes downloads an earlier run left unfinished
     app.queue().launch(ssr_mode=False)
@@ -0,0 +1,198 @@
+"""Benchmark get_video_info and download_video against the local media server
+
+Every case runs in a fresh interpreter so caches, the engine pool and
+memory start cold. Reported per case: wall time of the core call,
+throughput, peak RSS of the whole process tree, CPU time (including
+yt-dlp and ffmpeg children) and the number of subprocesses started.
+RSS and subprocess counts are sampled from /proc (Linux only). The JSON
+results also hold the DNS cache and connection reuse counters of the
+engine workers.
+
+Usage: python benchmarks/bench_core.py [--engine pool] [--presets 720p,480p,"Audio Only"]
+                                       [--output benchmarks/results.json]
+"""
+import argparse
+import fnmatch
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from media_server import URLS, MediaServer, generate_media
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+PRESETS = ['720p', '480p', 'Audio Only']
+SAMPLE_INTERVAL = 0.02
+
+
+def run_case(case):
+    """Child side: run one core call and print its result as JSON"""
+    sys.path.insert(0, REPO_DIR)
+    import core
+
+    start = time.perf_counter()
+    if case['op'] == 'info':
+        info, error = core.get_video_info(case['url'])
+        size = 0
+    else:
+        path, error = core.download_video(case['url'], case['preset'], embed_subs=False, embed_thumb=False)
+        size = os.path.getsize(path) if path else 0
+    wall_time = time.perf_counter() - start
+    # DNS cache hits and connection reuse inside the engine workers
+    network = core._engine_pool.network_stats() if core._engine_pool else None
+    print(json.dumps({'wall_time': wall_time, 'bytes': size, 'error': error, 'network': network}))
+
+
+def _process_tree(root_pid):
+    """Map the PIDs of a process and all its descendants to their RSS in bytes"""
+    parents, rss = {}, {}
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with open(f'/proc/{name}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+        except OSError:
+            continue
+        parents[int(name)] = int(fields[1])
+        rss[int(name)] = int(fields[21]) * resource.getpagesize()
+    tree, frontier = {root_pid}, [root_pid]
+    while frontier:
+        pid = frontier.pop()
+        children = [child for child, parent in parents.items() if parent == pid]
+        tree.update(children)
+        frontier.extend(children)
+    return {pid: rss.get(pid, 0) for pid in tree}
+
+
+def measure_case(case, env):
+    """Parent side: run a case in a child interpreter while sampling its process tree"""
+    before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    process = subprocess.Popen([sys.executable, __file__, '--run-case', json.dumps(case)],
+                               stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, env=env, text=True)
+    seen, peak_rss = set(), 0
+    sample = os.path.isdir('/proc')
+    while process.poll() is None:
+        if sample:
+            tree = _process_tree(process.pid)
+            seen.update(tree)
+            peak_rss = max(peak_rss, sum(tree.values()))
+        time.sleep(SAMPLE_INTERVAL)
+    output = process.stdout.read()
+    after = resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    try:
+        result = json.loads(output.strip().splitlines()[-1])
+    except (IndexError, ValueError):
+        result = {'wall_time': None, 'bytes': 0, 'error': f"Case crashed with exit status {process.returncode}"}
+    if not sample:
+        peak_rss = after.ru_maxrss * 1024
+    result.update({
+        'cpu_time': (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime),
+        'peak_rss_mb': peak_rss / 1024 ** 2,
+        'subprocesses': max(len(seen) - 1, 0) if sample else None,
+        'throughput_mbs': (result['bytes'] / result['wall_time'] / 1024 ** 2
+                           if result['bytes'] and result['wall_time'] else None),
+    })
+    return result
+
+
+def load_thresholds(path):
+    """Load {case name pattern: {'max_<metric>' | 'min_<metric>': limit}}"""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def check_thresholds(name, result, thresholds):
+    """List the thresholds a case result violates; later patterns override earlier ones"""
+    limits = {}
+    for pattern, values in thresholds.items():
+        if fnmatch.fnmatch(name, pattern):
+            limits.update(values)
+    failures = []
+    if result['error']:
+        failures.append('error')
+    for key, limit in limits.items():
+        bound, metric = key.split('_', 1)
+        value = result.get(metric)
+        if value is None:
+            continue
+        if (bound == 'max' and value > limit) or (bound == 'min' and value < limit):
+            failures.append(f"{metric}={value:.2f} ({bound} {limit})")
+    return failures
+
+
+def _cell(value, width, digits=2):
+    return f"{value:{width}.{digits}f}" if value is not None else '-'.rjust(width)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    parser.add_argument('--engine', default=os.environ.get('VD_ENGINE', 'pool'), choices=['pool', 'subprocess'])
+    parser.add_argument('--media', default=','.join(URLS), help="comma-separated media kinds")
+    parser.add_argument('--presets', default=','.join(PRESETS), help="comma-separated quality presets")
+    parser.add_argument('--bandwidth', type=int, default=0, help="emulated server bandwidth in bytes per second")
+    parser.add_argument('--output', default=os.path.join(BENCH_DIR, 'results.json'))
+    parser.add_argument('--thresholds', default=os.path.join(BENCH_DIR, 'thresholds.json'))
+    args = parser.parse_args()
+
+    if args.run_case:
+        run_case(json.loads(args.run_case))
+        return
+
+    server = MediaServer(generate_media(), bandwidth=args.bandwidth).start()
+    spool_dir = tempfile.mkdtemp(prefix='vd-bench-')
+    env = dict(os.environ,
+               VD_ENGINE=args.engine,
+               VD_FILE_CACHE_BYTES='0',
+               VD_INFO_CACHE_DB='',
+               VD_FILE_SERVER_PORT='0',
+               VD_SPOOL_DIR=spool_dir)
+    thresholds = load_thresholds(args.thresholds)
+
+    cases = []
+    for kind in args.media.split(','):
+        cases.append({'name': f'{kind}/info', 'op': 'info', 'url': server.url(kind), 'preset': None})
+        for preset in args.presets.split(','):
+            cases.append({'name': f'{kind}/{preset}/download', 'op': 'download', 'url': server.url(kind), 'preset': preset})
+
+    results, failed = [], 0
+    print(f"{'case':<32} {'wall s':>8} {'MiB/s':>8} {'RSS MiB':>8} {'CPU s':>8} {'procs':>6}")
+    for case in cases:
+        result = measure_case(case, env)
+        result['name'] = case['name']
+        result['regressions'] = check_thresholds(case['name'], result, thresholds)
+        failed += bool(result['regressions'])
+        results.append(result)
+
+        print(f"{case['name']:<32} {_cell(result['wall_time'], 8)} {_cell(result['throughput_mbs'], 8, 1)} "
+              f"{_cell(result['peak_rss_mb'], 8, 0)} {_cell(result['cpu_time'], 8)} {_cell(result['subprocesses'], 6, 0)}"
+              + (f"  FAIL: {', '.join(result['regressions'])}" if result['regressions'] else ''))
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'engine': args.engine,
+        'bandwidth': args.bandwidth,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cases': results,
+        'passed': not failed,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    shutil.rmtree(spool_dir, ignore_errors=True)
+    print(f"\n{len(results) - failed}/{len(results)} cases within thresholds, results written to {args.output}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Micro-benchmark: site detection time as the number of mirror domains grows
+
+Usage: python benchmarks/bench_site_matcher.py
+"""
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import core
+
+URLS = [
+    'https://www.youtube.com/watch?v=dQw4w9WgXcQ',
+    'https://anitaku.pe/one-piece-episode-1',
+    'https://mirror-9999.example-anime.net/watch/1',
+    'https://unknown-site.org/video/1?next=x.com',
+]
+
+
+def linear_detect(sites, url):
+    """The original per-pattern scan over the full URL"""
+    for category, patterns in sites.items():
+        for pattern, name, referer in patterns:
+            if re.search(pattern, url, re.IGNORECASE):
+                return {'category': category, 'name': name, 'referer': referer}
+    return {'category': 'unknown', 'name': 'Unknown', 'referer': ''}
+
+
+def mirrors(count):
+    """Synthetic mirror domains in both rule formats"""
+    domains = [f'mirror-{i}.example-anime.net' for i in range(count)]
+    extra = {'sites': {'anime': [{'name': 'Mirror', 'referer': '', 'domains': domains}]}}
+    sites = dict(core.SITES)
+    sites['anime'] = sites['anime'] + [(re.escape(d), 'Mirror', '') for d in domains]
+    return sites, extra
+
+
+def main():
+    number = 2000
+    print(f"{'rules':>8} {'linear us/url':>14} {'indexed us/url':>15}")
+    for count in (10, 100, 1000, 10000):
+        sites, extra = mirrors(count)
+        matcher = core.SiteMatcher(extra=extra)
+        # The linear scan is slow enough at large sizes that fewer rounds suffice
+        rounds = max(number * 10 // count, 5)
+        linear = timeit.timeit(lambda: [linear_detect(sites, u) for u in URLS], number=rounds)
+        indexed = timeit.timeit(lambda: [matcher.detect(u) for u in URLS], number=number)
+        print(f"{count:>8} {linear / rounds / len(URLS) * 1e6:>14.1f} {indexed / number / len(URLS) * 1e6:>15.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+"""Benchmark cold start: import time per module and time to the first analyze after boot
+
+Import cases run `python -X importtime -c "import <module>"` in a fresh
+interpreter and report the module's cumulative import time with its
+heaviest imports. The first-analyze cases boot like an app entry point
+(import core, optionally warm up, import the UI framework), wait until
+the user's first click and time get_video_info against the local media
+server, once with VD_WARM_UP=1 and once with VD_WARM_UP=0.
+
+Usage: python benchmarks/bench_startup.py [--engine pool] [--ui gradio] [--click-after 2]
+                                          [--output benchmarks/startup_results.json]
+"""
+import argparse
+import importlib.util
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+
+from bench_core import BENCH_DIR, REPO_DIR, check_thresholds, load_thresholds
+from media_server import MediaServer, generate_media
+
+MODULES = ['core', 'api', 'cli', 'worker', 'gradio', 'streamlit']
+TOP_IMPORTS = 5
+
+
+def parse_importtime(stderr, module):
+    """Get (cumulative seconds of module, its heaviest direct imports) from -X importtime output"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        rows.append((int(cumulative) / 1e6, len(name) - len(name.lstrip()), name.strip()))
+    index = next((i for i, row in enumerate(rows) if row[2] == module), None)
+    if index is None:
+        return None, []
+    total, depth, _ = rows[index]
+    # Imports are listed before the module that imported them, its direct ones one level deeper
+    children = []
+    for seconds, level, name in reversed(rows[:index]):
+        if level <= depth:
+            break
+        if level == depth + 2:
+            children.append((name, round(seconds, 4)))
+    return total, sorted(children, key=lambda child: -child[1])[:TOP_IMPORTS]
+
+
+def measure_import(module, env):
+    if importlib.util.find_spec(module) is None and not os.path.exists(os.path.join(REPO_DIR, f'{module}.py')):
+        return {'wall_time': None, 'error': None, 'skipped': f"{module} is not installed"}
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=REPO_DIR, env=env, capture_output=True, text=True)
+    total, heaviest = parse_importtime(result.stderr, module)
+    error = None if result.returncode == 0 else result.stderr.strip().splitlines()[-1]
+    return {'wall_time': total, 'heaviest_imports': heaviest, 'error': error}
+
+
+def run_boot(ui, click_after, url):
+    """Child side: boot like an app entry point, then analyze on the first click"""
+    boot = time.perf_counter()
+    sys.path.insert(0, REPO_DIR)
+    import core
+    core.warm_up()
+    if ui and importlib.util.find_spec(ui):
+        __import__(ui)
+    ready = time.perf_counter() - boot
+    time.sleep(max(0.0, click_after - ready))
+
+    click = time.perf_counter()
+    info, error = core.get_video_info(url)
+    done = time.perf_counter()
+    print(json.dumps({'wall_time': done - click, 'boot_to_result': done - boot, 'ui_ready': ready, 'error': error}))
+
+
+def measure_boot(ui, click_after, url, env):
+    process = subprocess.run([sys.executable, __file__, '--run-boot', json.dumps([ui, click_after, url])],
+                             env=env, capture_output=True, text=True)
+    try:
+        return json.loads(process.stdout.strip().splitlines()[-1])
+    except (IndexError, ValueError):
+        return {'wall_time': None, 'error': f"Boot crashed with exit status {process.returncode}"}
+
+
+def _cell(value, width):
+    return f"{value:{width}.3f}" if value is not None else '-'.rjust(width)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--run-boot', help=argparse.SUPPRESS)
+    parser.add_argument('--engine', default=os.environ.get('VD_ENGINE', 'pool'), choices=['pool', 'subprocess'])
+    parser.add_argument('--ui', default='gradio', help="UI framework imported during boot ('' for none)")
+    parser.add_argument('--click-after', type=float, default=2.0, help="seconds from boot to the first analyze")
+    parser.add_argument('--output', default=os.path.join(BENCH_DIR, 'startup_results.json'))
+    parser.add_argument('--thresholds', default=os.path.join(BENCH_DIR, 'thresholds.json'))
+    args = parser.parse_args()
+
+    if args.run_boot:
+        run_boot(*json.loads(args.run_boot))
+        return
+
+    env = dict(os.environ, VD_ENGINE=args.engine, VD_INFO_CACHE_DB='', VD_FILE_SERVER_PORT='0')
+    thresholds = load_thresholds(args.thresholds)
+    results = []
+    for module in MODULES:
+        result = measure_import(module, env)
+        result['name'] = f'startup/import/{module}'
+        results.append(result)
+
+    server = MediaServer(generate_media()).start()
+    for mode, warm in (('warm', '1'), ('cold', '0')):
+        result = measure_boot(args.ui, args.click_after, server.url('progressive'), dict(env, VD_WARM_UP=warm))
+        result['name'] = f'startup/first-analyze/{mode}'
+        results.append(result)
+
+    failed = 0
+    print(f"{'case':<32} {'seconds':>8}")
+    for result in results:
+        result['regressions'] = [] if result.get('skipped') else check_thresholds(result['name'], result, thresholds)
+        failed += bool(result['regressions'])
+        note = result.get('skipped') or ', '.join(f"{name} {seconds:.3f}" for name, seconds in result.get('heaviest_imports', []))
+        print(f"{result['name']:<32} {_cell(result['wall_time'], 8)}  {note}"
+              + (f"  FAIL: {', '.join(result['regressions'])}" if result['regressions'] else ''))
+
+    report = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'engine': args.engine,
+        'ui': args.ui,
+        'click_after': args.click_after,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cases': results,
+        'passed': not failed,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"\n{len(results) - failed}/{len(results)} cases within thresholds, results written to {args.output}")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,211 @@
+"""Local stand-in for a video site, used by the benchmarks
+
+Synthetic test media is generated once with ffmpeg and served over HTTP:
+
+- /progressive/index.html  <video> page with one progressive MP4 per height
+- /dash/manifest.mpd       separate video-only (per height) and audio streams that need a merge
+- /hls/master.m3u8         one variant per height, cut into many short fragments
+
+Usage: python benchmarks/media_server.py [--port 8790] [--bandwidth BYTES_PER_SEC]
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+
+MEDIA_DIR = os.path.join(tempfile.gettempdir(), 'vd-bench-media')
+HEIGHTS = (720, 480)
+DURATION = 10
+HLS_SEGMENT = 0.5
+FRAME_RATE = 25
+
+URLS = {
+    'progressive': '/progressive/index.html',
+    'dash': '/dash/manifest.mpd',
+    'hls': '/hls/master.m3u8',
+}
+
+PROGRESSIVE_PAGE = """<html><head><title>{title}</title></head><body>
+<video controls>
+{sources}
+</video>
+</body></html>
+"""
+
+MPD = """<?xml version="1.0" encoding="UTF-8"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT{duration}S" minBufferTime="PT2S" profiles="urn:mpeg:dash:profile:isoff-on-demand:2011">
+ <Period>
+  <AdaptationSet mimeType="video/mp4" contentType="video">
+{video}
+  </AdaptationSet>
+  <AdaptationSet mimeType="audio/mp4" contentType="audio">
+   <Representation id="audio" codecs="mp4a.40.2" bandwidth="128000" audioSamplingRate="44100"><BaseURL>audio.m4a</BaseURL></Representation>
+  </AdaptationSet>
+ </Period>
+</MPD>
+"""
+
+
+def _ffmpeg(*args, ffmpeg='ffmpeg'):
+    subprocess.run([ffmpeg, '-loglevel', 'error', '-y', *args], check=True)
+
+
+def generate_media(root=MEDIA_DIR, heights=HEIGHTS, duration=DURATION, hls_segment=HLS_SEGMENT, ffmpeg='ffmpeg'):
+    """Generate the test media into root, reusing it when the parameters are unchanged"""
+    # Keyframes at every HLS segment boundary, or segments come out a GOP long
+    gop = max(int(FRAME_RATE * hls_segment), 1)
+    encoder = ['-c:v', 'libx264', '-preset', 'ultrafast', '-g', str(gop)]
+    # Everything that shapes the files, so a change in the encoding or segmenting regenerates them
+    params = {'heights': list(heights), 'duration': duration, 'hls_segment': hls_segment, 'frame_rate': FRAME_RATE,
+              'encoder': encoder}
+    marker = os.path.join(root, 'media.json')
+    try:
+        with open(marker) as f:
+            if json.load(f) == params:
+                return root
+    except (OSError, ValueError):
+        pass
+    if not shutil.which(ffmpeg):
+        raise SystemExit("ffmpeg is required to generate the benchmark media")
+
+    shutil.rmtree(root, ignore_errors=True)
+    for kind in URLS:
+        os.makedirs(os.path.join(root, kind))
+
+    sources, representations, variants = [], [], []
+    for height in heights:
+        width = height * 16 // 9 // 2 * 2
+        progressive = os.path.join(root, 'progressive', f'{height}.mp4')
+        _ffmpeg('-f', 'lavfi', '-i', f'testsrc2=size={width}x{height}:rate={FRAME_RATE}:duration={duration}',
+                '-f', 'lavfi', '-i', f'sine=frequency=440:duration={duration}',
+                *encoder, '-c:a', 'aac', '-shortest',
+                progressive, ffmpeg=ffmpeg)
+        sources.append(f'<source src="{height}.mp4" type="video/mp4" res="{height}" label="{height}p">')
+
+        # DASH: the same picture without audio
+        _ffmpeg('-i', progressive, '-an', '-c', 'copy', os.path.join(root, 'dash', f'video-{height}.mp4'), ffmpeg=ffmpeg)
+        bandwidth = os.path.getsize(progressive) * 8 // duration
+        representations.append(
+            f'   <Representation id="video-{height}" codecs="avc1.64001f" width="{width}" height="{height}" '
+            f'bandwidth="{bandwidth}"><BaseURL>video-{height}.mp4</BaseURL></Representation>')
+
+        # HLS: many short MPEG-TS fragments per variant
+        _ffmpeg('-i', progressive, '-c', 'copy', '-bsf:v', 'h264_mp4toannexb', '-f', 'hls',
+                '-hls_time', str(hls_segment), '-hls_list_size', '0',
+                '-hls_segment_filename', os.path.join(root, 'hls', f'{height}-%04d.ts'),
+                os.path.join(root, 'hls', f'{height}.m3u8'), ffmpeg=ffmpeg)
+        variants.append(f'#EXT-X-STREAM-INF:BANDWIDTH={bandwidth},RESOLUTION={width}x{height},'
+                        f'CODECS="avc1.64001f,mp4a.40.2"\n{height}.m3u8')
+
+    _ffmpeg('-i', os.path.join(root, 'progressive', f'{heights[0]}.mp4'), '-vn', '-c', 'copy',
+            os.path.join(root, 'dash', 'audio.m4a'), ffmpeg=ffmpeg)
+
+    with open(os.path.join(root, 'progressive', 'index.html'), 'w') as f:
+        f.write(PROGRESSIVE_PAGE.format(title='Benchmark progressive', sources="\n".join(sources)))
+    with open(os.path.join(root, 'dash', 'manifest.mpd'), 'w') as f:
+        f.write(MPD.format(duration=duration, video="\n".join(representations)))
+    with open(os.path.join(root, 'hls', 'master.m3u8'), 'w') as f:
+        f.write("#EXTM3U\n" + "\n".join(variants) + "\n")
+    with open(marker, 'w') as f:
+        json.dump(params, f)
+    return root
+
+
+class _MediaHandler(SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like a CDN
+    bandwidth = 0  # bytes per second per connection, 0 for unlimited
+    remaining = None  # body length of a Range response
+
+    def send_head(self):
+        # Single byte ranges, like a CDN; ffmpeg seeks in MP4s this way
+        match = re.fullmatch(r'bytes=(\d+)-(\d*)', self.headers.get('Range', ''))
+        path = self.translate_path(self.path)
+        if not match or not os.path.isfile(path):
+            return super().send_head()
+        size = os.path.getsize(path)
+        start = int(match.group(1))
+        end = min(int(match.group(2) or size - 1), size - 1)
+        if start >= size:
+            self.send_error(416)
+            return None
+        source = open(path, 'rb')
+        source.seek(start)
+        self.remaining = end - start + 1
+        self.send_response(206)
+        self.send_header('Content-Type', self.guess_type(path))
+        self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+        self.send_header('Content-Length', str(self.remaining))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        return source
+
+    def copyfile(self, source, outputfile):
+        # Emulate a remote server: pace the body in 10 chunks per second
+        chunk_size = max(self.bandwidth // 10, 1) if self.bandwidth else 64 * 1024
+        remaining = self.remaining
+        while remaining is None or remaining > 0:
+            chunk = source.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not chunk:
+                break
+            try:
+                outputfile.write(chunk)
+            except (BrokenPipeError, ConnectionResetError):
+                # Clients seeking in a file drop the connection mid-body
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            if self.bandwidth:
+                time.sleep(0.1)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MediaServer(ThreadingHTTPServer):
+    """HTTP server for the generated media"""
+
+    daemon_threads = True
+
+    def __init__(self, root=MEDIA_DIR, host='127.0.0.1', port=0, bandwidth=0):
+        handler = type('MediaHandler', (_MediaHandler,), {'bandwidth': bandwidth})
+        super().__init__((host, port), partial(handler, directory=root))
+        self.base_url = f"http://{host}:{self.server_address[1]}"
+
+    def handle_error(self, request, client_address):
+        # Clients close their kept-alive connections whenever they like
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def start(self):
+        """Serve in a background thread"""
+        threading.Thread(target=self.serve_forever, name='media-server', daemon=True).start()
+        return self
+
+    def url(self, kind):
+        """Get the page URL of a media kind ('progressive', 'dash' or 'hls')"""
+        return self.base_url + URLS[kind]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8790)
+    parser.add_argument('--bandwidth', type=int, default=0, help="bytes per second per connection (0 = unlimited)")
+    parser.add_argument('--root', default=MEDIA_DIR)
+    args = parser.parse_args()
+
+    server = MediaServer(generate_media(args.root), port=args.port, bandwidth=args.bandwidth)
+    for kind in URLS:
+        print(f"{kind:>12}: {server.url(kind)}")
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,107 @@
+"""Batch command line downloader over core, without the UI frameworks
+
+Reads URLs (one per line, '#' starts a comment) from a file or stdin and
+downloads them with bounded parallelism. Prints one JSON line per URL as
+it finishes and exits non-zero when any download failed.
+
+Usage: python cli.py urls.txt [-q 720p] [-j 4] [-o downloads] [--audio-format mp3] [--subs]
+                                  [--sub-langs en,ms] [--auto-subs] [--thumb]
+"""
+import argparse
+import itertools
+import json
+import os
+import shutil
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import core
+
+
+def read_urls(source):
+    """Read the URLs of a list file, skipping blank lines and comments"""
+    urls = []
+    for line in source:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            urls.append(line)
+    return urls
+
+
+def reserve_path(output_dir, name):
+    """Create an empty file for name in output_dir, as 'title (2).mp4' etc. when taken; returns its path"""
+    stem, ext = os.path.splitext(name)
+    for n in itertools.count(1):
+        path = os.path.join(output_dir, name if n == 1 else f"{stem} ({n}){ext}")
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return path
+        except FileExistsError:
+            continue
+
+
+def download_one(url, options, output_dir):
+    """Download one URL into output_dir, returns its result dict"""
+    started = time.monotonic()
+    try:
+        while True:
+            try:
+                job = core.submit_download(url, **options)
+                break
+            except core.QueueFullError:
+                time.sleep(1)
+        file_path, error = job.wait()
+        if file_path:
+            dest = reserve_path(output_dir, os.path.basename(file_path))
+            shutil.move(file_path, dest)
+            core.release_download(file_path)
+            file_path = dest
+    except Exception as e:
+        file_path, error = None, f"{type(e).__name__}: {e}"
+    return {
+        'url': url,
+        'status': 'done' if file_path else 'failed',
+        'file': file_path,
+        'error': error and error[-500:],
+        'seconds': round(time.monotonic() - started, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('urls', help="file with one URL per line, '-' for stdin")
+    parser.add_argument('-q', '--quality', default='1080p', help="quality preset, e.g. 720p, 'Audio Only' (default 1080p)")
+    parser.add_argument('-j', '--parallel', type=int, default=core.BATCH_PARALLEL, help="downloads in flight at once")
+    parser.add_argument('-o', '--output-dir', default='.', help="where finished files are moved")
+    parser.add_argument('--audio-format', default='mp3', choices=sorted(core.STREAM_AUDIO_FORMATS))
+    parser.add_argument('--subs', action='store_true', help="embed subtitles")
+    parser.add_argument('--sub-langs', help="comma-separated subtitle languages (default: the video's language and "
+                                            f"{','.join(core.SUBTITLE_LANGS)})")
+    parser.add_argument('--auto-subs', action='store_true', help="fall back to auto-generated captions")
+    parser.add_argument('--thumb', action='store_true', help="embed the thumbnail")
+    args = parser.parse_args()
+
+    if args.urls == '-':
+        urls = read_urls(sys.stdin)
+    else:
+        with open(args.urls) as f:
+            urls = read_urls(f)
+    os.makedirs(args.output_dir, exist_ok=True)
+    options = {'quality': args.quality, 'embed_subs': args.subs, 'embed_thumb': args.thumb,
+               'audio_format': args.audio_format, 'sub_langs': args.sub_langs, 'auto_subs': args.auto_subs,
+               'priority': core.PRIORITY_LOW, 'session': 'cli'}
+
+    failed = 0
+    with ThreadPoolExecutor(max_workers=max(1, args.parallel), thread_name_prefix='cli') as executor:
+        futures = [executor.submit(download_one, url, options, args.output_dir) for url in urls]
+        for future in as_completed(futures):
+            result = future.result()
+            failed += result['status'] != 'done'
+            print(json.dumps(result), flush=True)
+    print(f"{len(urls) - failed} of {len(urls)} downloaded", file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
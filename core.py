@@ -1,10 +1,40 @@
+import abc
+import asyncio
 import os
 import subprocess
 import re
+import contextlib
+import functools
+import inspect
+import signal
 import tempfile
 import json
+import logging
 from pathlib import Path
 import sys
+import atexit
+import hashlib
+import heapq
+import importlib.util
+import itertools
+import math
+import mimetypes
+import multiprocessing
+import multiprocessing.connection
+import queue
+import random
+import secrets
+import shutil
+import socket
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait as wait_futures
+import threading
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, asdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode, quote
+
 
 # Website detection patterns
 SITES = {
@@ -50,32 +80,420 @@ VIDEO_HOSTS = [
     'gogocdn', 'kwik', 'megacloud', 'vidcloud', 'fembed', 'mixdrop', 'mycloud'
 ]
 
+# Referer for each video host; hosts not listed here use DEFAULT_VIDEO_HOST_REFERER
+VIDEO_HOST_REFERERS = {
+    'kwik': 'https://animepahe.ru/',
+    'gogocdn': 'https://gogoanimehd.to/',
+    'fembed': 'https://dramacool.pa/',
+}
+DEFAULT_VIDEO_HOST_REFERER = 'https://9animetv.to/'
+
+# Extra site rules (e.g. thousands of mirror domains) loaded from a JSON file:
+# {"sites": {"anime": [{"name": "GogoAnime", "referer": "https://gogoanimehd.to/",
+#                       "domains": ["gogoanime3.co"], "keywords": []}]},
+#  "video_hosts": {"streamtape": "https://9animetv.to/"}}
+SITES_FILE = os.environ.get('VD_SITES_FILE', '')
+
+# Engine mode: 'pool' drives yt_dlp.YoutubeDL inside long-lived pre-warmed worker
+# processes, 'subprocess' starts a fresh yt-dlp interpreter for every call
+ENGINE_MODE = os.environ.get('VD_ENGINE', 'pool')
+ENGINE_WORKERS = int(os.environ.get('VD_ENGINE_WORKERS', '2'))
+# Each engine worker keeps keep-alive HTTP connections (per host, at most
+# HTTP_POOL_PER_HOST) and a DNS_CACHE_TTL-second DNS cache across its jobs, so
+# repeat requests and fragments to the same CDN skip the lookup and handshake.
+# Connection sharing needs yt-dlp's requests handler (pip install requests).
+DNS_CACHE_TTL = float(os.environ.get('VD_DNS_CACHE_TTL', '300'))  # 0 disables
+DNS_CACHE_SIZE = 512
+HTTP_POOL_PER_HOST = int(os.environ.get('VD_HTTP_POOL_PER_HOST', '8'))
+HTTP_POOL_HOSTS = 32
+
+# Startup warm-up (warm_up()): the engine workers are forked before the UI
+# framework is imported and load the extractors of the SITES categories, while a
+# background thread resolves executables and probes ffmpeg, so the first
+# "Analisis" click does not pay for it. VD_WARM_UP=0 leaves it all to first use.
+WARM_UP = os.environ.get('VD_WARM_UP', '1') != '0'
+# yt-dlp extractor keys per SITES category; the streaming sites go through the generic extractor
+WARM_EXTRACTORS = {
+    'youtube': ('Youtube', 'YoutubeTab'),
+    'dailymotion': ('Dailymotion',),
+    'bilibili': ('BiliBili', 'BiliIntl'),
+    'social': ('Facebook', 'Instagram', 'TikTok', 'Twitter'),
+    'anime': ('Generic',),
+    'movie': ('Generic',),
+    'drama': ('Generic',),
+}
+
+# Options shared by every metadata extraction
+INFO_ARGS = ['--no-playlist', '--force-ipv4', '--no-check-certificates']
+
+# Playlist/channel enumeration: entries are listed lazily, page by page,
+# without resolving each video
+PLAYLIST_ARGS = ['--yes-playlist', '--flat-playlist', '--lazy-playlist', '--force-ipv4', '--no-check-certificates']
+BATCH_PARALLEL = int(os.environ.get('VD_BATCH_PARALLEL', '3'))
+
+# Metadata cache: entries live for INFO_CACHE_TTL seconds, or until shortly
+# before their signed format URLs expire, whichever comes first.
+# Set VD_INFO_CACHE_DB to a file path to persist entries across restarts.
+INFO_CACHE_TTL = int(os.environ.get('VD_INFO_CACHE_TTL', '3600'))
+INFO_CACHE_SIZE = int(os.environ.get('VD_INFO_CACHE_SIZE', '256'))
+INFO_CACHE_DB = os.environ.get('VD_INFO_CACHE_DB', '')
+INFO_EXPIRY_MARGIN = 300
+
+# Finished-file cache: repeat downloads with identical options are served
+# from disk. Set VD_FILE_CACHE_BYTES=0 to disable it.
+FILE_CACHE_DIR = os.environ.get('VD_FILE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'vd-file-cache'))
+FILE_CACHE_BYTES = int(os.environ.get('VD_FILE_CACHE_BYTES', str(2 * 1024 ** 3)))
+FILE_CACHE_POLICY = os.environ.get('VD_FILE_CACHE_POLICY', 'lru')  # 'lru' or 'lfu'
+
+# Spool: every download gets its own job directory under SPOOL_DIR. The
+# janitor deletes finished jobs after SPOOL_MAX_AGE seconds (oldest first
+# when over SPOOL_BYTES), and jobs whose expected size does not fit wait up
+# to SPOOL_WAIT seconds for room before they are refused.
+SPOOL_DIR = os.environ.get('VD_SPOOL_DIR', os.path.join(tempfile.gettempdir(), 'vd-spool'))
+SPOOL_BYTES = int(os.environ.get('VD_SPOOL_BYTES', str(10 * 1024 ** 3)))
+SPOOL_MAX_AGE = int(os.environ.get('VD_SPOOL_MAX_AGE', str(6 * 3600)))
+SPOOL_MIN_FREE = int(os.environ.get('VD_SPOOL_MIN_FREE', str(512 * 1024 ** 2)))
+SPOOL_WAIT = int(os.environ.get('VD_SPOOL_WAIT', '300'))
+# Managed jobs wait for room in the queue, checking again this often, not in a download slot
+SPOOL_ADMIT_INTERVAL = 5
+SPOOL_JANITOR_INTERVAL = 60
+# Processes sharing SPOOL_DIR each own their job directories ('host:pid' in a
+# <dir>.owner file) and heartbeat; a directory is only adopted, aged out or
+# evicted by another process once its owner is gone for OWNER_TTL seconds
+OWNER_TTL = 3 * SPOOL_JANITOR_INTERVAL
+# Merging writes the output next to the downloaded streams, so reserve room for both
+SPOOL_HEADROOM = 2.0
+
+# File delivery: finished files can be streamed from disk by a small HTTP server
+# (sendfile + Range) on its own port. It is off by default because the usual
+# deploys (Docker, HF Spaces, Koyeb) expose only the UI's port; set
+# VD_FILE_SERVER_PORT where a second port is reachable and VD_FILE_SERVER_URL
+# to the public base URL browsers use to reach it.
+FILE_SERVER_HOST = os.environ.get('VD_FILE_SERVER_HOST', '0.0.0.0')
+FILE_SERVER_PORT = int(os.environ.get('VD_FILE_SERVER_PORT', '0'))
+FILE_SERVER_URL = os.environ.get('VD_FILE_SERVER_URL', '')
+FILE_LINK_TTL = int(os.environ.get('VD_FILE_LINK_TTL', '3600'))
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+# Health and metrics: /healthz, /readyz and /metrics are served on their own
+# small port, so probes and Prometheus work without the file server (which
+# answers them as well). Containers can probe it on localhost; 0 disables it.
+METRICS_HOST = os.environ.get('VD_METRICS_HOST', '0.0.0.0')
+METRICS_PORT = int(os.environ.get('VD_METRICS_PORT', '9464'))
+
+# Pipe-through streaming: single-file formats go from yt-dlp's stdout (through
+# ffmpeg when converting audio) straight to the browser. Audio format ->
+# (MIME type, ffmpeg options producing a pipe-friendly container).
+STREAM_AUDIO_FORMATS = {
+    'mp3': ('audio/mpeg', ['-c:a', 'libmp3lame', '-q:a', '2', '-f', 'mp3']),
+    'm4a': ('audio/mp4', ['-c:a', 'aac', '-b:a', '192k', '-movflags', 'frag_keyframe+empty_moov', '-f', 'mp4']),
+    'wav': ('audio/wav', ['-c:a', 'pcm_s16le', '-f', 'wav']),
+    'flac': ('audio/flac', ['-c:a', 'flac', '-f', 'flac']),
+}
+STREAM_PROTOCOLS = ('http', 'https')
+
+# Downloader tuning per detect_website category: concurrent fragment downloads
+# for HLS/DASH, chunk size for HTTP-range downloads, and an optional external
+# downloader for plain HTTP files (only used when its binary is installed).
+# HLS/DASH stays on the native downloader, which appends each fragment to the
+# output as it arrives instead of concatenating them in a separate pass.
+DOWNLOADER_PROFILES = {
+    'default': {'fragments': 4, 'chunk_size': None, 'external': None},
+    'youtube': {'fragments': 4, 'chunk_size': '10M'},
+    'anime': {'fragments': 8, 'external': 'aria2c'},
+    'movie': {'fragments': 8, 'external': 'aria2c'},
+    'drama': {'fragments': 8, 'external': 'aria2c'},
+    'social': {'fragments': 2},
+}
+EXTERNAL_DOWNLOADER_ARGS = {
+    'aria2c': '-x 8 -s 8 -k 1M --file-allocation=none --summary-interval=1',
+}
+# Environment overrides applied on top of every profile
+CONCURRENT_FRAGMENTS = os.environ.get('VD_CONCURRENT_FRAGMENTS')
+HTTP_CHUNK_SIZE = os.environ.get('VD_HTTP_CHUNK_SIZE')
+EXTERNAL_DOWNLOADER = os.environ.get('VD_EXTERNAL_DOWNLOADER')  # 'none' disables
+
+# Format selection: the extracted formats are ranked per quality preset (see
+# rank_formats) so a pre-muxed file or stream-copyable streams win over merges
+# and re-encodes. Labels of the presets by height, for the real choices of a video.
+QUALITY_LABELS = {2160: '4K (2160p)', 1440: '2K (1440p)'}
+MERGE_CONTAINER = 'mp4'
+# Codec prefixes (yt-dlp's vcodec/acodec names) a container takes as they are, None for any
+CONTAINER_CODECS = {
+    'mp4': ('avc', 'h264', 'hev', 'hvc', 'h265', 'av01', 'vp09', 'vp9', 'mp4a', 'aac', 'mp3', 'ac-3', 'ec-3', 'opus', 'flac'),
+    'webm': ('vp8', 'vp9', 'vp09', 'av01', 'opus', 'vorbis'),
+    'mkv': None,
+}
+# Source audio codecs yt-dlp's ExtractAudio copies instead of transcoding, per audio format
+AUDIO_COPY_CODECS = {'mp3': ('mp3',), 'm4a': ('mp4a', 'aac'), 'flac': ('flac',), 'wav': ()}
+
+# Single-pass post-processing: when the formats are known from the cached info,
+# yt-dlp only downloads the streams, subtitles and thumbnail, and one stream-copy
+# ffmpeg run muxes them, instead of yt-dlp rewriting the whole file once per
+# Merger/Fixup/VideoRemuxer/EmbedSubtitle/EmbedThumbnail step
+SINGLE_PASS = os.environ.get('VD_SINGLE_PASS', '1') != '0'
+PARTS_DIR = '.parts'
+# Container -> subtitle codec ('copy' keeps the downloaded one), None drops subtitles
+SUBTITLE_CODECS = {'mp4': 'mov_text', 'm4v': 'mov_text', 'mov': 'mov_text', 'mkv': 'copy', 'webm': 'webvtt'}
+SUBTITLE_EXTS = ('vtt', 'srt', 'ass', 'ssa')
+
+# Subtitle selection: only tracks in the chosen languages are fetched, by default
+# the video's own language and SUBTITLE_LANGS (the UIs use the browser's locale),
+# and only uploaded ones unless auto-generated captions are asked for. Tracks are
+# fetched in parallel with the video and cached per video ID and language.
+# Subtitle and thumbnail fetches use the network options of the downloads and
+# are retried FETCH_RETRIES times; a subtitle track that still fails is left to
+# yt-dlp.
+SUBTITLE_LANGS = [lang.strip() for lang in os.environ.get('VD_SUBTITLE_LANGS', 'en').split(',') if lang.strip()]
+SUBTITLE_MAX_TRACKS = 4
+SUBTITLE_PARALLEL = 4
+FETCH_RETRIES = 2
+SUBTITLE_CACHE_DIR = os.environ.get('VD_SUBTITLE_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'vd-subtitle-cache'))
+SUBTITLE_CACHE_MAX_AGE = int(os.environ.get('VD_SUBTITLE_CACHE_MAX_AGE', str(7 * 24 * 3600)))
+THUMBNAIL_MIMES = {'jpg': 'image/jpeg', 'jpeg': 'image/jpeg', 'png': 'image/png', 'webp': 'image/webp'}
+
+# Thumbnail proxy: the analyze views show a local copy downsized to
+# THUMBNAIL_WIDTH (WebP, or JPEG when Pillow lacks WebP) instead of making the
+# browser fetch the full-size remote image, and --embed-thumbnail reuses the
+# fetched original. Both live in an LRU disk cache keyed by video ID.
+THUMBNAIL_WIDTH = int(os.environ.get('VD_THUMBNAIL_WIDTH', '320'))
+THUMBNAIL_CACHE_DIR = os.environ.get('VD_THUMBNAIL_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'vd-thumbnail-cache'))
+THUMBNAIL_CACHE_BYTES = int(os.environ.get('VD_THUMBNAIL_CACHE_BYTES', str(64 * 1024 * 1024)))
+
+# Download scheduling: at most MAX_DOWNLOADS jobs run at once, at most
+# MAX_QUEUED wait behind them, and each host gets its own concurrency limit
+# (by detect_website category) so bursts don't trigger 429s
+MAX_DOWNLOADS = int(os.environ.get('VD_MAX_DOWNLOADS', '4'))
+MAX_QUEUED = int(os.environ.get('VD_MAX_QUEUED', '32'))
+HOST_CONCURRENCY = {
+    'youtube': 3,
+    'dailymotion': 2,
+    'bilibili': 2,
+    'social': 2,
+    'anime': 1,
+    'movie': 1,
+    'drama': 1,
+    'unknown': 2,
+}
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 10
+PRIORITY_LOW = 20
+
+# Bandwidth budget: BANDWIDTH_LIMIT bytes/s for the whole node (0 for none) and
+# optional caps per detect_website category, e.g. VD_CATEGORY_BANDWIDTH=anime=4000000.
+# Running downloads share them weighted max-min fairly: sessions (users) get equal
+# shares, split between their jobs by priority weight, and what a job leaves
+# unused goes to the others. Shares are recomputed as jobs start and finish.
+# A yt-dlp subprocess cannot change its rate, so its share is pinned and the
+# others share what is left, never less than BANDWIDTH_MIN_RATE each.
+BANDWIDTH_LIMIT = int(os.environ.get('VD_BANDWIDTH_LIMIT', '0'))
+CATEGORY_BANDWIDTH = {
+    category: int(rate)
+    for category, rate in (item.split('=', 1) for item in os.environ.get('VD_CATEGORY_BANDWIDTH', '').split(',') if item)
+}
+PRIORITY_WEIGHTS = {PRIORITY_HIGH: 2.0, PRIORITY_NORMAL: 1.0, PRIORITY_LOW: 0.5}
+BANDWIDTH_REBALANCE_INTERVAL = 1.0
+BANDWIDTH_MIN_RATE = 64 * 1024
+
+# Resumable jobs: unfinished downloads are recorded in a SQLite job store next
+# to the spool ('' disables it), so a restarted process resumes them from their
+# partial files. Transient failures are retried up to RETRY_ATTEMPTS times with
+# exponential backoff and jitter per host, keeping what was already downloaded.
+# Rows belong to the process that runs them and are only resumed once it is gone.
+JOB_DB = os.environ.get('VD_JOB_DB', os.path.join(SPOOL_DIR, 'jobs.sqlite'))
+JOB_CHECKPOINT_INTERVAL = 5.0
+JOB_HEARTBEAT = 10.0
+RETRY_ATTEMPTS = int(os.environ.get('VD_RETRY_ATTEMPTS', '4'))
+RETRY_BASE = float(os.environ.get('VD_RETRY_BASE', '5'))
+RETRY_MAX = 300
+RETRYABLE_ERRORS = re.compile(
+    r'timed? ?out|connection (?:reset|refused|aborted)|remote end closed|incompleteread|'
+    r'temporary failure in name resolution|network is unreachable|http error (?:429|5\d\d)|'
+    r'giving up after|did not get any data|unable to download video data', re.IGNORECASE)
+PARTIAL_FILE = re.compile(r'\.part(?:-Frag\d+)?$|\.ytdl$')
+
+# Multi-node mode: with QUEUE_URL set, front ends (app.py, app_gradio.py) only
+# submit jobs and headless workers (worker.py) run them. Jobs are sharded by
+# video ID and every shard is owned by one live worker (rendezvous hashing), so
+# repeat requests for a video land on the node whose caches hold it; a job
+# waiting longer than QUEUE_STEAL_AFTER is taken by any idle worker. Finished
+# files are published to SHARED_DIR, storage that every node mounts.
+QUEUE_URL = os.environ.get('VD_QUEUE_URL', '')  # sqlite:///path/queue.sqlite or redis://host:6379/0
+SHARED_DIR = os.environ.get('VD_SHARED_DIR', os.path.join(tempfile.gettempdir(), 'vd-shared'))
+SHARED_MAX_AGE = int(os.environ.get('VD_SHARED_MAX_AGE', str(6 * 3600)))
+QUEUE_SHARDS = 64
+QUEUE_STEAL_AFTER = float(os.environ.get('VD_QUEUE_STEAL_AFTER', '30'))
+QUEUE_POLL_INTERVAL = 0.5
+WORKER_HEARTBEAT = 5.0
+WORKER_TTL = 20.0  # a worker silent this long is dead and its jobs are requeued
+QUEUE_ERROR_BACKOFF = 30.0  # longest wait between attempts while the queue backend fails
+
+# Progress reporting: events are coalesced to at most one per
+# PROGRESS_INTERVAL seconds and only the last LOG_LINES lines are kept
+PROGRESS_INTERVAL = float(os.environ.get('VD_PROGRESS_INTERVAL', '0.5'))
+LOG_LINES = 200
+PROGRESS_PREFIX = '[progress]'
+PROGRESS_TEMPLATE = PROGRESS_PREFIX + ' ' + ' '.join(f'%(progress.{field})s' for field in (
+    'status', 'downloaded_bytes', 'total_bytes', 'total_bytes_estimate',
+    'speed', 'eta', 'fragment_index', 'fragment_count'))
+
+# yt-dlp log prefixes that start a new job phase
+PHASE_PREFIXES = {
+    '[download]': 'download',
+    '[Merger]': 'merge',
+    '[EmbedSubtitle]': 'embed_subs',
+    '[EmbedThumbnail]': 'embed_thumbnail',
+    '[ThumbnailsConvertor]': 'embed_thumbnail',
+    '[VideoRemuxer]': 'remux',
+    '[VideoConvertor]': 'remux',
+    '[ExtractAudio]': 'audio_convert',
+    '[Fixup': 'fixup',
+    '[Postprocess]': 'postprocess',
+}
+
+# Observability: one JSON object per log line, and Prometheus metrics
+# (phase timings, bytes, errors by site category) on /metrics (see METRICS_PORT)
+LOG_LEVEL = os.environ.get('VD_LOG_LEVEL', 'INFO').upper()
+METRIC_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+# Query parameters that never change what gets downloaded
+TRACKING_PARAMS = {'list', 'index', 'pp', 'si', 'feature', 'fbclid', 'gclid', 't'}
+
+
+def url_host(url):
+    """Get the lowercase hostname of a URL (scheme optional)"""
+    url = url.strip()
+    if '://' not in url:
+        url = '//' + url
+    try:
+        return (urlsplit(url).hostname or '').rstrip('.')
+    except ValueError:
+        return ''
+
+
+def _split_site_pattern(pattern):
+    """Split a SITES pattern into exact domains (youtube\\.com) and hostname keywords (gogoanime)"""
+    domains, keywords = [], []
+    for piece in pattern.split('|'):
+        if '\\.' in piece and re.fullmatch(r'(?:[\w-]|\\\.)+', piece):
+            domains.append(piece.replace('\\.', '.').lower())
+        else:
+            keywords.append(piece)
+    return domains, keywords
+
+
+class SiteMatcher:
+    """Hostname-indexed site lookup
+
+    Domains are resolved with a suffix walk over a dict (one lookup per host
+    label, independent of the number of rules); keyword rules are combined
+    into one compiled alternation that only ever sees the hostname. When
+    several rules match a host, the earliest one wins, as with the original
+    linear scan.
+    """
+
+    def __init__(self, sites=SITES, video_hosts=VIDEO_HOSTS, video_host_referers=VIDEO_HOST_REFERERS, extra=None):
+        self._domains = {}
+        self._keyword_rules = []
+        keyword_patterns = []
+        
+        rules = [(category, name, referer, *_split_site_pattern(pattern))
+                 for category, entries in sites.items() for pattern, name, referer in entries]
+        for category, entries in ((extra or {}).get('sites') or {}).items():
+            for entry in entries:
+                rules.append((category, entry['name'], entry.get('referer', ''),
+                              [d.lower() for d in entry.get('domains', [])],
+                              [re.escape(k) for k in entry.get('keywords', [])]))
+        
+        for rank, (category, name, referer, domains, keywords) in enumerate(rules):
+            site = {'category': category, 'name': name, 'referer': referer}
+            for domain in domains:
+                self._domains.setdefault(domain, (rank, site))
+            if keywords:
+                pattern = '|'.join(f'(?:{keyword})' for keyword in keywords)
+                keyword_patterns.append(pattern)
+                self._keyword_rules.append((rank, re.compile(pattern, re.IGNORECASE), site))
+        # One search rules out most hosts; only on a hit are the rules tried in order
+        self._keyword_re = re.compile('|'.join(keyword_patterns), re.IGNORECASE) if keyword_patterns else None
+        
+        hosts = dict.fromkeys(video_hosts, DEFAULT_VIDEO_HOST_REFERER)
+        hosts.update(video_host_referers)
+        hosts.update((extra or {}).get('video_hosts') or {})
+        self._video_host_referers = {host.lower(): referer for host, referer in hosts.items()}
+        self._video_host_re = re.compile('|'.join(re.escape(host) for host in self._video_host_referers))
+        # Hosts with their own referer take priority in the order given (kwik > gogocdn > fembed)
+        self._referer_hosts = [host.lower() for host in (*video_host_referers, *((extra or {}).get('video_hosts') or {}))]
+
+    def match_host(self, host):
+        """Find the site of a hostname"""
+        labels = host.lower().split('.')
+        best = None
+        for i in range(len(labels) - 1):
+            found = self._domains.get('.'.join(labels[i:]))
+            if found and (best is None or found[0] < best[0]):
+                best = found
+        if self._keyword_re and self._keyword_re.search(host):
+            for rank, pattern, site in self._keyword_rules:
+                if best is not None and rank > best[0]:
+                    break
+                if pattern.search(host):
+                    return site
+        return best[1] if best else None
+
+    def detect(self, url):
+        """Detect website category and return info"""
+        site = self.match_host(url_host(url))
+        if site:
+            return dict(site)
+        return {'category': 'unknown', 'name': 'Unknown', 'referer': ''}
+
+    def video_host_referer(self, url):
+        """Get appropriate referer for video hosts"""
+        host = url_host(url)
+        match = self._video_host_re.search(host)
+        if not match:
+            return None
+        for referer_host in self._referer_hosts:
+            if referer_host in host:
+                return self._video_host_referers[referer_host]
+        return self._video_host_referers[match.group(0)]
+
+
+_site_matcher = None
+
+
+def get_site_matcher():
+    """Get the compiled site matcher, built on first use"""
+    global _site_matcher
+    if _site_matcher is None:
+        extra = None
+        if SITES_FILE:
+            with open(SITES_FILE) as f:
+                extra = json.load(f)
+        _site_matcher = SiteMatcher(extra=extra)
+    return _site_matcher
+
+
+def reload_sites():
+    """Rebuild the site matcher, e.g. after editing SITES or VD_SITES_FILE"""
+    global _site_matcher
+    _site_matcher = None
+    return get_site_matcher()
+
 
 def detect_website(url):
     """Detect website category and return info"""
-    for category, sites in SITES.items():
-        for pattern, name, referer in sites:
-            if re.search(pattern, url, re.IGNORECASE):
-                return {'category': category, 'name': name, 'referer': referer}
-    return {'category': 'unknown', 'name': 'Unknown', 'referer': ''}
+    return get_site_matcher().detect(url)
 
 
 def get_video_host_referer(url):
     """Get appropriate referer for video hosts"""
-    for host in VIDEO_HOSTS:
-        if host in url.lower():
-            if 'kwik' in url.lower():
-                return 'https://animepahe.ru/'
-            elif 'gogocdn' in url.lower():
-                return 'https://gogoanimehd.to/'
-            elif 'fembed' in url.lower():
-                return 'https://dramacool.pa/'
-            return 'https://9animetv.to/'
-    return None
+    return get_site_matcher().video_host_referer(url)
 
 
+@functools.lru_cache(maxsize=None)
 def get_executable_path(name):
-    """Get path to executable, checking local dirs first"""
+    """Get path to executable, checking local dirs first (memoized until refresh_capabilities)"""
     # Windows extension check
     is_windows = sys.platform.startswith('win')
     ext = ".exe" if is_windows else ""
@@ -92,184 +510,5219 @@ def get_executable_path(name):
     return name
 
 
-def check_dependencies():
-    """Check if yt-dlp and ffmpeg are available"""
-    yt_dlp_path = get_executable_path('yt-dlp')
-    ffmpeg_path = get_executable_path('ffmpeg')
-    
+def _run_probe(cmd):
+    """Run a short probe command, returns its stdout or None if it cannot run"""
     try:
-        # Use --version for yt-dlp
-        result = subprocess.run([yt_dlp_path, '--version'], capture_output=True, text=True)
-        ytdlp_version = result.stdout.strip()
-    except:
-        ytdlp_version = None
+        result = subprocess.run(cmd, capture_output=True, text=True, timeout=15)
+    except (OSError, subprocess.TimeoutExpired):
+        return None
+    return result.stdout if result.returncode == 0 else None
+
+
+def _probe_ytdlp_version(yt_dlp_path):
+    if yt_dlp_path == 'yt-dlp':
+        # Installed package: read its metadata instead of starting an interpreter
+        import importlib.metadata
+        try:
+            return importlib.metadata.version('yt-dlp')
+        except importlib.metadata.PackageNotFoundError:
+            pass
+    output = _run_probe([yt_dlp_path, '--version'])
+    return output.strip() if output else None
+
+
+def _probe_ffmpeg_list(ffmpeg_path, option):
+    """Get the names listed by `ffmpeg -encoders` / `-muxers` / `-hwaccels`"""
+    output = _run_probe([ffmpeg_path, '-hide_banner', option]) or ''
+    names = []
+    if option == '-hwaccels':
+        return [line.strip() for line in output.splitlines()[1:] if line.strip()]
+    # Rows look like " V....D libx264   description" or " E mp4   MP4 (MPEG-4 Part 14)"
+    in_table = False
+    for line in output.splitlines():
+        if line.strip().startswith('--'):
+            in_table = True
+            continue
+        parts = line.split()
+        if in_table and len(parts) >= 2:
+            names.extend(parts[1].split(','))
+    return names
+
+
+def probe_capabilities():
+    """Probe yt-dlp and ffmpeg: versions, executable paths, encoders, muxers and hwaccels"""
+    get_executable_path.cache_clear()
+    paths = {name: get_executable_path(name) for name in ('yt-dlp', 'ffmpeg', 'ffprobe', 'aria2c')}
+    for name, path in paths.items():
+        if path == name:
+            paths[name] = shutil.which(name) or (name if name == 'yt-dlp' else None)
     
-    try:
-        # Check ffmpeg
-        if ffmpeg_path != 'ffmpeg':
-            # If we found a local ffmpeg, it's definitely available
-            ffmpeg_available = True
-        else:
-            result = subprocess.run(['ffmpeg', '-version'], capture_output=True, text=True)
-            ffmpeg_available = True
-    except:
-        ffmpeg_available = False
+    ffmpeg_path = paths['ffmpeg']
+    ffmpeg_version = None
+    if ffmpeg_path:
+        output = _run_probe([ffmpeg_path, '-hide_banner', '-version'])
+        if output:
+            match = re.match(r'ffmpeg version (\S+)', output)
+            ffmpeg_version = match.group(1) if match else output.splitlines()[0]
     
-    return ytdlp_version, ffmpeg_available
+    return {
+        'ytdlp_version': _probe_ytdlp_version(get_executable_path('yt-dlp')),
+        'ffmpeg_version': ffmpeg_version,
+        'encoders': _probe_ffmpeg_list(ffmpeg_path, '-encoders') if ffmpeg_version else [],
+        'muxers': _probe_ffmpeg_list(ffmpeg_path, '-muxers') if ffmpeg_version else [],
+        'hwaccels': _probe_ffmpeg_list(ffmpeg_path, '-hwaccels') if ffmpeg_version else [],
+        'paths': paths,
+        'engine': 'pool' if use_engine_pool() else 'subprocess',
+        'probed_at': time.time(),
+    }
 
 
-def get_video_info(url):
-    """Get video metadata using yt-dlp"""
-    yt_dlp_path = get_executable_path('yt-dlp')
+_capabilities = None
+_capabilities_lock = threading.Lock()
+
+
+def get_capabilities(refresh=False):
+    """Get the process-wide capability registry, probing on first use"""
+    global _capabilities
+    with _capabilities_lock:
+        if _capabilities is None or refresh:
+            _capabilities = probe_capabilities()
+        return _capabilities
+
+
+def refresh_capabilities():
+    """Re-probe executables, e.g. after installing ffmpeg"""
+    return get_capabilities(refresh=True)
+
+
+def check_dependencies():
+    """Check if yt-dlp and ffmpeg are available"""
+    capabilities = get_capabilities()
+    return capabilities['ytdlp_version'], capabilities['ffmpeg_version'] is not None
+
+
+class EngineError(Exception):
+    """Raised when an engine worker process dies or cannot be reached"""
+
+
+class _EngineLogger:
+    """yt-dlp logger that forwards every message line to the parent process"""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+
+    def send(self, kind, payload):
+        with self.lock:
+            self.conn.send((kind, payload))
+
+    def _send(self, message):
+        self.send('log', f"{message}\n")
+
+    def debug(self, message):
+        self._send(message)
+
+    def info(self, message):
+        self._send(message)
+
+    def warning(self, message):
+        if not message.startswith('WARNING:'):
+            message = f"WARNING: {message}"
+        self._send(message)
+
+    def error(self, message):
+        self._send(message)
+
+
+def _engine_info(conn, args, url):
+    """Worker task: extract the full info dict (same content as --dump-json)"""
+    import yt_dlp
+    # The CLI defaults to ignoring errors, which would turn failures into a None result
+    ydl_opts = dict(yt_dlp.parse_options(args).ydl_opts, quiet=True, ignoreerrors=False, logger=_EngineLogger(conn))
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False)
+        return ydl.sanitize_info(info)
+
+
+def _engine_download(conn, args):
+    """Worker task: run a download from a yt-dlp argument list, return the exit code"""
+    import yt_dlp
+    parsed = yt_dlp.parse_options(args)
+    ydl_opts = dict(parsed.ydl_opts, logger=_EngineLogger(conn))
     try:
-        cmd = [yt_dlp_path, '--dump-json', '--no-playlist', '--force-ipv4', '--no-check-certificates', url]
-        if yt_dlp_path == 'yt-dlp':
-            cmd = [sys.executable, '-m', 'yt_dlp', '--dump-json', '--no-playlist', '--force-ipv4', '--no-check-certificates', url]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True, timeout=60)
-        
-        if result.returncode != 0:
-            return None, result.stderr
-        
-        info = json.loads(result.stdout)
-        
+        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+            if parsed.options.load_info_filename:
+                return ydl.download_with_info_file(parsed.options.load_info_filename)
+            return ydl.download(parsed.urls)
+    except yt_dlp.utils.DownloadError:
+        # The error itself has already been forwarded through the logger
+        return 1
+
+
+def _engine_entries(conn, args, url, limit):
+    """Worker task: stream playlist entries to the parent as they are discovered"""
+    import yt_dlp
+    logger = _EngineLogger(conn)
+    ydl_opts = dict(yt_dlp.parse_options(args).ydl_opts, quiet=True, ignoreerrors=False, logger=logger)
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
+        info = ydl.extract_info(url, download=False, process=False)
+        entries = info.get('entries') if info.get('_type') in ('playlist', 'multi_video') else [info]
+        count = 0
+        for entry in entries or []:
+            if (limit and count >= limit) or _engine_stop.is_set():
+                break
+            count += 1
+            logger.send('item', playlist_entry(ydl.sanitize_info(entry), count))
+        return count
+
+
+def _engine_fetch(conn, url, path, http_headers, timeout):
+    """Worker task: fetch a small file (subtitle, thumbnail) into path, returns its content type"""
+    return _fetch_url(url, path, http_headers, timeout, logger=_EngineLogger(conn))
+
+
+_ENGINE_TASKS = {
+    'info': _engine_info,
+    'download': _engine_download,
+    'entries': _engine_entries,
+    'fetch': _engine_fetch,
+}
+
+
+def _engine_warm_up():
+    """Import yt-dlp, its extractor registry and the extractors of the SITES categories so the first task starts hot"""
+    import yt_dlp
+    from yt_dlp.extractor import gen_extractor_classes
+    list(gen_extractor_classes())
+    ydl = yt_dlp.YoutubeDL({'quiet': True})
+    for key in sorted({key for category in SITES for key in WARM_EXTRACTORS.get(category, ())}):
+        try:
+            # Instantiating a lazy extractor imports its real module
+            ydl.get_info_extractor(key)
+        except Exception:
+            pass
+    ydl.close()
+
+
+class DNSCache:
+    """TTL cache in front of socket.getaddrinfo
+
+    Failed lookups are not cached. The OS resolver does not expose record
+    TTLs, so every answer lives for the same ttl.
+    """
+
+    def __init__(self, ttl=DNS_CACHE_TTL, max_entries=DNS_CACHE_SIZE, resolve=socket.getaddrinfo):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._resolve = resolve
+        self._entries = OrderedDict()  # getaddrinfo arguments -> (expires, result)
+        self._lock = threading.Lock()
+        self.lookups = 0
+        self.hits = 0
+        self.resolve_seconds = 0.0
+
+    def getaddrinfo(self, host, port, family=0, type=0, proto=0, flags=0):
+        key = (host, port, family, type, proto, flags)
+        with self._lock:
+            self.lookups += 1
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return list(entry[1])
+        started = time.perf_counter()
+        result = self._resolve(host, port, family, type, proto, flags)
+        with self._lock:
+            self.resolve_seconds += time.perf_counter() - started
+            self._entries[key] = (time.monotonic() + self.ttl, result)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return list(result)
+
+    def install(self):
+        """Route every lookup of this process through the cache"""
+        socket.getaddrinfo = self.getaddrinfo
+
+    def stats(self):
+        with self._lock:
+            misses = self.lookups - self.hits
+            return {
+                'lookups': self.lookups,
+                'hits': self.hits,
+                'resolve_seconds': self.resolve_seconds,
+                # Every hit saves an average resolve
+                'saved_seconds': self.hits * self.resolve_seconds / misses if misses else 0.0,
+            }
+
+
+class HTTPPoolStats:
+    """Requests, new connections and connect (TCP + TLS handshake) time per host"""
+
+    def __init__(self):
+        self._hosts = {}  # host -> [requests, connections, connect seconds]
+        self._lock = threading.Lock()
+
+    def request(self, host):
+        with self._lock:
+            self._hosts.setdefault(host, [0, 0, 0.0])[0] += 1
+
+    def connected(self, host, seconds):
+        with self._lock:
+            counts = self._hosts.setdefault(host, [0, 0, 0.0])
+            counts[1] += 1
+            counts[2] += seconds
+
+    def stats(self):
+        with self._lock:
+            hosts = {host: list(counts) for host, counts in self._hosts.items()}
+        requests = sum(counts[0] for counts in hosts.values())
+        connections = sum(counts[1] for counts in hosts.values())
+        # A reused connection saves the host's average connect time
+        saved = sum(max(counts[0] - counts[1], 0) * counts[2] / counts[1] for counts in hosts.values() if counts[1])
         return {
-            'title': info.get('title', 'Unknown'),
-            'thumbnail': info.get('thumbnail', ''),
-            'duration': info.get('duration_string', ''),
-            'uploader': info.get('uploader', ''),
-            'formats': ['1080p', '720p', '480p', 'Audio Only']
-        }, None
-    except Exception as e:
-        return None, str(e)
+            'requests': requests,
+            'connections': connections,
+            'connect_seconds': sum(counts[2] for counts in hosts.values()),
+            'saved_seconds': saved,
+            'hosts': {host: {'requests': counts[0], 'connections': counts[1]} for host, counts in hosts.items()},
+        }
 
 
-def download_video(url, quality, embed_subs=False, embed_thumb=False, audio_format='mp3', custom_filename=None, progress_callback=None):
-    """Download video using yt-dlp"""
-    yt_dlp_path = get_executable_path('yt-dlp')
-    ffmpeg_path = get_executable_path('ffmpeg')
-    
-    temp_dir = tempfile.mkdtemp()
+def _share_http_connections(pool_stats, per_host=HTTP_POOL_PER_HOST, hosts=HTTP_POOL_HOSTS):
+    """Make yt-dlp's requests handler keep its sessions (and their connection pools) across YoutubeDL instances
+
+    The sessions of an engine worker are keyed by their TLS and source
+    address settings; the cookie jar is swapped in per job, which is safe
+    because a worker runs one task at a time. Returns False when yt-dlp
+    uses its urllib handler, which opens a connection per request, or
+    when the private yt-dlp/urllib3 hooks this relies on have changed.
+    """
+    try:
+        import urllib3
+        from yt_dlp.networking._requests import RequestsRH
+        create_instance = RequestsRH._create_instance
+        RequestsRH._close_instance
+        make_request = urllib3.connectionpool.HTTPConnectionPool._make_request
+        connects = [connection_class.__dict__['connect']
+                    for connection_class in (urllib3.connection.HTTPConnection, urllib3.connection.HTTPSConnection)]
+        if 'cookiejar' not in inspect.signature(create_instance).parameters:
+            raise TypeError("RequestsRH._create_instance takes no cookiejar")
+    except (ImportError, AttributeError, KeyError, TypeError, ValueError) as e:
+        log_event('http_sharing_unavailable', logging.INFO, error=str(e))
+        return False
     
-    # Handle custom filename
-    if custom_filename:
-        # Sanitize filename
-        custom_filename = re.sub(r'[\\/*?:"<>|]', "", custom_filename)
-        output_template = f"{custom_filename}.%(ext)s"
-    else:
-        output_template = '%(title)s.%(ext)s'
-        
-    output_path = os.path.join(temp_dir, output_template)
+    sessions = {}
     
-    # Clean URL - remove list parameter to avoid playlist issues
-    url = re.sub(r'&list=[^&]*', '', url)
+    def shared_instance(self, cookiejar, *args, **kwargs):
+        try:
+            key = (repr(args), repr(sorted(kwargs.items())), self.verify, self.source_address,
+                   self.prefer_system_certs, repr(self._client_cert))
+        except AttributeError:
+            return create_instance(self, cookiejar, *args, **kwargs)
+        session = sessions.get(key)
+        if session is None:
+            session = sessions[key] = create_instance(self, cookiejar, *args, **kwargs)
+            adapter = session.get_adapter('https://')
+            # Keep up to per_host idle connections per host; extra concurrent ones are closed after use
+            adapter.init_poolmanager(hosts, per_host)
+        session.cookies = cookiejar
+        return session
     
-    # Validate YouTube URL
-    youtube_match = re.search(r'v=([\w-]{11})', url)
-    if youtube_match:
-        video_id = youtube_match.group(1)
-        if len(video_id) < 11:
-            return None, f"Invalid YouTube ID: '{video_id}' (length: {len(video_id)}). YouTube IDs must be 11 characters long."
+    def close_instance(self, instance):
+        pass  # the session outlives the YoutubeDL that created it
     
-    # Build quality format
-    if '4K' in quality:
-        fmt = 'bestvideo[height<=2160]+bestaudio/best[height<=2160]'
-    elif '2K' in quality:
-        fmt = 'bestvideo[height<=1440]+bestaudio/best[height<=1440]'
-    elif quality == '1080p':
-        fmt = 'bestvideo[height<=1080]+bestaudio/best[height<=1080]'
-    elif quality == '720p':
-        fmt = 'bestvideo[height<=720]+bestaudio/best[height<=720]'
-    elif quality == '480p':
-        fmt = 'bestvideo[height<=480]+bestaudio/best[height<=480]'
-    elif quality == 'Audio Only':
-        fmt = 'bestaudio/best'
-    else:
-        fmt = 'bestvideo+bestaudio/best'
+    RequestsRH._create_instance = shared_instance
+    RequestsRH._close_instance = close_instance
     
-    # Build command
-    cmd = []
+    def counted_request(pool, *args, **kwargs):
+        pool_stats.request(pool.host)
+        return make_request(pool, *args, **kwargs)
     
-    # Check if we should use python -m yt_dlp
-    if yt_dlp_path == 'yt-dlp':
-        cmd.extend([sys.executable, '-m', 'yt_dlp'])
-    else:
-        cmd.append(yt_dlp_path)
+    urllib3.connectionpool.HTTPConnectionPool._make_request = counted_request
+    for connection_class, connect in zip((urllib3.connection.HTTPConnection, urllib3.connection.HTTPSConnection), connects):
         
-    cmd.extend([
-        '-f', fmt,
-        '-o', output_path,
-        '--merge-output-format', 'mp4',
-        '--no-playlist',
-        '--force-ipv4',  # Force IPv4 to avoid IPv6 DNS issues
-        '--no-check-certificates', # Avoid SSL certificate issues
-        '--socket-timeout', '30',
-        '--extractor-args', 'generic:impersonate',
-        '--user-agent', 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
-    ])
-    
-    # Force mp4 extension for video downloads unless custom filename is used
-    if not custom_filename and quality != 'Audio Only':
-        cmd.extend(['--remux-video', 'mp4'])
-    
-    # Add Subtitles
-    if embed_subs:
-        cmd.extend(['--embed-subs', '--sub-langs', 'all', '--write-subs'])
+        def timed_connect(connection, connect=connect):
+            started = time.perf_counter()
+            try:
+                return connect(connection)
+            finally:
+                pool_stats.connected(connection.host, time.perf_counter() - started)
         
-    # Add Thumbnail
-    if embed_thumb:
-        cmd.extend(['--embed-thumbnail'])
-    
-    # Check for cookies file
-    cookies_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cookies.txt')
-    if os.path.exists(cookies_path):
-        cmd.extend(['--cookies', cookies_path])
+        connection_class.connect = timed_connect
+    return True
+
+
+class TokenBucket:
+    """Blocking token bucket shared by the threads of a process; rate None lets everything through"""
+
+    def __init__(self, rate=None, burst_seconds=0.25):
+        self.burst_seconds = burst_seconds
+        self._lock = threading.Lock()
+        self.set_rate(rate)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = rate
+            self._burst = max(rate * self.burst_seconds, 64 * 1024) if rate else 0
+            self._tokens = self._burst
+            self._stamp = time.monotonic()
+
+    def consume(self, amount):
+        """Take amount tokens, sleeping while the bucket is in debt"""
+        if not self.rate:
+            return
+        with self._lock:
+            if not self.rate:
+                return
+            now = time.monotonic()
+            self._tokens = min(self._burst, self._tokens + (now - self._stamp) * self.rate) - amount
+            self._stamp = now
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+def _throttle_socket_reads(bucket):
+    """Charge every byte read from a (TLS) socket of this process to bucket"""
+    import ssl
+    for socket_class in (socket.socket, ssl.SSLSocket):
+        recv, recv_into = socket_class.recv, socket_class.recv_into
+        
+        def throttled_recv(sock, *args, recv=recv):
+            data = recv(sock, *args)
+            bucket.consume(len(data))
+            return data
+        
+        def throttled_recv_into(sock, *args, recv_into=recv_into):
+            count = recv_into(sock, *args)
+            bucket.consume(count)
+            return count
+        
+        socket_class.recv = throttled_recv
+        socket_class.recv_into = throttled_recv_into
+
+
+_dns_cache = None
+_http_pool_stats = None
+_bandwidth_bucket = None
+_engine_stop = threading.Event()  # set by a ('stop', None) control message, for tasks that can end early
+
+
+def _engine_network_setup():
+    """Install the worker's DNS cache, shared HTTP connections and bandwidth limit"""
+    global _dns_cache, _http_pool_stats, _bandwidth_bucket
+    _bandwidth_bucket = TokenBucket()
+    _throttle_socket_reads(_bandwidth_bucket)
+    if DNS_CACHE_TTL > 0:
+        _dns_cache = DNSCache()
+        _dns_cache.install()
+    _http_pool_stats = HTTPPoolStats()
+    try:
+        shared = _share_http_connections(_http_pool_stats)
+    except Exception as e:
+        # Never let the optional connection sharing take the worker down: keep the DNS cache only
+        log_event('http_sharing_failed', logging.WARNING, error=str(e))
+        shared = False
+    if not shared:
+        _http_pool_stats = None
+
+
+def _engine_network_stats():
+    return {
+        'dns': _dns_cache.stats() if _dns_cache else None,
+        'http': _http_pool_stats.stats() if _http_pool_stats else None,
+    }
+
+
+def _engine_control(message):
+    """Apply a control message the parent sent while a task runs"""
+    kind, value = message
+    if kind == 'bandwidth':
+        _bandwidth_bucket.set_rate(value)
+    elif kind == 'stop':
+        _engine_stop.set()
+
+
+def _engine_control_loop(conn, stop_fd):
+    """Receive control messages until stop_fd becomes readable at the end of the task"""
+    while True:
+        ready = multiprocessing.connection.wait([conn, stop_fd])
+        if stop_fd in ready:
+            return
+        try:
+            _engine_control(conn.recv()[1])
+        except (EOFError, OSError):
+            return
+
+
+def _engine_worker_main(conn):
+    """Worker process loop: warm up once, then serve tasks from the pipe"""
+    _engine_warm_up()
+    _engine_network_setup()
+    while True:
+        try:
+            task = conn.recv()
+        except (EOFError, KeyboardInterrupt):
+            break
+        if task is None:
+            break
+        kind, args = task[0], task[1:]
+        if kind == 'control':
+            # Sent just as the previous task ended
+            _engine_control(*args)
+            continue
+        
+        _bandwidth_bucket.set_rate(None)
+        _engine_stop.clear()
+        stop_read, stop_write = os.pipe()
+        listener = threading.Thread(target=_engine_control_loop, args=(conn, stop_read), daemon=True)
+        listener.start()
+        try:
+            result = ('done', _ENGINE_TASKS[kind](conn, *args))
+        except (Exception, SystemExit) as e:
+            result = ('error', str(e))
+        finally:
+            os.write(stop_write, b'x')
+            listener.join()
+            os.close(stop_read)
+            os.close(stop_write)
+        conn.send(('network', _engine_network_stats()))
+        conn.send(result)
+
+
+class EnginePool:
+    """Pool of long-lived worker processes that drive the yt_dlp.YoutubeDL API"""
+
+    def __init__(self, size=ENGINE_WORKERS):
+        self.size = max(1, size)
+        self._ctx = multiprocessing.get_context()
+        self._idle = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self._network = {}  # worker pid -> its latest network stats
+        self._retired_network = []
+
+    def start(self):
+        """Spawn and pre-warm all workers"""
+        for _ in range(self.size):
+            self._idle.put(self._spawn())
+        return self
+
+    def _spawn(self):
+        conn, child_conn = self._ctx.Pipe()
+        process = self._ctx.Process(target=_engine_worker_main, args=(child_conn,), daemon=True)
+        process.start()
+        child_conn.close()
+        worker = (process, conn)
+        with self._lock:
+            self._workers.append(worker)
+        return worker
+
+    def _retire(self, worker):
+        process, conn = worker
+        with self._lock:
+            if worker in self._workers:
+                self._workers.remove(worker)
+            if process.pid in self._network:
+                self._retired_network.append(self._network.pop(process.pid))
+        conn.close()
+        if process.is_alive():
+            process.kill()
+        process.join(timeout=5)
+
+    def call(self, task, on_line=None, timeout=None, on_item=None, on_control=None):
+        """Run a task on an idle worker, returning (result, error)
+
+        on_control(send) receives a function that delivers control messages
+        (like ('bandwidth', rate)) to the worker while this task runs; it
+        may be called from any thread and does nothing once the task ended.
+        """
+        if self._closed:
+            raise EngineError("Engine pool is closed")
+        worker = self._idle.get()
+        process, conn = worker
+        healthy = False
+        control_lock = threading.Lock()
+        running = [True]
+        
+        def send_control(message):
+            with control_lock:
+                if running[0]:
+                    conn.send(('control', message))
+        
+        try:
+            conn.send(task)
+            if on_control:
+                on_control(send_control)
+            deadline = time.monotonic() + timeout if timeout else None
+            while True:
+                remaining = None if deadline is None else max(0, deadline - time.monotonic())
+                if not conn.poll(remaining):
+                    return None, f"Timed out after {timeout} seconds"
+                try:
+                    kind, payload = conn.recv()
+                except (EOFError, OSError):
+                    raise EngineError(f"Engine worker exited with code {process.exitcode}")
+                if kind == 'log':
+                    if on_line:
+                        on_line(payload)
+                    continue
+                if kind == 'item':
+                    if on_item:
+                        on_item(payload)
+                    continue
+                if kind == 'network':
+                    with self._lock:
+                        self._network[process.pid] = payload
+                    continue
+                healthy = True
+                if kind == 'done':
+                    return payload, None
+                return None, payload
+        except (BrokenPipeError, OSError) as e:
+            raise EngineError(str(e))
+        finally:
+            with control_lock:
+                running[0] = False
+            # A worker that timed out or crashed mid-task is replaced, never reused
+            if healthy and not self._closed:
+                self._idle.put(worker)
+            else:
+                self._retire(worker)
+                if not self._closed:
+                    self._idle.put(self._spawn())
+
+    def network_stats(self):
+        """Sum the DNS cache and connection reuse counters of all workers, past and present"""
+        with self._lock:
+            reports = list(self._network.values()) + self._retired_network
+        dns = {'lookups': 0, 'hits': 0, 'resolve_seconds': 0.0, 'saved_seconds': 0.0}
+        http = {'requests': 0, 'connections': 0, 'connect_seconds': 0.0, 'saved_seconds': 0.0}
+        hosts = {}
+        for report in reports:
+            for totals, part in ((dns, report['dns']), (http, report['http'])):
+                for key in totals:
+                    totals[key] += (part or {}).get(key, 0)
+            for host, counts in ((report['http'] or {}).get('hosts') or {}).items():
+                host_totals = hosts.setdefault(host, {'requests': 0, 'connections': 0})
+                host_totals['requests'] += counts['requests']
+                host_totals['connections'] += counts['connections']
+        dns['hit_rate'] = dns['hits'] / dns['lookups'] if dns['lookups'] else 0.0
+        http['reused'] = max(http['requests'] - http['connections'], 0)
+        http['reuse_rate'] = http['reused'] / http['requests'] if http['requests'] else 0.0
+        http['hosts'] = hosts
+        return {'dns': dns, 'http': http}
+
+    def close(self):
+        """Stop all workers"""
+        self._closed = True
+        with self._lock:
+            workers = list(self._workers)
+        for process, conn in workers:
+            try:
+                conn.send(None)
+            except Exception:
+                pass
+        for worker in workers:
+            worker[0].join(timeout=2)
+            self._retire(worker)
+
+
+_engine_pool = None
+_engine_pool_lock = threading.Lock()
+
+
+def get_engine_pool():
+    """Get the process-wide engine pool, starting it on first use"""
+    global _engine_pool
+    with _engine_pool_lock:
+        if _engine_pool is None:
+            _engine_pool = EnginePool(ENGINE_WORKERS).start()
+            atexit.register(_engine_pool.close)
+        return _engine_pool
+
+
+def use_engine_pool():
+    """Check whether calls should go through the in-process engine pool"""
+    if ENGINE_MODE != 'pool':
+        return False
+    # A bundled yt-dlp executable takes precedence over the Python package
+    if get_executable_path('yt-dlp') != 'yt-dlp':
+        return False
+    return importlib.util.find_spec('yt_dlp') is not None
+
+
+_warm_up = None
+_warm_up_done = threading.Event()
+_warm_up_lock = threading.Lock()
+
+
+def warm_up(background=True):
+    """Warm the engine at startup instead of on the first request, once per process
+
+    The engine workers are forked right away, while the process is still
+    small and no UI framework is imported, and import yt-dlp and the SITES
+    extractors in parallel with the caller. Resolving executables, the
+    ffmpeg probe and the site matcher follow in a background thread (inline
+    with background=False). Returns the report of step timings, or None
+    with VD_WARM_UP=0.
+    """
+    global _warm_up
+    if not WARM_UP:
+        return None
+    with _warm_up_lock:
+        if _warm_up is not None:
+            return _warm_up
+        report = _warm_up = {'started_at': time.time(), 'steps': {}, 'seconds': None}
     
-    # Add ffmpeg location if needed
-    if ffmpeg_path != 'ffmpeg':
-        cmd.extend(['--ffmpeg-location', os.path.dirname(ffmpeg_path)])
+    def timed(step, func):
+        started = time.perf_counter()
+        try:
+            func()
+        except Exception as e:
+            log_event('warm_up_failed', logging.WARNING, step=step, error=str(e))
+        report['steps'][step] = round(time.perf_counter() - started, 4)
     
-    # Add audio-only options
-    if quality == 'Audio Only':
-        cmd.extend(['-x', '--audio-format', audio_format])
+    def finish():
+        timed('capabilities', get_capabilities)
+        timed('site_matcher', get_site_matcher)
+        report['seconds'] = round(time.time() - report['started_at'], 4)
+        _warm_up_done.set()
+        log_event('warm_up', steps=report['steps'], seconds=report['seconds'])
     
-    # Add smart headers for video hosts
-    referer = get_video_host_referer(url)
-    if referer:
-        cmd.extend(['--referer', referer])
-        cmd.extend(['--add-header', f'Origin: {referer.rstrip("/")}'])
+    if use_engine_pool():
+        timed('engine_pool', get_engine_pool)
+    if background:
+        threading.Thread(target=finish, name='warm-up', daemon=True).start()
+    else:
+        finish()
+    return report
+
+
+def _yt_dlp_command():
+    """Get the command prefix used to run yt-dlp as a subprocess"""
+    yt_dlp_path = get_executable_path('yt-dlp')
+    if yt_dlp_path == 'yt-dlp':
+        return [sys.executable, '-m', 'yt_dlp']
+    return [yt_dlp_path]
+
+
+def canonical_url(url):
+    """Normalize a URL so equivalent links share one cache entry"""
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or '').lower()
+    for prefix in ('www.', 'm.'):
+        if host.startswith(prefix):
+            host = host[len(prefix):]
     
-    # Add URL
-    cmd.append(url)
+    path = parts.path.rstrip('/') or '/'
+    query = [(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+             if k not in TRACKING_PARAMS and not k.startswith('utm_')]
     
-    print(f"Executing command: {' '.join(cmd)}")
+    # Short and shorts links point at the same YouTube watch page
+    video_id = url_video_id(url)
+    if video_id and video_id.startswith('Youtube:'):
+        host, path, query = 'youtube.com', '/watch', [('v', video_id.split(':', 1)[1])]
     
-    try:
-        process = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            text=True
-        )
-        
-        # Monitor progress
-        output_log = []
-        while True:
-            line = process.stdout.readline()
-            if not line and process.poll() is not None:
-                break
-            if line:
-                output_log.append(line)
-                if progress_callback:
-                    progress_callback(line)
-        
-        # Find downloaded file
-        files = list(Path(temp_dir).glob('*'))
-        if files:
-            return str(files[0]), None
-            
-        full_error = "".join(output_log)
-        return None, f"No file downloaded. Log: {full_error}"
-        
-    except Exception as e:
-        return None, str(e)
+    return urlunsplit(((parts.scheme or 'https').lower(), host, path, urlencode(sorted(query)), ''))
+
+
+def url_video_id(url):
+    """Get the extractor-qualified video ID when it can be read from the URL alone"""
+    match = re.search(r'(?:youtube\.com/(?:watch\?(?:.*&)?v=|shorts/|embed/|live/)|youtu\.be/)([\w-]{11})', url)
+    if match:
+        return f"Youtube:{match.group(1)}"
+    return None
+
+
+def info_video_id(info):
+    """Get the extractor-qualified video ID of an info dict"""
+    return f"{info.get('extractor_key', 'Generic')}:{info.get('id')}"
+
+
+def info_expiry(info):
+    """Get the earliest expiry timestamp of the signed format URLs in an info dict"""
+    expiry = None
+    for fmt in info.get('formats') or [info]:
+        for key in ('url', 'manifest_url', 'fragment_base_url'):
+            value = fmt.get(key)
+            if not value:
+                continue
+            for name, param in parse_qsl(urlsplit(value).query):
+                if name.lower() in ('expire', 'expires', 'exp') and param.isdigit() and int(param) > 1e9:
+                    expiry = int(param) if expiry is None else min(expiry, int(param))
+            # googlevideo also encodes the expiry as a path segment
+            match = re.search(r'/expire/(\d{10})', value)
+            if match:
+                expiry = int(match.group(1)) if expiry is None else min(expiry, int(match.group(1)))
+    return expiry
+
+
+class InfoCache:
+    """LRU cache of full yt-dlp info dicts keyed by canonical URL and video ID"""
+
+    def __init__(self, max_entries=INFO_CACHE_SIZE, ttl=INFO_CACHE_TTL, db_path=INFO_CACHE_DB):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # video ID -> (info, expires_at)
+        self._aliases = {}  # canonical URL -> video ID
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self._db = None
+        if db_path:
+            self._db = sqlite3.connect(db_path, check_same_thread=False)
+            self._db.executescript("""
+                CREATE TABLE IF NOT EXISTS info_cache (
+                    video_id TEXT PRIMARY KEY, info TEXT, expires_at REAL, accessed_at REAL);
+                CREATE TABLE IF NOT EXISTS info_alias (url TEXT PRIMARY KEY, video_id TEXT);
+            """)
+
+    def _key(self, url):
+        canonical = canonical_url(url)
+        return self._aliases.get(canonical) or url_video_id(url) or canonical
+
+    def get(self, url):
+        """Get a fresh cached info dict for a URL, or None"""
+        with self._lock:
+            key = self._key(url)
+            entry = self._entries.get(key)
+            if entry is None and self._db:
+                entry = self._db_load(url, key)
+            if entry is None:
+                self.misses += 1
+                return None
+            info, expires_at = entry
+            if time.time() >= expires_at:
+                # Format URLs are about to expire, force a fresh extraction
+                self.expired += 1
+                self.misses += 1
+                self.invalidate(url)
+                return None
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return info
+
+    def put(self, url, info):
+        """Store an info dict under its URL and video ID"""
+        key = info_video_id(info)
+        expires_at = time.time() + self.ttl
+        url_expiry = info_expiry(info)
+        if url_expiry:
+            expires_at = min(expires_at, url_expiry - INFO_EXPIRY_MARGIN)
+        with self._lock:
+            self._aliases[canonical_url(url)] = key
+            if info.get('webpage_url'):
+                self._aliases[canonical_url(info['webpage_url'])] = key
+            self._entries[key] = (info, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                old_key, _ = self._entries.popitem(last=False)
+                self._aliases = {u: k for u, k in self._aliases.items() if k != old_key}
+            if self._db:
+                self._db_store(key, info, expires_at)
+
+    def invalidate(self, url):
+        """Drop the cached entry for a URL"""
+        with self._lock:
+            key = self._key(url)
+            self._entries.pop(key, None)
+            self._aliases = {u: k for u, k in self._aliases.items() if k != key}
+            if self._db:
+                with self._db:
+                    self._db.execute("DELETE FROM info_cache WHERE video_id = ?", (key,))
+                    self._db.execute("DELETE FROM info_alias WHERE video_id = ?", (key,))
+
+    def _db_load(self, url, key):
+        row = self._db.execute(
+            "SELECT i.video_id, i.info, i.expires_at FROM info_cache i "
+            "LEFT JOIN info_alias a ON a.video_id = i.video_id "
+            "WHERE i.video_id = ? OR a.url = ? LIMIT 1", (key, canonical_url(url))).fetchone()
+        if not row:
+            return None
+        key, info, expires_at = row[0], json.loads(row[1]), row[2]
+        self._aliases[canonical_url(url)] = key
+        with self._db:
+            self._db.execute("UPDATE info_cache SET accessed_at = ? WHERE video_id = ?", (time.time(), key))
+        return info, expires_at
+
+    def _db_store(self, key, info, expires_at):
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO info_cache VALUES (?, ?, ?, ?)",
+                             (key, json.dumps(info), expires_at, time.time()))
+            self._db.executemany("INSERT OR REPLACE INTO info_alias VALUES (?, ?)",
+                                 [(u, k) for u, k in self._aliases.items() if k == key])
+            # Evict least recently used rows beyond the size limit
+            self._db.execute(
+                "DELETE FROM info_cache WHERE video_id NOT IN "
+                "(SELECT video_id FROM info_cache ORDER BY accessed_at DESC LIMIT ?)", (self.max_entries,))
+            self._db.execute("DELETE FROM info_alias WHERE video_id NOT IN (SELECT video_id FROM info_cache)")
+
+    def stats(self):
+        """Get hit/miss counters"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'entries': len(self._entries),
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+info_cache = InfoCache()
+
+
+class FileCache:
+    """Content-addressed disk cache of finished downloads with a byte budget"""
+
+    def __init__(self, root=FILE_CACHE_DIR, max_bytes=FILE_CACHE_BYTES, policy=FILE_CACHE_POLICY):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._index = None  # key -> metadata, loaded lazily from disk
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    @staticmethod
+    def key(video_id, fmt, options):
+        """Build the cache key of a (video ID, format spec, postprocessing options) triple"""
+        payload = json.dumps([video_id, fmt, options], sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()
+
+    def _load_index(self):
+        if self._index is not None:
+            return self._index
+        self._index = {}
+        os.makedirs(self.root, exist_ok=True)
+        for entry in os.scandir(self.root):
+            if entry.name.startswith('.'):
+                # Unfinished publish from a crashed process
+                shutil.rmtree(entry.path, ignore_errors=True)
+                continue
+            try:
+                with open(os.path.join(entry.path, 'meta.json')) as f:
+                    self._index[entry.name] = json.load(f)
+            except (OSError, ValueError):
+                shutil.rmtree(entry.path, ignore_errors=True)
+        return self._index
+
+    def _write_meta(self, key, meta):
+        meta_path = os.path.join(self.root, key, 'meta.json')
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump(meta, f)
+        os.replace(meta_path + '.tmp', meta_path)
+
+    def get(self, key, dest_dir, filename=None):
+        """Place a cached file into dest_dir, returns its path or None on a miss"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            meta = self._load_index().get(key)
+            source = meta and os.path.join(self.root, key, meta['name'])
+            if not meta or not os.path.exists(source):
+                self.misses += 1
+                return None
+            meta['hits'] += 1
+            meta['accessed'] = time.time()
+            self._write_meta(key, meta)
+            self.hits += 1
+        
+        name = meta['name']
+        if filename:
+            name = filename + os.path.splitext(name)[1]
+        dest = os.path.join(dest_dir, name)
+        _link_or_copy(source, dest)
+        return dest
+
+    def put(self, key, path):
+        """Atomically publish a finished file into the cache"""
+        if not self.enabled or PARTIAL_FILE.search(os.path.basename(path)):
+            # Never cache an unfinished download (.part, .ytdl, ...)
+            return False
+        size = os.path.getsize(path)
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            index = self._load_index()
+            if key in index:
+                return True
+            
+            # Build the entry in a hidden directory, then rename it into place
+            staging = tempfile.mkdtemp(prefix=f'.{key[:16]}-', dir=self.root)
+            name = os.path.basename(path)
+            _link_or_copy(path, os.path.join(staging, name))
+            now = time.time()
+            meta = {'name': name, 'size': size, 'hits': 0, 'created': now, 'accessed': now}
+            with open(os.path.join(staging, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+            try:
+                os.rename(staging, os.path.join(self.root, key))
+            except OSError:
+                shutil.rmtree(staging, ignore_errors=True)
+                return False
+            index[key] = meta
+            self._evict(keep=key)
+        return True
+
+    def _evict(self, keep=None):
+        """Evict down to max_bytes; keep is the entry just added, which LFU would otherwise pick first (no hits yet)"""
+        index = self._index
+        total = sum(meta['size'] for meta in index.values())
+        if self.policy == 'lfu':
+            order = sorted(index, key=lambda k: (index[k]['hits'], index[k]['accessed']))
+        else:
+            order = sorted(index, key=lambda k: index[k]['accessed'])
+        for key in order:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= index.pop(key)['size']
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+            self.evictions += 1
+
+    def stats(self):
+        """Get hit/miss counters and disk usage"""
+        with self._lock:
+            index = self._load_index() if self.enabled else {}
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(index),
+                'bytes': sum(meta['size'] for meta in index.values()),
+                'max_bytes': self.max_bytes,
+            }
+
+
+def _link_or_copy(source, dest):
+    """Hard-link a file, copying only when linking is not possible"""
+    try:
+        os.link(source, dest)
+    except OSError:
+        shutil.copy2(source, dest)
+
+
+file_cache = FileCache()
+
+
+class SpoolFullError(Exception):
+    """Raised when a download does not fit into the spool's quota or free disk space"""
+
+
+class SpoolBusyError(SpoolFullError):
+    """Raised when no room freed up for a download within the admission timeout"""
+
+
+def process_owner():
+    """Identify this process to other processes sharing the spool or job store, as 'host:pid'"""
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def owner_alive(owner, heartbeat=None, ttl=OWNER_TTL):
+    """Check whether the process an owner tag names may still be running
+
+    A process of this host must exist (by PID), and any owner must have
+    heartbeated (heartbeat is a timestamp) within ttl seconds.
+    """
+    host, _, pid = (owner or '').rpartition(':')
+    if not host or not pid.isdigit():
+        return False
+    if host == socket.gethostname() and not sys.platform.startswith('win'):
+        try:
+            os.kill(int(pid), 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+    return heartbeat is not None and time.time() - heartbeat < ttl
+
+
+def _dir_size(path):
+    total = 0
+    for dirpath, _, filenames in os.walk(path):
+        for name in filenames:
+            try:
+                total += os.path.getsize(os.path.join(dirpath, name))
+            except OSError:
+                pass
+    return total
+
+
+class Spool:
+    """Per-job download directories under one root, kept within a byte quota
+
+    A job is 'active' while yt-dlp writes into it, 'paused' while its
+    partial files wait for a retry and 'done' once its file has been
+    handed over. Active jobs reserve their expected size at admission so
+    concurrent downloads cannot overrun the disk together.
+    """
+
+    def __init__(self, root=SPOOL_DIR, max_bytes=SPOOL_BYTES, max_age=SPOOL_MAX_AGE, min_free=SPOOL_MIN_FREE):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.min_free = min_free
+        self.owner = None  # set on first use, so nothing touches the disk at import
+        self._cond = threading.Condition()
+        self._jobs = {}  # job directory -> {'state', 'created', 'finished', 'reserved'}
+        self._janitor = None
+        self.evictions = 0
+        self.refused = 0
+
+    def _setup(self):
+        """Create the root, register this process as an owner and adopt orphaned job directories"""
+        with self._cond:
+            if self.owner == process_owner():
+                return
+            self.owner = process_owner()
+            os.makedirs(os.path.join(self.root, '.owners'), exist_ok=True)
+            self._heartbeat()
+            self._adopt_orphans()
+        self.start_janitor()
+
+    def _owner_file(self, owner):
+        return os.path.join(self.root, '.owners', owner.replace(':', '-'))
+
+    def _heartbeat(self):
+        Path(self._owner_file(self.owner)).touch()
+
+    def _owner_of(self, path):
+        try:
+            with open(path + '.owner') as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
+    def _claim(self, path):
+        """Record this process as the owner of a job directory"""
+        partial = f"{path}.owner.{secrets.token_hex(4)}.tmp"
+        with open(partial, 'w') as f:
+            f.write(self.owner)
+        os.replace(partial, path + '.owner')
+
+    def _orphaned(self, path, mtime):
+        owner = self._owner_of(path)
+        if owner is None:
+            # Left by an older version, or just created and not claimed yet
+            return time.time() - mtime > OWNER_TTL
+        if owner == self.owner:
+            return False
+        try:
+            heartbeat = os.path.getmtime(self._owner_file(owner))
+        except OSError:
+            heartbeat = None
+        return not owner_alive(owner, heartbeat)
+
+    def _adopt_orphans(self):
+        """Take over job directories whose owner is gone, so the janitor ages them out; called under _cond"""
+        for entry in os.scandir(self.root):
+            if not entry.is_dir() or entry.name.startswith('.') or entry.path in self._jobs:
+                continue
+            mtime = entry.stat().st_mtime
+            if self._orphaned(entry.path, mtime):
+                self._claim(entry.path)
+                self._jobs[entry.path] = {'state': 'done', 'created': mtime, 'finished': mtime, 'reserved': 0}
+        for entry in os.scandir(os.path.join(self.root, '.owners')):
+            if time.time() - entry.stat().st_mtime > OWNER_TTL * 10:
+                with contextlib.suppress(OSError):
+                    os.remove(entry.path)
+
+    def _delete(self, path):
+        """Delete a job directory unless another process has taken it over; called under _cond"""
+        if self._owner_of(path) in (self.owner, None):
+            shutil.rmtree(path, ignore_errors=True)
+            with contextlib.suppress(OSError):
+                os.remove(path + '.owner')
+        del self._jobs[path]
+
+    def create_job(self):
+        """Create an active job directory"""
+        self._setup()
+        path = tempfile.mkdtemp(prefix='job-', dir=self.root)
+        with self._cond:
+            self._claim(path)
+            self._jobs[path] = {'state': 'active', 'created': time.time(), 'finished': None, 'reserved': 0}
+        return path
+
+    def resume(self, path):
+        """Reactivate the directory of an interrupted job, keeping its partial files"""
+        self._setup()
+        os.makedirs(path, exist_ok=True)
+        with self._cond:
+            self._claim(path)
+            job = self._jobs.get(path)
+            created = job['created'] if job else time.time()
+            self._jobs[path] = {'state': 'active', 'created': created, 'finished': None, 'reserved': 0}
+        return path
+
+    def _available(self):
+        """Bytes a new job may still use: quota and free disk minus outstanding reservations"""
+        used = pending = 0
+        for path, job in self._jobs.items():
+            size = _dir_size(path)
+            used += size
+            if job['state'] == 'active':
+                pending += max(job['reserved'] - size, 0)
+        free = shutil.disk_usage(self.root).free - self.min_free
+        return min(self.max_bytes - used, free) - pending
+
+    def admit(self, path, expected_bytes, timeout=SPOOL_WAIT):
+        """Reserve room for a job, waiting up to timeout seconds
+
+        Raises SpoolFullError when the job can never fit, or SpoolBusyError
+        when no room frees up in time.
+        """
+        need = int(expected_bytes * SPOOL_HEADROOM) if expected_bytes else 0
+        if need > self.max_bytes:
+            with self._cond:
+                self.refused += 1
+            raise SpoolFullError(f"File too large: about {format_bytes(expected_bytes)}, "
+                                 f"the limit is {format_bytes(self.max_bytes / SPOOL_HEADROOM)}")
+        
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while True:
+                shortfall = need - self._available()
+                if shortfall <= 0:
+                    break
+                if self._evict_done(shortfall) < shortfall:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.refused += 1
+                        raise SpoolBusyError("Server disk is full, please try again later")
+                    self._cond.wait(min(remaining, SPOOL_JANITOR_INTERVAL))
+            if path in self._jobs:
+                self._jobs[path]['reserved'] = need
+
+    def finish(self, path):
+        """Mark a job as done; its file stays until released or aged out"""
+        with self._cond:
+            job = self._jobs.get(path)
+            if job:
+                job.update(state='done', finished=time.time(), reserved=0)
+            self._cond.notify_all()
+
+    def pause(self, path):
+        """Keep the partial files of a failed job for a retry; aged out like done jobs, never evicted for room"""
+        with self._cond:
+            job = self._jobs.get(path)
+            if job:
+                job.update(state='paused', finished=time.time(), reserved=0)
+            self._cond.notify_all()
+
+    def release(self, path):
+        """Delete a job directory"""
+        shutil.rmtree(path, ignore_errors=True)
+        with contextlib.suppress(OSError):
+            os.remove(path + '.owner')
+        with self._cond:
+            self._jobs.pop(path, None)
+            self._cond.notify_all()
+
+    def owns(self, path):
+        """Check whether a path is a job directory of this spool"""
+        return os.path.dirname(os.path.abspath(path)) == os.path.abspath(self.root)
+
+    def _evict_done(self, needed):
+        """Delete done jobs, oldest first, until needed bytes are freed; returns the bytes freed"""
+        freed = 0
+        done = sorted((job['finished'], path) for path, job in self._jobs.items() if job['state'] == 'done')
+        for _, path in done:
+            if freed >= needed:
+                break
+            freed += _dir_size(path)
+            self._delete(path)
+            self.evictions += 1
+        return freed
+
+    def sweep(self):
+        """Delete done jobs past max_age and, oldest first, any beyond the quota"""
+        now = time.time()
+        with self._cond:
+            self._heartbeat()
+            self._adopt_orphans()
+            for path, job in list(self._jobs.items()):
+                if not os.path.isdir(path):
+                    del self._jobs[path]
+                elif job['state'] in ('done', 'paused') and now - job['finished'] > self.max_age:
+                    self._delete(path)
+                    self.evictions += 1
+            over = sum(_dir_size(path) for path in self._jobs) - self.max_bytes
+            if over > 0:
+                self._evict_done(over)
+            self._cond.notify_all()
+
+    def start_janitor(self, interval=SPOOL_JANITOR_INTERVAL):
+        """Run sweep() every interval seconds in a background thread"""
+        with self._cond:
+            if self._janitor is not None and self._janitor.is_alive():
+                return
+            
+            def janitor():
+                while True:
+                    time.sleep(interval)
+                    self.sweep()
+            
+            self._janitor = threading.Thread(target=janitor, name='spool-janitor', daemon=True)
+            self._janitor.start()
+
+    def stats(self):
+        """Get job counts and disk usage"""
+        with self._cond:
+            states = [job['state'] for job in self._jobs.values()]
+            return {
+                'active': states.count('active'),
+                'paused': states.count('paused'),
+                'done': states.count('done'),
+                'bytes': sum(_dir_size(path) for path in self._jobs),
+                'reserved': sum(job['reserved'] for job in self._jobs.values()),
+                'max_bytes': self.max_bytes,
+                'evictions': self.evictions,
+                'refused': self.refused,
+            }
+
+
+spool = Spool()
+
+
+def _quality_height(quality):
+    """Get the height limit of a quality choice ('720p', '4K (2160p)'), None for no limit"""
+    match = re.search(r'(\d+)p\b', quality)
+    return int(match.group(1)) if match else None
+
+
+def _format_size(f, duration=None):
+    """Estimated bytes of a format, None when unknown"""
+    size = f.get('filesize') or f.get('filesize_approx')
+    if not size and f.get('tbr') and duration:
+        size = int(f['tbr'] * 1000 / 8 * duration)
+    return size or None
+
+
+def _copyable(f, container):
+    """Whether a format's streams go into container without re-encoding"""
+    prefixes = CONTAINER_CODECS.get(container)
+    if prefixes is None:
+        return True
+    codecs = [c for c in (f.get('vcodec'), f.get('acodec')) if c and c != 'none']
+    if not codecs:
+        return f.get('ext') == container
+    return all(c.lower().startswith(prefixes) for c in codecs)
+
+
+def rank_formats(info, quality, audio_format='mp3', container=MERGE_CONTAINER):
+    """Rank the ways of getting a quality from the extracted formats, best first
+
+    Every candidate is a list of formats: one pre-muxed format, or a video
+    and an audio stream to merge. Video candidates rank on the height (and
+    frame rate) reached within the limit, then pre-muxed over merged, then
+    stream-copyable into the container, then the fewest estimated bytes.
+    When no format fits the limit, formats of unknown height are used,
+    then the lowest height above it. 'Audio Only' ranks audio that the
+    audio_format conversion can copy instead of transcoding first.
+    """
+    info = info or {}
+    formats = [f for f in info.get('formats') or [info] if f.get('format_id')]
+    order = {id(f): i for i, f in enumerate(formats)}  # yt-dlp stores them worst to best
+    duration = info.get('duration')
+
+    def size(candidate):
+        sizes = [_format_size(f, duration) for f in candidate]
+        return sum(sizes) if all(sizes) else float('inf')
+
+    audio = [f for f in formats if f.get('acodec') != 'none' and f.get('vcodec') == 'none']
+    if quality == 'Audio Only':
+        copy = AUDIO_COPY_CODECS.get(audio_format, ())
+        audio.sort(key=lambda f: ((f.get('acodec') or '').lower().startswith(copy) if copy else False,
+                                  order[id(f)]), reverse=True)
+        if audio:
+            return [[f] for f in audio]
+        muxed = [f for f in formats if f.get('acodec') != 'none']
+        return [[f] for f in reversed(muxed)]
+
+    height = _quality_height(quality)
+    videos = [f for f in formats if f.get('vcodec') != 'none']
+    known = [f for f in videos if f.get('height')]
+    pool = [f for f in known if not height or f['height'] <= height] or [f for f in videos if not f.get('height')]
+    if not pool and known:
+        lowest = min(f['height'] for f in known)
+        pool = [f for f in known if f['height'] == lowest]
+
+    best_audio = max(audio, key=lambda f: (_copyable(f, container), order[id(f)]), default=None)
+    candidates = []
+    for f in pool:
+        if f.get('acodec') != 'none':
+            candidates.append([f])
+        elif best_audio:
+            candidates.append([f, best_audio])
+        else:
+            candidates.append([f])  # Video without any audio, the last resort
+
+    def key(candidate):
+        video = candidate[0]
+        has_audio = any(f.get('acodec') != 'none' for f in candidate)
+        return (-(video.get('height') or 0), -(video.get('fps') or 0), not has_audio, len(candidate),
+                not all(_copyable(f, container) for f in candidate), size(candidate), -order[id(video)])
+
+    return sorted(candidates, key=key)
+
+
+def select_formats(info, quality, audio_format='mp3'):
+    """Pick the formats to download for a quality, None when info has no usable formats"""
+    ranked = rank_formats(info, quality, audio_format)
+    return ranked[0] if ranked else None
+
+
+def format_choices(info):
+    """List the qualities a video really offers, best first
+
+    Each choice has the preset label download_video accepts, the formats
+    it downloads, whether they need a merge, and a one-line note.
+    """
+    formats = (info or {}).get('formats') or []
+    heights = sorted({f['height'] for f in formats if f.get('vcodec') != 'none' and f.get('height')}, reverse=True)
+    labels = [QUALITY_LABELS.get(h, f'{h}p') for h in heights]
+    if not labels and any(f.get('vcodec') != 'none' for f in formats):
+        labels = ['Best']
+    if any(f.get('acodec') != 'none' for f in formats):
+        labels.append('Audio Only')
+
+    choices = []
+    for label in labels:
+        selected = select_formats(info, label)
+        if not selected:
+            continue
+        video = selected[0]
+        streams = (selected[-1].get('acodec'),) if label == 'Audio Only' else (video.get('vcodec'), selected[-1].get('acodec'))
+        codecs = '+'.join(c.split('.')[0] for c in streams if c and c != 'none')
+        size = sum(_format_size(f, info.get('duration')) or 0 for f in selected)
+        note = ", ".join(part for part in (
+            label,
+            MERGE_CONTAINER if len(selected) > 1 else video.get('ext'),
+            codecs,
+            "merge" if len(selected) > 1 else None,
+            f"~{format_bytes(size)}" if size else None,
+        ) if part)
+        choices.append({
+            'label': label,
+            'format_ids': [f['format_id'] for f in selected],
+            'merge': len(selected) > 1,
+            'filesize': size or None,
+            'note': note,
+        })
+    return choices
+
+
+def estimate_download_size(info, quality):
+    """Estimate the bytes of a download from its selected formats, None when unknown"""
+    if not info:
+        return None
+    selected = select_formats(info, quality)
+    sizes = [_format_size(f, info.get('duration')) for f in selected or []]
+    if sizes and all(sizes):
+        return sum(sizes)
+    return info.get('filesize') or info.get('filesize_approx') or None
+
+
+def extract_info(url, timeout=60):
+    """Extract the full yt-dlp info dict, returns (info, error)"""
+    started = time.monotonic()
+    info = info_cache.get(url)
+    if info:
+        _record_extraction(url, started, 'cache')
+        return info, None
+    
+    info, error = _extract_info_uncached(url, timeout)
+    if info:
+        info_cache.put(url, info)
+    _record_extraction(url, started, 'extract', None if info else error or "No info")
+    return info, error
+
+
+def _record_extraction(url, started, source, error=None):
+    """Record the timing or failure of a metadata lookup"""
+    category = detect_website(url)['category']
+    elapsed = time.monotonic() - started
+    if error:
+        errors_total.inc(category=category, phase='extract')
+    else:
+        info_seconds.observe(elapsed, category=category, source=source)
+    if source != 'cache':
+        log_event('info_extracted', logging.WARNING if error else logging.INFO,
+                  url=url, category=category, seconds=round(elapsed, 3), error=error and error[-500:])
+
+
+def _extract_info_uncached(url, timeout):
+    if use_engine_pool():
+        try:
+            return get_engine_pool().call(('info', INFO_ARGS, url), timeout=timeout)
+        except EngineError as e:
+            log_event('engine_fallback', logging.WARNING, error=str(e))
+    
+    cmd = _yt_dlp_command() + ['--dump-json'] + INFO_ARGS + [url]
+    result = subprocess.run(cmd, capture_output=True, text=True, timeout=timeout)
+    
+    if result.returncode != 0:
+        return None, result.stderr
+    
+    return json.loads(result.stdout), None
+
+
+def summarize_info(info):
+    """Reduce a full info dict to what the UI shows"""
+    choices = format_choices(info)
+    return {
+        'title': info.get('title', 'Unknown'),
+        'thumbnail': info.get('thumbnail', ''),
+        'duration': info.get('duration_string', ''),
+        'uploader': info.get('uploader', ''),
+        'formats': [choice['label'] for choice in choices] or ['1080p', '720p', '480p', 'Audio Only'],
+        'choices': choices,
+        'video_id': info_video_id(info),
+        'language': info.get('language') or '',
+        'subtitles': sorted(key for key in info.get('subtitles') or {} if key != 'live_chat'),
+    }
+
+
+def get_video_info(url):
+    """Get video metadata using yt-dlp"""
+    try:
+        info, error = extract_info(url)
+        
+        if error:
+            return None, error
+        
+        return summarize_info(info), None
+    except Exception as e:
+        return None, str(e)
+
+
+def _rate_limited(args, rate):
+    """Limit a yt-dlp process to rate bytes/s
+
+    yt-dlp applies --limit-rate to each concurrent fragment, so the rate
+    is divided between them.
+    """
+    if not rate:
+        return args
+    fragments = 1
+    if '--concurrent-fragments' in args:
+        fragments = max(1, int(args[args.index('--concurrent-fragments') + 1]))
+    return ['--limit-rate', str(max(rate // fragments, 1))] + list(args)
+
+
+# yt-dlp options whose value (a credential or the path to one) stays out of the logs
+SECRET_ARGS = {'--cookies', '--username', '--password', '--video-password', '--ap-password',
+               '--client-certificate-key', '--client-certificate-password'}
+
+
+def _redact_args(args):
+    """Copy a command line with the values of SECRET_ARGS masked, for logging"""
+    return [arg if i == 0 or args[i - 1] not in SECRET_ARGS else '<redacted>' for i, arg in enumerate(args)]
+
+
+def run_yt_dlp(args, progress_callback=None, lease=None):
+    """Run yt-dlp with the given arguments, returns the last LOG_LINES output lines
+
+    With a BandwidthLease, engine workers follow every change of its rate;
+    a yt-dlp subprocess pins the rate it started with.
+    """
+    output_log = deque(maxlen=LOG_LINES)
+    
+    def on_line(line):
+        output_log.append(line)
+        if progress_callback:
+            progress_callback(line)
+    
+    if use_engine_pool():
+        on_control = lease and (lambda send: lease.bind(lambda rate: send(('bandwidth', rate))))
+        try:
+            get_engine_pool().call(('download', args), on_line=on_line, on_control=on_control)
+            return output_log
+        except EngineError as e:
+            log_event('engine_fallback', logging.WARNING, error=str(e))
+        finally:
+            if lease:
+                lease.bind(None)
+    
+    cmd = _yt_dlp_command() + _rate_limited(args, lease and lease.pin())
+    log_event('yt_dlp_command', logging.DEBUG, cmd=_redact_args(cmd))
+    
+    process = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        text=True
+    )
+    
+    # Monitor progress
+    while True:
+        line = process.stdout.readline()
+        if not line and process.poll() is not None:
+            break
+        if line:
+            on_line(line)
+    
+    return output_log
+
+
+@dataclass
+class ProgressEvent:
+    """Structured progress update of a download job"""
+    phase: str = 'queued'
+    downloaded_bytes: int = None
+    total_bytes: int = None
+    speed: float = None
+    eta: int = None
+    fragment_index: int = None
+    fragment_count: int = None
+    bandwidth: int = None  # bytes/s allocated to the job by the BandwidthGovernor, None for unlimited
+    line: str = ''
+
+    @property
+    def percent(self):
+        if self.phase == 'finished':
+            return 100.0
+        if self.downloaded_bytes is not None and self.total_bytes:
+            return min(100.0, self.downloaded_bytes * 100 / self.total_bytes)
+        if self.fragment_index is not None and self.fragment_count:
+            return min(100.0, self.fragment_index * 100 / self.fragment_count)
+        return None
+
+    def describe(self):
+        """Human-readable one-line summary"""
+        if self.phase != 'download' or self.percent is None:
+            return self.line or self.phase
+        text = f"Downloading {self.percent:.1f}%"
+        if self.total_bytes:
+            text += f" of {format_bytes(self.total_bytes)}"
+        if self.speed:
+            text += f" at {format_bytes(self.speed)}/s"
+        if self.eta is not None:
+            text += f", ETA {self.eta // 60:02d}:{self.eta % 60:02d}"
+        if self.bandwidth:
+            text += f" (share {format_bytes(self.bandwidth)}/s)"
+        return text
+
+    def to_dict(self):
+        return dict(asdict(self), percent=self.percent)
+
+
+def format_bytes(size):
+    """Format a byte count as a short human-readable string"""
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(size) < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}TiB"
+
+
+def _progress_number(value, cast=int):
+    try:
+        return cast(float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_progress_line(line, previous=None):
+    """Turn one yt-dlp output line into a ProgressEvent, carrying over the current phase"""
+    phase = previous.phase if previous else 'extract'
+    text = line.strip()
+    
+    if text.startswith(PROGRESS_PREFIX):
+        fields = text[len(PROGRESS_PREFIX):].split()
+        if len(fields) == 8:
+            status, downloaded, total, estimate, speed, eta, frag_index, frag_count = fields
+            return ProgressEvent(
+                phase='download',
+                downloaded_bytes=_progress_number(downloaded),
+                total_bytes=_progress_number(total) or _progress_number(estimate),
+                speed=_progress_number(speed, float),
+                eta=_progress_number(eta),
+                fragment_index=_progress_number(frag_index),
+                fragment_count=_progress_number(frag_count),
+                line=text,
+            )
+    
+    for prefix, prefix_phase in PHASE_PREFIXES.items():
+        if text.startswith(prefix):
+            phase = prefix_phase
+            break
+    else:
+        if re.match(r'\[(info|[\w:]+)\]', text) and phase in ('queued', 'extract'):
+            phase = 'extract'
+    
+    event = ProgressEvent(phase=phase, line=text)
+    if previous and phase == previous.phase == 'download':
+        # Keep the byte counters visible between machine-readable updates
+        event = ProgressEvent(**dict(asdict(previous), line=text))
+    return event
+
+
+class ProgressThrottle:
+    """Coalesce progress events to at most one per interval (phase changes always pass)"""
+
+    def __init__(self, callback, interval=PROGRESS_INTERVAL):
+        self.callback = callback
+        self.interval = interval
+        self._last_sent = 0.0
+        self._last_phase = None
+        self._pending = None
+
+    def __call__(self, event):
+        now = time.monotonic()
+        if event.phase != self._last_phase or now - self._last_sent >= self.interval:
+            self._send(event, now)
+        else:
+            self._pending = event
+
+    def _send(self, event, now):
+        self._pending = None
+        self._last_sent = now
+        self._last_phase = event.phase
+        self.callback(event)
+
+    def flush(self):
+        """Deliver the last coalesced event, if any"""
+        if self._pending is not None:
+            self._send(self._pending, time.monotonic())
+
+
+logger = logging.getLogger('video_downloader')
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(_log_handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+
+
+def log_event(event, level=logging.INFO, **fields):
+    """Log a structured event as one JSON line"""
+    if logger.isEnabledFor(level):
+        record = {'ts': round(time.time(), 3), 'level': logging.getLevelName(level).lower(), 'event': event}
+        record.update(fields)
+        logger.log(level, json.dumps(record, default=str))
+
+
+class _Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}  # label values -> value
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        return tuple(str(labels.get(name, '')) for name in self.labelnames)
+
+
+class Counter(_Metric):
+    """Monotonic counter with labels"""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, dict(zip(self.labelnames, key)), value) for key, value in self._values.items()]
+
+
+class Histogram(_Metric):
+    """Histogram with cumulative buckets, a sum and a count per label set"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=METRIC_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            counts = [n + (value <= bound) for n, bound in zip(counts, self.buckets)]
+            self._values[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        samples = []
+        with self._lock:
+            for key, (counts, total, count) in self._values.items():
+                labels = dict(zip(self.labelnames, key))
+                for bound, n in zip(self.buckets, counts):
+                    samples.append((f'{self.name}_bucket', dict(labels, le=str(bound)), n))
+                samples.append((f'{self.name}_bucket', dict(labels, le='+Inf'), count))
+                samples.append((f'{self.name}_sum', labels, total))
+                samples.append((f'{self.name}_count', labels, count))
+        return samples
+
+
+class Callback(_Metric):
+    """Gauge or counter read from a function at scrape time"""
+
+    def __init__(self, name, documentation, func, kind='gauge'):
+        super().__init__(name, documentation)
+        self.func = func
+        self.kind = kind
+
+    def samples(self):
+        return [(self.name, {}, self.func())]
+
+
+class MetricsRegistry:
+    """Collection of metrics rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=METRIC_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def callback(self, name, documentation, func, kind='gauge'):
+        return self._register(Callback(name, documentation, func, kind))
+
+    def render(self):
+        """Render every metric in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            registered = list(self._metrics.values())
+        for metric in registered:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                log_event('metric_failed', logging.WARNING, metric=metric.name, error=str(e))
+                continue
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in samples:
+                if labels:
+                    label_text = ",".join(f'{key}="{_escape_label(value)}"' for key, value in labels.items())
+                    name = f"{name}{{{label_text}}}"
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+metrics = MetricsRegistry()
+phase_seconds = metrics.histogram('vd_phase_seconds', "Time spent in each job phase", ('phase', 'category'))
+job_seconds = metrics.histogram('vd_job_seconds', "Run time of download jobs, excluding queueing", ('category', 'status'))
+queue_wait_seconds = metrics.histogram('vd_queue_wait_seconds', "Time download jobs waited for a slot", ('category',))
+info_seconds = metrics.histogram('vd_info_seconds', "Time to get video metadata", ('category', 'source'))
+jobs_total = metrics.counter('vd_jobs_total', "Finished download jobs", ('category', 'status'))
+download_bytes_total = metrics.counter('vd_download_bytes_total', "Bytes downloaded from video sites", ('category',))
+errors_total = metrics.counter('vd_errors_total', "Failed jobs and extractions by the phase they failed in", ('category', 'phase'))
+retries_total = metrics.counter('vd_download_retries_total', "Downloads retried after a transient failure", ('category',))
+postprocess_saved_bytes_total = metrics.counter(
+    'vd_postprocess_io_saved_bytes_total', "Disk reads and writes avoided by single-pass post-processing")
+
+
+class PhaseTimer:
+    """Time the phases of one job from its ProgressEvents and record them as metrics
+
+    Feed every (unthrottled) event; phases that repeat, like downloading
+    the video and then the audio stream, add up.
+    """
+
+    def __init__(self, url, category=None, job_id=None):
+        self.url = url
+        self.category = category or detect_website(url)['category']
+        self.job_id = job_id
+        self.phases = {}  # phase -> seconds
+        self.phase = None
+        self.last_phase = None
+        self.bytes = 0
+        self.queue_wait = None
+        self._file_bytes = 0
+        self._resumed_bytes = 0  # already on disk when the current file resumed
+        self._resume_announced = False
+        self._created = self._started = self._phase_started = time.monotonic()
+
+    def start(self):
+        """Mark the end of queueing"""
+        self._started = self._phase_started = time.monotonic()
+        self.queue_wait = self._started - self._created
+
+    def __call__(self, event):
+        now = time.monotonic()
+        if event.phase != self.phase and event.phase not in ('queued', 'finished', 'failed'):
+            self._close_phase(now)
+            self.phase = self.last_phase = event.phase
+            self._phase_started = now
+        if event.line.startswith('[download] Destination:'):
+            # The next file (e.g. the audio stream) started
+            self.bytes += self._file_bytes
+            self._file_bytes = 0
+            # yt-dlp announces a resume just before the file's destination
+            if not self._resume_announced:
+                self._resumed_bytes = 0
+            self._resume_announced = False
+        elif event.line.startswith('[download] Resuming download at byte '):
+            self._resumed_bytes = _progress_number(event.line.rsplit(' ', 1)[1]) or 0
+            self._resume_announced = True
+        elif event.phase == 'download' and event.downloaded_bytes:
+            # Concurrent fragments can report out of order, keep the maximum
+            self._file_bytes = max(self._file_bytes, event.downloaded_bytes - self._resumed_bytes)
+
+    def _close_phase(self, now):
+        if self.phase:
+            self.phases[self.phase] = self.phases.get(self.phase, 0.0) + now - self._phase_started
+            self.phase = None
+
+    def finish(self, status, error=None):
+        """Record the job's metrics and log its timings"""
+        now = time.monotonic()
+        self._close_phase(now)
+        self.bytes += self._file_bytes
+        self._file_bytes = 0
+        elapsed = now - self._started
+        
+        for phase, seconds in self.phases.items():
+            phase_seconds.observe(seconds, phase=phase, category=self.category)
+        if self.queue_wait is not None:
+            queue_wait_seconds.observe(self.queue_wait, category=self.category)
+            job_seconds.observe(elapsed, category=self.category, status=status)
+        jobs_total.inc(category=self.category, status=status)
+        if self.bytes:
+            download_bytes_total.inc(self.bytes, category=self.category)
+        if status == 'failed':
+            errors_total.inc(category=self.category, phase=self.last_phase or 'start')
+        
+        log_event('job_finished', logging.INFO if status == 'done' else logging.WARNING,
+                  job=self.job_id, url=self.url, category=self.category, status=status,
+                  seconds=round(elapsed, 3),
+                  queue_wait=self.queue_wait and round(self.queue_wait, 3),
+                  phases={phase: round(seconds, 3) for phase, seconds in self.phases.items()},
+                  bytes=self.bytes, error=error and error[-500:])
+
+
+class QueueFullError(Exception):
+    """Raised when the download queue is full and a job is refused"""
+
+
+def downloader_profile(url):
+    """Get the downloader settings for a URL's site category"""
+    profile = dict(DOWNLOADER_PROFILES['default'])
+    profile.update(DOWNLOADER_PROFILES.get(detect_website(url)['category'], {}))
+    if CONCURRENT_FRAGMENTS:
+        profile['fragments'] = int(CONCURRENT_FRAGMENTS)
+    if HTTP_CHUNK_SIZE:
+        profile['chunk_size'] = HTTP_CHUNK_SIZE
+    if EXTERNAL_DOWNLOADER:
+        profile['external'] = None if EXTERNAL_DOWNLOADER == 'none' else EXTERNAL_DOWNLOADER
+    return profile
+
+
+def downloader_args(url):
+    """Build the yt-dlp downloader options for a URL"""
+    profile = downloader_profile(url)
+    args = ['--concurrent-fragments', str(profile['fragments'])]
+    if profile.get('chunk_size'):
+        args.extend(['--http-chunk-size', profile['chunk_size']])
+    
+    external = profile.get('external')
+    if external:
+        external_path = get_executable_path(external)
+        if external_path != external or shutil.which(external):
+            args.extend(['--downloader', external_path, '--downloader', 'dash,m3u8:native'])
+            if external in EXTERNAL_DOWNLOADER_ARGS:
+                args.extend(['--downloader-args', f"{external}:{EXTERNAL_DOWNLOADER_ARGS[external]}"])
+    return args
+
+
+def download_host_key(url):
+    """Get the (host key, category) pair a download is rate-limited under"""
+    site = detect_website(url)
+    if site['category'] != 'unknown':
+        return site['name'], site['category']
+    referer = get_video_host_referer(url)
+    if referer:
+        return urlsplit(referer).hostname, 'unknown'
+    return urlsplit(url).hostname or url, 'unknown'
+
+
+def is_retryable(error):
+    """Check whether a download error is transient (timeouts, dropped connections, 429/5xx)"""
+    return bool(error and RETRYABLE_ERRORS.search(error))
+
+
+def partial_files(path):
+    """Map the partial downloads in a job directory (relative path -> bytes)"""
+    parts = {}
+    for root, _, names in os.walk(path):
+        for name in names:
+            if PARTIAL_FILE.search(name):
+                full = os.path.join(root, name)
+                try:
+                    parts[os.path.relpath(full, path)] = os.path.getsize(full)
+                except OSError:
+                    pass
+    return parts
+
+
+class HostBackoff:
+    """Exponential backoff with jitter per host after transient download failures
+
+    Every consecutive failure of a host doubles its delay (capped); the
+    jitter spreads the retries of jobs that failed together.
+    """
+
+    def __init__(self, base=RETRY_BASE, cap=RETRY_MAX):
+        self.base = base
+        self.cap = cap
+        self._hosts = {}  # host -> (consecutive failures, retry_at)
+        self._lock = threading.Lock()
+
+    def failed(self, host):
+        """Record a failure, returns the seconds until the host may be retried"""
+        with self._lock:
+            failures = self._hosts.get(host, (0, 0.0))[0] + 1
+            ceiling = min(self.base * 2 ** (failures - 1), self.cap)
+            delay = ceiling / 2 + random.uniform(0, ceiling / 2)
+            self._hosts[host] = (failures, time.time() + delay)
+        return delay
+
+    def succeeded(self, host):
+        with self._lock:
+            self._hosts.pop(host, None)
+
+    def retry_at(self, host):
+        """Get the wall-clock time before which the host should not be retried"""
+        with self._lock:
+            return self._hosts.get(host, (0, 0.0))[1]
+
+
+host_backoff = HostBackoff()
+
+
+class JobStore:
+    """SQLite record of unfinished downloads
+
+    A row holds the URL, options, job directory, attempts, last progress and
+    partial files of a job from submission until it finishes or fails for
+    good, so a restarted process can resume it where it stopped. Rows are
+    owned by the process running them (see process_owner), which
+    heartbeats while it lives; other processes sharing the database only
+    take over the rows of owners that are gone.
+    """
+
+    def __init__(self, db_path=JOB_DB):
+        self.db_path = db_path
+        self.owner = None
+        self._db = None  # opened on first use, not at import
+        self._lock = threading.Lock()
+        self._heartbeat_thread = None
+
+    @property
+    def enabled(self):
+        return bool(self.db_path)
+
+    def _connect(self):
+        """Open the database and start heartbeating; called under _lock"""
+        if self._db is not None and self.owner == process_owner():
+            return self._db
+        os.makedirs(os.path.dirname(os.path.abspath(self.db_path)), exist_ok=True)
+        self._db = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, url TEXT, options TEXT, priority INTEGER, temp_dir TEXT,
+                status TEXT, attempts INTEGER, next_attempt_at REAL, progress TEXT, parts TEXT,
+                error TEXT, created_at REAL, updated_at REAL);
+            CREATE TABLE IF NOT EXISTS owners (owner TEXT PRIMARY KEY, heartbeat REAL);
+        """)
+        with contextlib.suppress(sqlite3.OperationalError):
+            # Databases from before rows had owners: their rows count as orphaned
+            self._db.execute("ALTER TABLE jobs ADD COLUMN owner TEXT")
+        self.owner = process_owner()
+        self._beat()
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name='job-store-heartbeat', daemon=True)
+        self._heartbeat_thread.start()
+        return self._db
+
+    def _beat(self):
+        with self._db:
+            self._db.execute("INSERT OR REPLACE INTO owners VALUES (?, ?)", (self.owner, time.time()))
+
+    def _heartbeat_loop(self):
+        owner = self.owner
+        while self.owner == owner:
+            time.sleep(JOB_HEARTBEAT)
+            with self._lock, contextlib.suppress(sqlite3.Error):
+                self._beat()
+
+    def save(self, record):
+        """Insert or update a job from a dict with the table's columns, owned by this process"""
+        if not self.enabled:
+            return
+        parts = partial_files(record['temp_dir']) if record.get('temp_dir') else {}
+        with self._lock:
+            db = self._connect()
+            with db:
+                db.execute(
+                    "INSERT OR REPLACE INTO jobs (id, url, options, priority, temp_dir, status, attempts, next_attempt_at, "
+                    "progress, parts, error, created_at, updated_at, owner) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, "
+                    "COALESCE((SELECT created_at FROM jobs WHERE id = ?), ?), ?, ?)",
+                    (record['id'], record['url'], json.dumps(record['options']), record.get('priority', PRIORITY_NORMAL),
+                     record.get('temp_dir'), record.get('status', 'queued'), record.get('attempts', 0),
+                     record.get('next_attempt_at'), json.dumps(record.get('progress')), json.dumps(parts),
+                     record.get('error'), record['id'], time.time(), time.time(), self.owner))
+
+    def delete(self, job_id):
+        if not self.enabled:
+            return
+        with self._lock:
+            db = self._connect()
+            with db:
+                db.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def claim_orphans(self):
+        """Take over the recorded jobs whose owner is gone, oldest first
+
+        The jobs of live processes (another UI, the CLI or API on the same
+        spool) are left alone, since they are still downloading them.
+        """
+        if not self.enabled:
+            return []
+        with self._lock:
+            db = self._connect()
+            with db:
+                db.execute("BEGIN IMMEDIATE")
+                heartbeats = dict(db.execute("SELECT owner, heartbeat FROM owners"))
+                rows = db.execute(
+                    "SELECT id, url, options, priority, temp_dir, status, attempts, next_attempt_at, progress, parts, owner "
+                    "FROM jobs ORDER BY created_at").fetchall()
+                rows = [row for row in rows
+                        if row[-1] != self.owner and not owner_alive(row[-1], heartbeats.get(row[-1]), 3 * JOB_HEARTBEAT)]
+                db.executemany("UPDATE jobs SET owner = ? WHERE id = ?", [(self.owner, row[0]) for row in rows])
+                db.execute("DELETE FROM owners WHERE heartbeat < ?", (time.time() - 3600,))
+        columns = ('id', 'url', 'options', 'priority', 'temp_dir', 'status', 'attempts', 'next_attempt_at',
+                   'progress', 'parts')
+        jobs = []
+        for row in rows:
+            job = dict(zip(columns, row))
+            for key in ('options', 'progress', 'parts'):
+                job[key] = json.loads(job[key]) if job[key] else None
+            jobs.append(job)
+        return jobs
+
+
+job_store = JobStore()
+
+
+def _fair_shares(total, claims):
+    """Split total weighted max-min fairly between claims {key: (weight, limit)}
+
+    A claim never gets more than its limit (None for no limit); what it
+    leaves goes to the others in proportion to their weights. total may be
+    math.inf, then unlimited claims get math.inf.
+    """
+    shares = {}
+    pending = dict(claims)
+    while pending:
+        unit = total / sum(weight for weight, _ in pending.values())
+        capped = {key: limit for key, (weight, limit) in pending.items() if limit is not None and limit <= weight * unit}
+        if not capped:
+            shares.update((key, weight * unit) for key, (weight, _) in pending.items())
+            break
+        for key, limit in capped.items():
+            shares[key] = limit
+            total -= limit
+            del pending[key]
+    return shares
+
+
+def _split_bandwidth(total, claims):
+    """Share total between claims {key: (weight, demand, cap)}
+
+    Fair shares up to each demand first, then what is left up to each cap,
+    so a job whose demand was underestimated never loses idle bandwidth.
+    """
+    if total == math.inf:
+        return _fair_shares(total, {key: (weight, cap) for key, (weight, _, cap) in claims.items()})
+    shares = _fair_shares(total, {
+        key: (weight, cap if demand is None else demand if cap is None else min(demand, cap))
+        for key, (weight, demand, cap) in claims.items()
+    })
+    left = total - sum(shares.values())
+    if left > 0:
+        extra = _fair_shares(left, {
+            key: (weight, None if cap is None else max(cap - shares[key], 0))
+            for key, (weight, _, cap) in claims.items()
+        })
+        for key, share in extra.items():
+            shares[key] += share
+    return shares
+
+
+class BandwidthLease:
+    """A running download's share of the bandwidth budget
+
+    rate is the current allocation in bytes per second (None for
+    unlimited); the bound callback is called with every new rate.
+    """
+
+    def __init__(self, governor, key, category, session, weight):
+        self.governor = governor
+        self.key = key
+        self.category = category
+        self.session = session
+        self.weight = weight
+        self.rate = None
+        self.demand = None  # bytes/s the job can use when it leaves part of its share idle
+        self.pinned = False
+        self._callback = None
+        self._lock = threading.Lock()
+
+    def bind(self, callback):
+        """Deliver the current and every later rate to callback (None unbinds)"""
+        with self._lock:
+            self._callback = callback
+        if callback:
+            self._notify()
+
+    def _notify(self):
+        with self._lock:
+            callback = self._callback
+            if callback is None:
+                return
+            try:
+                callback(self.rate)
+            except Exception as e:
+                log_event('bandwidth_notify_failed', logging.WARNING, job=self.key, error=str(e))
+
+    def pin(self):
+        """Keep the current rate for good, for a yt-dlp subprocess that cannot change it; returns the rate"""
+        self.pinned = True
+        return self.rate
+
+    def observe(self, speed):
+        """Report the measured download speed, so unused share can go to other jobs"""
+        self.governor._observe(self, speed)
+
+    def release(self):
+        self.governor._release(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class BandwidthGovernor:
+    """Node-wide download bandwidth budget shared between the running jobs
+
+    Each job holds a BandwidthLease while it downloads. The budget is split
+    between the categories (each capped by category_limits) and then between
+    the jobs of a category, both weighted max-min fairly. A job's weight is
+    its priority weight divided by the number of running jobs of its session,
+    so every session gets the same total. Pinned leases keep their rate and
+    the others share what they leave.
+    """
+
+    def __init__(self, limit=BANDWIDTH_LIMIT, category_limits=CATEGORY_BANDWIDTH, interval=BANDWIDTH_REBALANCE_INTERVAL):
+        self.limit = limit
+        self.category_limits = dict(category_limits)
+        self.interval = interval
+        self._leases = {}
+        self._lock = threading.Lock()
+        self._rebalanced_at = 0.0
+
+    @property
+    def enabled(self):
+        return bool(self.limit or self.category_limits)
+
+    def acquire(self, key, category, session=None, weight=1.0):
+        """Start accounting a job, returns its BandwidthLease"""
+        lease = BandwidthLease(self, key, category, session or key, weight)
+        if self.enabled:
+            with self._lock:
+                self._leases[key] = lease
+            self._rebalance()
+        return lease
+
+    def _release(self, lease):
+        with self._lock:
+            if self._leases.get(lease.key) is not lease:
+                return
+            del self._leases[lease.key]
+        self._rebalance()
+
+    def _observe(self, lease, speed):
+        if not self.enabled or not speed or lease.key not in self._leases:
+            return
+        # A job well below its share is limited elsewhere (the site, the disk): let it
+        # grow by a quarter per rebalance and hand the rest to the others
+        lease.demand = speed * 1.25 if lease.rate and speed < lease.rate * 0.8 else None
+        if time.monotonic() - self._rebalanced_at >= self.interval:
+            self._rebalance()
+
+    def _rebalance(self):
+        changed = []
+        with self._lock:
+            self._rebalanced_at = time.monotonic()
+            sessions = {}
+            for lease in self._leases.values():
+                sessions[lease.session] = sessions.get(lease.session, 0) + 1
+            weights = {key: lease.weight / sessions[lease.session] for key, lease in self._leases.items()}
+            
+            # Pinned rates cannot shrink: take them off the budgets before sharing
+            pinned = {}
+            by_category = {}
+            for key, lease in self._leases.items():
+                if lease.pinned:
+                    pinned[lease.category] = pinned.get(lease.category, 0) + (lease.rate or 0)
+                else:
+                    by_category.setdefault(lease.category, {})[key] = (weights[key], lease.demand, None)
+            category_claims = {}
+            for category, claims in by_category.items():
+                demands = [demand for _, demand, _ in claims.values()]
+                limit = self.category_limits.get(category)
+                category_claims[category] = (sum(weight for weight, _, _ in claims.values()),
+                                             None if None in demands else sum(demands),
+                                             None if limit is None else max(limit - pinned.get(category, 0), 0))
+            
+            total = max(self.limit - sum(pinned.values()), 0) if self.limit else math.inf
+            category_shares = _split_bandwidth(total, category_claims)
+            for category, claims in by_category.items():
+                for key, share in _split_bandwidth(category_shares[category], claims).items():
+                    lease = self._leases[key]
+                    rate = max(int(share), BANDWIDTH_MIN_RATE) if share != math.inf else None
+                    if rate != lease.rate:
+                        lease.rate = rate
+                        changed.append(lease)
+        for lease in changed:
+            lease._notify()
+
+    def stats(self):
+        """Get the current allocation per job"""
+        with self._lock:
+            return {
+                'limit': self.limit or None,
+                'category_limits': self.category_limits,
+                'jobs': {key: {'category': lease.category, 'session': lease.session, 'rate': lease.rate}
+                         for key, lease in self._leases.items()},
+            }
+
+
+bandwidth_governor = BandwidthGovernor()
+
+
+class DownloadJob:
+    """Handle of a submitted download that UIs can poll or subscribe to"""
+
+    def __init__(self, job_id, url, options, priority, host, category, session=None):
+        self.id = job_id
+        self.url = url
+        self.options = options
+        self.priority = priority
+        self.host = host
+        self.category = category
+        self.session = session or job_id
+        self.lease = None  # BandwidthLease while running
+        self.status = 'queued'
+        self.progress = ProgressEvent()
+        self.log = deque(maxlen=LOG_LINES)
+        self.file_path = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.temp_dir = None  # kept across attempts so retries resume partial files
+        self.attempts = 0
+        self.not_before = 0.0
+        self.spool_wait_since = None  # when the spool first had no room for the job
+        self.resumed = False
+        self._store = None
+        self._manager = None  # the DownloadManager whose queue holds the job
+        self._checkpoint_at = 0.0
+        self._done = threading.Event()
+        self._subscribers = []
+        self._lock = threading.RLock()
+        self._throttle = ProgressThrottle(self._emit)
+        self._timer = PhaseTimer(url, category, job_id)
+
+    def subscribe(self, callback):
+        """Call callback(event) from the worker thread for every (throttled) ProgressEvent"""
+        with self._lock:
+            self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            if callback in self._subscribers:
+                self._subscribers.remove(callback)
+
+    def _on_line(self, line):
+        self.log.append(line)
+        self.progress = parse_progress_line(line, self.progress)
+        if self.lease:
+            self.progress.bandwidth = self.lease.rate
+            if self.progress.phase == 'download':
+                self.lease.observe(self.progress.speed)
+        self._timer(self.progress)
+        self._throttle(self.progress)
+        now = time.monotonic()
+        if self._store and now - self._checkpoint_at >= JOB_CHECKPOINT_INTERVAL:
+            self._checkpoint_at = now
+            self._store.save(self.record())
+
+    def _on_retry(self, delay):
+        self.progress = ProgressEvent(
+            phase='retrying',
+            line=f"Connection problem, retrying in {delay:.0f}s (attempt {self.attempts + 1} of {RETRY_ATTEMPTS + 1})")
+        self._timer(self.progress)
+        self._throttle(self.progress)
+
+    def record(self):
+        """Get the JobStore row of the job"""
+        progress = asdict(self.progress)
+        progress['line'] = ''
+        return {
+            'id': self.id,
+            'url': self.url,
+            'options': self.options,
+            'priority': self.priority,
+            'temp_dir': self.temp_dir,
+            'status': self.status,
+            'attempts': self.attempts,
+            'next_attempt_at': self.not_before or None,
+            'progress': progress,
+        }
+
+    def _emit(self, event):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for callback in subscribers:
+            try:
+                callback(event)
+            except Exception as e:
+                log_event('subscriber_failed', logging.WARNING, job=self.id, error=str(e))
+
+    def _finish(self, status, file_path=None, error=None):
+        self._throttle.flush()
+        if status == 'done':
+            self.progress = ProgressEvent(phase='finished', line=os.path.basename(file_path))
+            self._emit(self.progress)
+        self.status = status
+        self.file_path = file_path
+        self.error = error
+        self.finished_at = time.time()
+        self._timer.finish(status, error)
+        self._done.set()
+
+    @property
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None, progress_callback=None):
+        """Block until the job ends, returns (file_path, error)
+
+        ProgressEvents are delivered to progress_callback on the calling
+        thread, which UI frameworks like Streamlit require.
+        """
+        deadline = time.monotonic() + timeout if timeout else None
+        if progress_callback is None:
+            self._done.wait(timeout)
+        else:
+            events = queue.Queue()
+            self.subscribe(events.put)
+            try:
+                while deadline is None or time.monotonic() < deadline:
+                    try:
+                        progress_callback(events.get(timeout=0.1))
+                    except queue.Empty:
+                        if self.done:
+                            break
+            finally:
+                self.unsubscribe(events.put)
+        if not self.done:
+            return None, f"Timed out after {timeout} seconds"
+        return self.file_path, self.error
+
+    def cancel(self):
+        """Cancel the job if it is not running"""
+        # The manager's lock is the one jobs are started under, so a job cancelled here can no longer start
+        with self._manager._cond if self._manager else contextlib.nullcontext():
+            with self._lock:
+                if self.status not in ('queued', 'retrying'):
+                    return False
+                self._finish('cancelled', error="Cancelled")
+            if self._manager:
+                self._manager._dequeue(self)
+        if self._store:
+            self._store.delete(self.id)
+        if self.temp_dir:
+            spool.release(self.temp_dir)
+        return True
+
+    def snapshot(self):
+        """Get a JSON-friendly view of the job for polling"""
+        return {
+            'id': self.id,
+            'url': self.url,
+            'status': self.status,
+            'host': self.host,
+            'priority': self.priority,
+            'progress': self.progress.to_dict(),
+            'file_path': self.file_path,
+            'error': self.error,
+            'attempts': self.attempts,
+            'next_attempt_at': self.not_before or None,
+            'submitted_at': self.submitted_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+        }
+
+
+def download_options(quality, embed_subs=False, embed_thumb=False, audio_format='mp3', custom_filename=None,
+                     sub_langs=None, auto_subs=False):
+    """Build the options dict a job carries to _run_download"""
+    return {
+        'quality': quality,
+        'embed_subs': embed_subs,
+        'embed_thumb': embed_thumb,
+        'audio_format': audio_format,
+        'custom_filename': custom_filename,
+        'sub_langs': parse_languages(sub_langs) or None,
+        'auto_subs': bool(auto_subs),
+    }
+
+
+class DownloadManager:
+    """Bounded worker pool with per-host concurrency limits and a priority queue
+
+    Jobs are recorded in the JobStore until they end. Transient failures
+    are requeued behind the host's backoff and resume their partial files.
+    """
+
+    def __init__(self, max_workers=MAX_DOWNLOADS, max_queued=MAX_QUEUED, host_limits=HOST_CONCURRENCY, history=200,
+                 store=None, backoff=None):
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self.host_limits = host_limits
+        self.history = history
+        self.store = store or job_store
+        self.backoff = backoff or host_backoff
+        self._pending = []  # heap of (priority, sequence, job)
+        self._running = {}  # host -> number of running jobs
+        self._jobs = OrderedDict()
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._workers = []
+
+    def submit(self, url, quality, embed_subs=False, embed_thumb=False, audio_format='mp3',
+               custom_filename=None, priority=PRIORITY_NORMAL, session=None, sub_langs=None, auto_subs=False):
+        """Queue a download, returns its DownloadJob or raises QueueFullError
+
+        Jobs of the same session (e.g. one UI user) share one bandwidth share.
+        """
+        host, category = download_host_key(url)
+        options = download_options(quality, embed_subs, embed_thumb, audio_format, custom_filename, sub_langs, auto_subs)
+        with self._cond:
+            # Pick up a job resumed after a restart instead of downloading it twice
+            for job in self._jobs.values():
+                if job.resumed and not job.done and job.options == options and canonical_url(job.url) == canonical_url(url):
+                    job.resumed = False
+                    return job
+            if len(self._pending) >= self.max_queued:
+                raise QueueFullError("Server busy: download queue is full, please try again later")
+            job = DownloadJob(secrets.token_hex(8), url, options, priority, host, category, session)
+            # Saved before a worker or cancel() can see the job, so their delete always comes after
+            self.store.save(job.record())
+            self._enqueue(job)
+        return job
+
+    def _enqueue(self, job):
+        job._store = self.store if self.store.enabled else None
+        job._manager = self
+        heapq.heappush(self._pending, (job.priority, next(self._sequence), job))
+        self._jobs[job.id] = job
+        while len(self._jobs) > self.history and next(iter(self._jobs.values())).done:
+            self._jobs.popitem(last=False)
+        self._ensure_workers()
+        self._cond.notify_all()
+
+    def _dequeue(self, job):
+        """Take a cancelled job off the queue, so it no longer counts against max_queued (call under _cond)"""
+        self._pending = [entry for entry in self._pending if entry[2] is not job]
+        heapq.heapify(self._pending)
+
+    def resume(self):
+        """Requeue the jobs a process that is gone left unfinished, returns how many"""
+        records = self.store.claim_orphans()
+        with self._cond:
+            for record in records:
+                if record['id'] in self._jobs:
+                    continue
+                host, category = download_host_key(record['url'])
+                job = DownloadJob(record['id'], record['url'], record['options'], record['priority'], host, category)
+                job.temp_dir = record['temp_dir']
+                if job.temp_dir:
+                    spool.pause(job.temp_dir)  # adopted as done, keep it from eviction until it runs
+                job.attempts = record['attempts'] or 0
+                job.not_before = record['next_attempt_at'] or 0.0
+                job.resumed = True
+                if record['progress']:
+                    job.progress = ProgressEvent(**dict(record['progress'], phase='queued'))
+                self._enqueue(job)
+                log_event('job_resumed', job=job.id, url=job.url, attempts=job.attempts,
+                          partial_bytes=sum((record['parts'] or {}).values()))
+        return len(records)
+
+    def take_resumed(self, url, options):
+        """Hand a resumed job that has not started yet over to another runner (AsyncDownload)
+
+        Returns the job, now out of the queue, whose temp_dir and id the
+        caller continues, or None.
+        """
+        with self._cond:
+            for entry in self._pending:
+                job = entry[2]
+                if job.resumed and not job.done and job.options == options and canonical_url(job.url) == canonical_url(url):
+                    self._pending.remove(entry)
+                    heapq.heapify(self._pending)
+                    del self._jobs[job.id]
+                    return job
+        return None
+
+    def get(self, job_id):
+        """Look up a job by ID"""
+        return self._jobs.get(job_id)
+
+    def _ensure_workers(self):
+        while len(self._workers) < self.max_workers:
+            worker = threading.Thread(target=self._worker_loop, name=f'download-{len(self._workers)}', daemon=True)
+            self._workers.append(worker)
+            worker.start()
+
+    def _has_capacity(self, host, category):
+        """Check the per-host and the global limit; called under _cond"""
+        limit = self.host_limits.get(category, self.host_limits.get('unknown', 1))
+        return self._running.get(host, 0) < limit and sum(self._running.values()) < self.max_workers
+
+    def acquire_slot(self, url):
+        """Wait for a download slot for work run outside the worker pool, returns the host to release
+
+        Streams and async downloads hold one, so they count against the same
+        global and per-host limits as queued jobs.
+        """
+        host, category = download_host_key(url)
+        with self._cond:
+            while not self._has_capacity(host, category):
+                self._cond.wait()
+            self._running[host] = self._running.get(host, 0) + 1
+        return host
+
+    def release_slot(self, host):
+        with self._cond:
+            self._running[host] -= 1
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, url):
+        """Hold a download slot (see acquire_slot) for the duration of a with block"""
+        host = self.acquire_slot(url)
+        try:
+            yield
+        finally:
+            self.release_slot(host)
+
+    def _next_job(self):
+        """Pop the highest-priority job whose host has spare capacity and is not backing off"""
+        with self._cond:
+            while True:
+                now = time.time()
+                wake_at = None
+                for entry in sorted(self._pending):
+                    job = entry[2]
+                    if job.done:
+                        # Cancelled while queued
+                        self._pending.remove(entry)
+                        heapq.heapify(self._pending)
+                        continue
+                    ready_at = max(job.not_before, self.backoff.retry_at(job.host))
+                    if ready_at > now:
+                        wake_at = ready_at if wake_at is None else min(wake_at, ready_at)
+                        continue
+                    if self._has_capacity(job.host, job.category):
+                        self._pending.remove(entry)
+                        heapq.heapify(self._pending)
+                        self._running[job.host] = self._running.get(job.host, 0) + 1
+                        job.status = 'running'
+                        if job.started_at is None:
+                            job.started_at = time.time()
+                            job._timer.start()
+                        return job
+                self._cond.wait(None if wake_at is None else wake_at - now)
+
+    def _worker_loop(self):
+        while True:
+            job = self._next_job()
+            file_path = error = None
+            waiting_for_room = False
+            try:
+                if job.temp_dir is None:
+                    job.temp_dir = spool.create_job()
+                self.store.save(job.record())
+                job.lease = bandwidth_governor.acquire(job.id, job.category, job.session, PRIORITY_WEIGHTS.get(job.priority, 1.0))
+                file_path, error = _run_download(job.url, progress_callback=job._on_line, temp_dir=job.temp_dir,
+                                                 keep_partial=True, lease=job.lease, spool_wait=0, **job.options)
+            except SpoolBusyError as e:
+                # Wait for disk room in the queue instead of in a worker slot
+                error = str(e)
+                waiting_for_room = job.spool_wait_since is None or time.time() - job.spool_wait_since < SPOOL_WAIT
+            except Exception as e:
+                error = str(e)
+            finally:
+                if job.lease:
+                    job.lease.release()
+                    job.lease = None
+                with self._cond:
+                    self._running[job.host] -= 1
+                    if waiting_for_room:
+                        self._wait_for_room(job)
+                    retrying = waiting_for_room or (not file_path and self._retry(job, error))
+                    self._cond.notify_all()
+            if retrying:
+                continue
+            if file_path:
+                self.backoff.succeeded(job.host)
+            elif job.temp_dir:
+                spool.release(job.temp_dir)
+            self.store.delete(job.id)
+            job._finish('done' if file_path else 'failed', file_path, error)
+
+    def _wait_for_room(self, job):
+        """Requeue a job the spool could not admit yet, to try again after a while"""
+        if job.spool_wait_since is None:
+            job.spool_wait_since = time.time()
+        job.not_before = time.time() + SPOOL_ADMIT_INTERVAL
+        job.status = 'queued'
+        heapq.heappush(self._pending, (job.priority, next(self._sequence), job))
+
+    def _retry(self, job, error):
+        """Requeue a job after a transient failure, behind its host's backoff; False when it has to fail"""
+        if job.attempts >= RETRY_ATTEMPTS or not is_retryable(error):
+            return False
+        delay = self.backoff.failed(job.host)
+        job.attempts += 1
+        job._on_retry(delay)
+        job.not_before = time.time() + delay
+        job.status = 'retrying'
+        heapq.heappush(self._pending, (job.priority, next(self._sequence), job))
+        self.store.save(job.record())
+        retries_total.inc(category=job.category)
+        log_event('job_retrying', logging.WARNING, job=job.id, url=job.url, host=job.host,
+                  attempt=job.attempts, delay=round(delay, 1), error=error[-300:])
+        return True
+
+    def stats(self):
+        """Get queue depth and running jobs per host"""
+        with self._cond:
+            return {
+                'queued': len(self._pending),
+                'running': sum(self._running.values()),
+                'running_by_host': {host: n for host, n in self._running.items() if n},
+                'max_workers': self.max_workers,
+                'max_queued': self.max_queued,
+            }
+
+
+_download_manager = None
+_download_manager_lock = threading.Lock()
+
+
+def get_download_manager():
+    """Get the process-wide download manager"""
+    global _download_manager
+    with _download_manager_lock:
+        if _download_manager is None:
+            _download_manager = DownloadManager()
+            _download_manager.resume()
+        return _download_manager
+
+
+def _queue_stat(key):
+    return _download_manager.stats()[key] if _download_manager else 0
+
+
+metrics.callback('vd_downloads_queued', "Download jobs waiting for a slot", lambda: _queue_stat('queued'))
+metrics.callback('vd_downloads_running', "Download jobs running", lambda: _queue_stat('running'))
+metrics.callback('vd_info_cache_hits_total', "Metadata cache hits", lambda: info_cache.hits, 'counter')
+metrics.callback('vd_info_cache_misses_total', "Metadata cache misses", lambda: info_cache.misses, 'counter')
+metrics.callback('vd_file_cache_hits_total', "Finished-file cache hits", lambda: file_cache.hits, 'counter')
+metrics.callback('vd_file_cache_misses_total', "Finished-file cache misses", lambda: file_cache.misses, 'counter')
+metrics.callback('vd_warm_up_seconds', "Time the startup warm-up took (0 until it finished)",
+                 lambda: (_warm_up or {}).get('seconds') or 0)
+metrics.callback('vd_subtitle_cache_hits_total', "Subtitle tracks served from the subtitle cache",
+                 lambda: subtitle_cache.hits, 'counter')
+metrics.callback('vd_subtitle_cache_misses_total', "Subtitle tracks fetched from the network",
+                 lambda: subtitle_cache.misses, 'counter')
+metrics.callback('vd_thumbnail_cache_hits_total', "Thumbnails served from the thumbnail cache",
+                 lambda: thumbnail_cache.hits, 'counter')
+metrics.callback('vd_thumbnail_cache_misses_total', "Thumbnails fetched from the network",
+                 lambda: thumbnail_cache.misses, 'counter')
+metrics.callback('vd_spool_bytes', "Bytes held in download job directories", lambda: spool.stats()['bytes'])
+metrics.callback('vd_spool_refused_total', "Downloads refused for lack of disk room", lambda: spool.refused, 'counter')
+metrics.callback('vd_bandwidth_allocated_bytes', "Bandwidth allocated to the running downloads (bytes/s, unlimited ones excluded)",
+                 lambda: sum(job['rate'] or 0 for job in bandwidth_governor.stats()['jobs'].values()))
+
+
+def _network_stat(kind, key):
+    return _engine_pool.network_stats()[kind][key] if _engine_pool else 0
+
+
+metrics.callback('vd_dns_lookups_total', "DNS lookups made by engine workers", lambda: _network_stat('dns', 'lookups'), 'counter')
+metrics.callback('vd_dns_cache_hits_total', "DNS lookups answered by the workers' cache", lambda: _network_stat('dns', 'hits'), 'counter')
+metrics.callback('vd_http_requests_total', "HTTP requests sent by engine workers", lambda: _network_stat('http', 'requests'), 'counter')
+metrics.callback('vd_http_connections_total', "HTTP connections opened by engine workers", lambda: _network_stat('http', 'connections'), 'counter')
+metrics.callback('vd_http_connection_reuse_ratio', "Share of HTTP requests sent on a kept-alive connection",
+                 lambda: _network_stat('http', 'reuse_rate'))
+metrics.callback('vd_network_seconds_saved_total', "Estimated DNS and connection handshake time saved by reuse",
+                 lambda: _network_stat('dns', 'saved_seconds') + _network_stat('http', 'saved_seconds'), 'counter')
+
+
+def job_video_id(url):
+    """Get the video ID a download is sharded by, falling back to the canonical URL"""
+    info = info_cache.get(url)
+    return (info and info_video_id(info)) or url_video_id(url) or canonical_url(url)
+
+
+def queue_shard(url):
+    """Map a download to one of QUEUE_SHARDS shards by its video ID"""
+    digest = hashlib.sha1(job_video_id(url).encode()).digest()
+    return int.from_bytes(digest[:8], 'big') % QUEUE_SHARDS
+
+
+def shard_owner(shard, workers):
+    """Pick the worker that owns a shard by rendezvous hashing, None without workers
+
+    A worker joining or leaving only moves the shards it wins or held, so
+    the other workers keep their hot caches.
+    """
+    if not workers:
+        return None
+    return max(workers, key=lambda worker: hashlib.sha1(f'{worker}:{shard}'.encode()).digest())
+
+
+class JobQueue(abc.ABC):
+    """Download jobs shared by front ends and workers across nodes
+
+    A job is a dict with the QUEUE_FIELDS keys. Front ends submit() and poll
+    get(); workers heartbeat(), claim() the jobs of the shards they own (or
+    any job waiting longer than steal_after) and update() them until they end.
+    Backends implement the storage primitives.
+    """
+
+    def __init__(self, steal_after=QUEUE_STEAL_AFTER, worker_ttl=WORKER_TTL, max_queued=MAX_QUEUED):
+        self.steal_after = steal_after
+        self.worker_ttl = worker_ttl
+        self.max_queued = max_queued
+
+    def new_job(self, url, options, priority=PRIORITY_NORMAL, session=None):
+        """Build the record of a new queued job"""
+        now = time.time()
+        return {
+            'id': secrets.token_hex(8),
+            'url': url,
+            'options': options,
+            'priority': priority,
+            'session': session,
+            'shard': queue_shard(url),
+            'status': 'queued',
+            'worker': None,
+            'progress': None,
+            'file_path': None,
+            'error': None,
+            'submitted_at': now,
+            'claimed_at': None,
+            'updated_at': now,
+        }
+
+    def _pick(self, candidates, worker_id, workers, now):
+        """Choose the first job (in priority order) the worker owns or may steal"""
+        for job in candidates:
+            if shard_owner(job['shard'], workers) == worker_id or now - job['submitted_at'] >= self.steal_after:
+                return job
+        return None
+
+    @abc.abstractmethod
+    def submit(self, job):
+        """Queue a job record, raises QueueFullError when the queue is full"""
+
+    @abc.abstractmethod
+    def get(self, job_id):
+        """Get a job record, None when it is unknown or expired"""
+
+    @abc.abstractmethod
+    def update(self, job_id, **fields):
+        """Set fields of a job record"""
+
+    def finish(self, job_id, **fields):
+        """Record the end of a running job (status, file_path, error)"""
+        self.update(job_id, **fields)
+
+    @abc.abstractmethod
+    def claim(self, worker_id):
+        """Take the next job for a worker, marking it running; None when there is none"""
+
+    @abc.abstractmethod
+    def cancel(self, job_id):
+        """Cancel a job that no worker has claimed yet"""
+
+    @abc.abstractmethod
+    def heartbeat(self, worker_id):
+        """Register a worker as alive now"""
+
+    @abc.abstractmethod
+    def workers(self):
+        """List the IDs of the live workers"""
+
+    @abc.abstractmethod
+    def remove_worker(self, worker_id):
+        """Unregister a worker and requeue the jobs it was running"""
+
+    @abc.abstractmethod
+    def requeue_lost(self):
+        """Requeue the running jobs of workers that stopped heartbeating, returns how many"""
+
+    @abc.abstractmethod
+    def expire(self, max_age=SHARED_MAX_AGE):
+        """Forget jobs that ended more than max_age seconds ago"""
+
+    @abc.abstractmethod
+    def stats(self):
+        """Get job counts by status and the number of live workers"""
+
+
+QUEUE_FIELDS = ('id', 'url', 'options', 'priority', 'session', 'shard', 'status', 'worker', 'progress',
+                'file_path', 'error', 'submitted_at', 'claimed_at', 'updated_at')
+QUEUE_JSON_FIELDS = ('options', 'progress')
+
+
+class SQLiteJobQueue(JobQueue):
+    """JobQueue in a SQLite file, for processes on one machine (or a shared disk with working locks)
+
+    Claims run in IMMEDIATE transactions, so SQLite's file lock hands each
+    job to exactly one worker process.
+    """
+
+    def __init__(self, db_path, **kwargs):
+        super().__init__(**kwargs)
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS queue_jobs (
+                id TEXT PRIMARY KEY, url TEXT, options TEXT, priority INTEGER, session TEXT, shard INTEGER,
+                status TEXT, worker TEXT, progress TEXT, file_path TEXT, error TEXT,
+                submitted_at REAL, claimed_at REAL, updated_at REAL);
+            CREATE INDEX IF NOT EXISTS queue_jobs_status ON queue_jobs (status, priority, submitted_at);
+            CREATE TABLE IF NOT EXISTS queue_workers (id TEXT PRIMARY KEY, heartbeat REAL);
+        """)
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    @staticmethod
+    def _row(row):
+        job = dict(zip(QUEUE_FIELDS, row))
+        for key in QUEUE_JSON_FIELDS:
+            job[key] = json.loads(job[key]) if job[key] else None
+        return job
+
+    def submit(self, job):
+        values = [json.dumps(job[key]) if key in QUEUE_JSON_FIELDS else job[key] for key in QUEUE_FIELDS]
+        with self._transaction() as db:
+            queued = db.execute("SELECT COUNT(*) FROM queue_jobs WHERE status = 'queued'").fetchone()[0]
+            if queued >= self.max_queued:
+                raise QueueFullError("Server busy: download queue is full, please try again later")
+            db.execute(f"INSERT INTO queue_jobs VALUES ({', '.join('?' * len(QUEUE_FIELDS))})", values)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            row = self._db.execute(f"SELECT {', '.join(QUEUE_FIELDS)} FROM queue_jobs WHERE id = ?", (job_id,)).fetchone()
+        return self._row(row) if row else None
+
+    def update(self, job_id, **fields):
+        fields['updated_at'] = time.time()
+        columns = ', '.join(f'{key} = ?' for key in fields)
+        values = [json.dumps(value) if key in QUEUE_JSON_FIELDS else value for key, value in fields.items()]
+        with self._transaction() as db:
+            db.execute(f"UPDATE queue_jobs SET {columns} WHERE id = ?", values + [job_id])
+
+    def claim(self, worker_id):
+        now = time.time()
+        with self._transaction() as db:
+            workers = [row[0] for row in db.execute(
+                "SELECT id FROM queue_workers WHERE heartbeat >= ?", (now - self.worker_ttl,))]
+            candidates = [self._row(row) for row in db.execute(
+                f"SELECT {', '.join(QUEUE_FIELDS)} FROM queue_jobs WHERE status = 'queued' "
+                "ORDER BY priority, submitted_at")]
+            job = self._pick(candidates, worker_id, workers, now)
+            if job:
+                db.execute("UPDATE queue_jobs SET status = 'running', worker = ?, claimed_at = ?, updated_at = ? "
+                           "WHERE id = ?", (worker_id, now, now, job['id']))
+                job.update(status='running', worker=worker_id, claimed_at=now, updated_at=now)
+        return job
+
+    def cancel(self, job_id):
+        with self._transaction() as db:
+            cursor = db.execute("UPDATE queue_jobs SET status = 'cancelled', error = 'Cancelled', updated_at = ? "
+                                "WHERE id = ? AND status = 'queued'", (time.time(), job_id))
+        return cursor.rowcount > 0
+
+    def heartbeat(self, worker_id):
+        with self._transaction() as db:
+            db.execute("INSERT OR REPLACE INTO queue_workers VALUES (?, ?)", (worker_id, time.time()))
+
+    def workers(self):
+        with self._lock:
+            return [row[0] for row in self._db.execute(
+                "SELECT id FROM queue_workers WHERE heartbeat >= ?", (time.time() - self.worker_ttl,))]
+
+    def remove_worker(self, worker_id):
+        with self._transaction() as db:
+            db.execute("DELETE FROM queue_workers WHERE id = ?", (worker_id,))
+            db.execute("UPDATE queue_jobs SET status = 'queued', worker = NULL, updated_at = ? "
+                       "WHERE status = 'running' AND worker = ?", (time.time(), worker_id))
+
+    def requeue_lost(self):
+        now = time.time()
+        with self._transaction() as db:
+            db.execute("DELETE FROM queue_workers WHERE heartbeat < ?", (now - self.worker_ttl,))
+            cursor = db.execute(
+                "UPDATE queue_jobs SET status = 'queued', worker = NULL, updated_at = ? WHERE status = 'running' "
+                "AND worker NOT IN (SELECT id FROM queue_workers)", (now,))
+        return cursor.rowcount
+
+    def expire(self, max_age=SHARED_MAX_AGE):
+        with self._transaction() as db:
+            db.execute("DELETE FROM queue_jobs WHERE status IN ('done', 'failed', 'cancelled') AND updated_at < ?",
+                       (time.time() - max_age,))
+
+    def stats(self):
+        with self._lock:
+            counts = dict(self._db.execute("SELECT status, COUNT(*) FROM queue_jobs GROUP BY status").fetchall())
+        return {'jobs': counts, 'workers': len(self.workers())}
+
+
+class RedisJobQueue(JobQueue):
+    """JobQueue on a Redis-compatible server (Redis, Valkey, KeyDB), for workers on several nodes
+
+    Queued job IDs sit in a sorted set ordered by priority then submission
+    time. A submit checks the queue size and adds the job in one Lua script,
+    and a claim takes the job off the set and marks it running in one Lua
+    script, so it succeeds for one worker only and a crash cannot lose the
+    job in between. Needs the redis package (pip install redis).
+    """
+
+    SUBMIT_SCRIPT = """
+        if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[1]) then
+            return 0
+        end
+        redis.call('HSET', KEYS[2], unpack(ARGV, 4))
+        redis.call('ZADD', KEYS[1], ARGV[2], ARGV[3])
+        return 1
+    """
+
+    CLAIM_SCRIPT = """
+        if redis.call('ZREM', KEYS[1], ARGV[1]) == 0 then
+            return 0
+        end
+        redis.call('HSET', KEYS[2], 'status', ARGV[2], 'worker', ARGV[3], 'claimed_at', ARGV[4], 'updated_at', ARGV[4])
+        redis.call('SADD', KEYS[3], ARGV[1])
+        return 1
+    """
+
+    def __init__(self, url, prefix='vd', **kwargs):
+        super().__init__(**kwargs)
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError("VD_QUEUE_URL uses Redis, which needs the redis package (pip install redis)")
+        self._redis = redis.Redis.from_url(url)
+        self._prefix = prefix
+        self._submit = self._redis.register_script(self.SUBMIT_SCRIPT)
+        self._claim = self._redis.register_script(self.CLAIM_SCRIPT)
+
+    def _key(self, *parts):
+        return ':'.join((self._prefix,) + parts)
+
+    @staticmethod
+    def _score(job):
+        return job['priority'] * 1e11 + job['submitted_at']
+
+    def _load(self, job_id):
+        raw = self._redis.hgetall(self._key('job', job_id))
+        if not raw:
+            return None
+        return {key.decode(): json.loads(value) for key, value in raw.items()}
+
+    def _store(self, job_id, fields, pipe=None):
+        (pipe or self._redis).hset(self._key('job', job_id), mapping={key: json.dumps(value) for key, value in fields.items()})
+
+    def submit(self, job):
+        # The size check and the insert run as one script, so max_queued holds with many front ends
+        fields = [item for key, value in job.items() for item in (key, json.dumps(value))]
+        if not self._submit(keys=[self._key('queue'), self._key('job', job['id'])],
+                            args=[self.max_queued, repr(self._score(job)), job['id']] + fields):
+            raise QueueFullError("Server busy: download queue is full, please try again later")
+        return job
+
+    def get(self, job_id):
+        return self._load(job_id)
+
+    def update(self, job_id, **fields):
+        fields['updated_at'] = time.time()
+        self._store(job_id, fields)
+
+    def claim(self, worker_id):
+        now = time.time()
+        workers = self.workers()
+        ids = [job_id.decode() for job_id in self._redis.zrange(self._key('queue'), 0, 99)]
+        candidates = [job for job in map(self._load, ids) if job]
+        while True:
+            job = self._pick(candidates, worker_id, workers, now)
+            if job is None:
+                return None
+            keys = [self._key('queue'), self._key('job', job['id']), self._key('running')]
+            if self._claim(keys=keys, args=[job['id'], json.dumps('running'), json.dumps(worker_id), json.dumps(now)]):
+                break
+            # Another worker was faster
+            candidates.remove(job)
+        job.update(status='running', worker=worker_id, claimed_at=now, updated_at=now)
+        return job
+
+    def cancel(self, job_id):
+        if not self._redis.zrem(self._key('queue'), job_id):
+            return False
+        self.update(job_id, status='cancelled', error='Cancelled')
+        self._redis.expire(self._key('job', job_id), SHARED_MAX_AGE)
+        return True
+
+    def finish(self, job_id, **fields):
+        """Record the end of a running job; its record expires after SHARED_MAX_AGE"""
+        with self._redis.pipeline() as pipe:
+            self._store(job_id, dict(fields, updated_at=time.time()), pipe)
+            pipe.srem(self._key('running'), job_id)
+            pipe.expire(self._key('job', job_id), SHARED_MAX_AGE)
+            pipe.execute()
+
+    def heartbeat(self, worker_id):
+        self._redis.hset(self._key('workers'), worker_id, time.time())
+
+    def workers(self):
+        cutoff = time.time() - self.worker_ttl
+        return [worker.decode() for worker, heartbeat in self._redis.hgetall(self._key('workers')).items()
+                if float(heartbeat) >= cutoff]
+
+    def _requeue(self, job_ids):
+        for job_id in job_ids:
+            job = self._load(job_id)
+            if self._redis.srem(self._key('running'), job_id) and job:
+                self.update(job_id, status='queued', worker=None)
+                self._redis.zadd(self._key('queue'), {job_id: self._score(job)})
+
+    def remove_worker(self, worker_id):
+        self._redis.hdel(self._key('workers'), worker_id)
+        self._requeue([job['id'] for job in map(self._load, self._running_ids()) if job and job['worker'] == worker_id])
+
+    def _running_ids(self):
+        return [job_id.decode() for job_id in self._redis.smembers(self._key('running'))]
+
+    def requeue_lost(self):
+        live = set(self.workers())
+        dead = [worker.decode() for worker in self._redis.hkeys(self._key('workers')) if worker.decode() not in live]
+        if dead:
+            self._redis.hdel(self._key('workers'), *dead)
+        lost = [job['id'] for job in map(self._load, self._running_ids()) if job and job['worker'] not in live]
+        self._requeue(lost)
+        return len(lost)
+
+    def expire(self, max_age=SHARED_MAX_AGE):
+        pass  # ended jobs expire by themselves
+
+    def stats(self):
+        return {
+            'jobs': {'queued': self._redis.zcard(self._key('queue')), 'running': self._redis.scard(self._key('running'))},
+            'workers': len(self.workers()),
+        }
+
+
+def open_job_queue(url=QUEUE_URL):
+    """Open the JobQueue of a VD_QUEUE_URL (sqlite:///path or redis://host:port/db)"""
+    scheme = urlsplit(url).scheme
+    if scheme == 'sqlite':
+        return SQLiteJobQueue(url[len('sqlite://'):])
+    if scheme in ('redis', 'rediss', 'unix'):
+        return RedisJobQueue(url)
+    raise ValueError(f"Unsupported VD_QUEUE_URL: {url!r} (use sqlite:///path or redis://host:port/db)")
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+
+def queue_enabled():
+    """Check whether downloads run on queue workers instead of in this process"""
+    return bool(QUEUE_URL)
+
+
+def get_job_queue():
+    """Get the process-wide JobQueue of VD_QUEUE_URL"""
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = open_job_queue()
+        return _job_queue
+
+
+class QueuedJob:
+    """Handle of a job submitted to the JobQueue, polled like a DownloadJob"""
+
+    def __init__(self, job_queue, record):
+        self.queue = job_queue
+        self.id = record['id']
+        self.url = record['url']
+        self.record = record
+        self.progress = ProgressEvent()
+
+    def poll(self):
+        """Refresh the record, returns a ProgressEvent when the progress changed since the last poll"""
+        record = self.queue.get(self.id)
+        if record is None:
+            record = dict(self.record, status='failed', error="The job expired from the queue")
+        self.record = record
+        progress = ProgressEvent(**record['progress']) if record['progress'] else None
+        if progress and progress != self.progress:
+            self.progress = progress
+            return progress
+        return None
+
+    @property
+    def status(self):
+        return self.record['status']
+
+    @property
+    def done(self):
+        return self.status in ('done', 'failed', 'cancelled')
+
+    @property
+    def file_path(self):
+        return self.record['file_path']
+
+    @property
+    def error(self):
+        return self.record['error']
+
+    def wait(self, timeout=None, progress_callback=None, interval=QUEUE_POLL_INTERVAL):
+        """Block until the job ends, returns (file_path, error); see DownloadJob.wait"""
+        deadline = time.monotonic() + timeout if timeout else None
+        while True:
+            event = self.poll()
+            if event and progress_callback:
+                progress_callback(event)
+            if self.done:
+                return self.file_path, self.error
+            if deadline is not None and time.monotonic() >= deadline:
+                return None, f"Timed out after {timeout} seconds"
+            time.sleep(interval)
+
+    def cancel(self):
+        """Cancel the job if no worker has claimed it yet"""
+        return self.queue.cancel(self.id)
+
+    def snapshot(self):
+        """Get a JSON-friendly view of the job for polling"""
+        return dict(self.record, progress=self.progress.to_dict())
+
+
+def submit_download(url, quality, embed_subs=False, embed_thumb=False, audio_format='mp3', custom_filename=None,
+                    priority=PRIORITY_NORMAL, session=None, sub_langs=None, auto_subs=False):
+    """Queue a download on the queue workers (with VD_QUEUE_URL) or the local DownloadManager
+
+    Returns a QueuedJob or DownloadJob, both with wait(), or raises QueueFullError.
+    """
+    if not queue_enabled():
+        return get_download_manager().submit(url, quality, embed_subs, embed_thumb, audio_format, custom_filename,
+                                             priority=priority, session=session, sub_langs=sub_langs, auto_subs=auto_subs)
+    job_queue = get_job_queue()
+    options = download_options(quality, embed_subs, embed_thumb, audio_format, custom_filename, sub_langs, auto_subs)
+    record = job_queue.submit(job_queue.new_job(url, options, priority, session))
+    log_event('job_submitted', job=record['id'], url=url, shard=record['shard'])
+    return QueuedJob(job_queue, record)
+
+
+def get_job(job_id):
+    """Look up a job submitted through submit_download, None when it is unknown"""
+    if queue_enabled():
+        job_queue = get_job_queue()
+        record = job_queue.get(job_id)
+        return QueuedJob(job_queue, record) if record else None
+    return get_download_manager().get(job_id)
+
+
+def iter_job_events(job, interval=QUEUE_POLL_INTERVAL):
+    """Yield the ProgressEvents of a DownloadJob or QueuedJob until it ends, starting with the current one"""
+    if isinstance(job, QueuedJob):
+        yield job.progress
+        while True:
+            event = job.poll()
+            if event:
+                yield event
+            if job.done:
+                return
+            time.sleep(interval)
+    
+    events = queue.Queue()
+    job.subscribe(events.put)
+    try:
+        yield job.progress
+        while True:
+            try:
+                yield events.get(timeout=interval)
+            except queue.Empty:
+                if job.done:
+                    return
+    finally:
+        job.unsubscribe(events.put)
+
+
+def publish_shared(path, job_id, shared_dir=SHARED_DIR):
+    """Copy (or hard-link) a finished download to shared storage, returns the shared path
+
+    The file appears under its final name only once it is complete.
+    """
+    dest_dir = os.path.join(shared_dir, job_id)
+    os.makedirs(dest_dir, exist_ok=True)
+    dest = os.path.join(dest_dir, os.path.basename(path))
+    partial = dest + '.part'
+    _link_or_copy(path, partial)
+    os.replace(partial, dest)
+    return dest
+
+
+def sweep_shared(shared_dir=SHARED_DIR, max_age=SHARED_MAX_AGE):
+    """Delete published downloads older than max_age, returns how many"""
+    removed = 0
+    cutoff = time.time() - max_age
+    try:
+        entries = list(os.scandir(shared_dir))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            if entry.is_dir() and entry.stat().st_mtime < cutoff:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+        except OSError:
+            pass
+    return removed
+
+
+queue_jobs_total = metrics.counter('vd_queue_jobs_total', "Queue jobs finished by this worker", ('status',))
+
+
+class QueueWorker:
+    """Headless worker that runs JobQueue jobs through a local DownloadManager
+
+    Up to max_jobs claimed jobs run at once, under the manager's host
+    limits, retries and bandwidth budget. Progress is written back to the
+    queue and finished files are published to shared_dir. The queue is the
+    durable record of the jobs, so the local JobStore is not used: the jobs
+    of a worker that dies are requeued once its heartbeat stops.
+    """
+
+    def __init__(self, job_queue, shared_dir=SHARED_DIR, max_jobs=MAX_DOWNLOADS, worker_id=None):
+        self.queue = job_queue
+        self.shared_dir = shared_dir
+        self.max_jobs = max_jobs
+        self.id = worker_id or f"{socket.gethostname()}-{os.getpid()}-{secrets.token_hex(2)}"
+        self.manager = DownloadManager(max_workers=max_jobs, max_queued=max_jobs, store=JobStore(''))
+        self._threads = {}  # queue job ID -> thread waiting for the job
+        self._stop = threading.Event()
+        self._exited = threading.Event()  # run() is done with the jobs, the heartbeat ends
+
+    def run(self):
+        """Claim and run jobs until stop(), then wait for the running ones to finish"""
+        os.makedirs(self.shared_dir, exist_ok=True)
+        self.queue.heartbeat(self.id)
+        heartbeat = threading.Thread(target=self._heartbeat_loop, name='queue-heartbeat', daemon=True)
+        heartbeat.start()
+        log_event('worker_started', worker=self.id, max_jobs=self.max_jobs, shared_dir=self.shared_dir)
+        failures = 0
+        try:
+            while not self._stop.is_set():
+                self._threads = {job_id: thread for job_id, thread in self._threads.items() if thread.is_alive()}
+                try:
+                    record = self.queue.claim(self.id) if len(self._threads) < self.max_jobs else None
+                    failures = 0
+                except Exception as e:
+                    # A backend hiccup: wait and try again rather than stopping the worker
+                    failures += 1
+                    log_event('claim_failed', logging.WARNING, worker=self.id, error=str(e))
+                    self._stop.wait(min(QUEUE_POLL_INTERVAL * 2 ** failures, QUEUE_ERROR_BACKOFF))
+                    continue
+                if record is None:
+                    self._stop.wait(QUEUE_POLL_INTERVAL)
+                    continue
+                thread = threading.Thread(target=self._run_job, args=(record,), name=f"queue-job-{record['id']}",
+                                          daemon=True)
+                self._threads[record['id']] = thread
+                thread.start()
+            for thread in list(self._threads.values()):
+                thread.join()
+        finally:
+            # The heartbeat must not register the worker again once it is removed
+            self._exited.set()
+            heartbeat.join()
+            self.queue.remove_worker(self.id)
+            log_event('worker_stopped', worker=self.id)
+
+    def stop(self):
+        """Stop claiming jobs; run() returns once the running ones are finished"""
+        self._stop.set()
+
+    def _heartbeat_loop(self):
+        last_sweep = 0.0
+        # Keeps beating after stop() while the running jobs finish, or other nodes would requeue them
+        while not self._exited.wait(WORKER_HEARTBEAT):
+            try:
+                self.queue.heartbeat(self.id)
+                lost = self.queue.requeue_lost()
+                if lost:
+                    log_event('jobs_requeued', logging.WARNING, worker=self.id, jobs=lost)
+                if time.monotonic() - last_sweep >= SPOOL_JANITOR_INTERVAL:
+                    last_sweep = time.monotonic()
+                    self.queue.expire()
+                    sweep_shared(self.shared_dir)
+            except Exception as e:
+                log_event('heartbeat_failed', logging.WARNING, worker=self.id, error=str(e))
+
+    def _run_job(self, record):
+        job_id = record['id']
+        log_event('job_claimed', worker=self.id, job=job_id, url=record['url'], shard=record['shard'],
+                  waited=round(time.time() - record['submitted_at'], 3))
+        
+        def report(event):
+            self.queue.update(job_id, progress=asdict(event))
+        
+        file_path = error = None
+        try:
+            job = self.manager.submit(record['url'], priority=record['priority'], session=record['session'],
+                                      **record['options'])
+            job.subscribe(report)
+            file_path, error = job.wait()
+            job.unsubscribe(report)
+            if file_path:
+                shared_path = publish_shared(file_path, job_id, self.shared_dir)
+                release_download(file_path)
+                file_path = shared_path
+        except Exception as e:
+            file_path, error = None, str(e)
+        status = 'done' if file_path else 'failed'
+        fields = {'status': status, 'file_path': file_path, 'error': error and error[-2000:]}
+        delay = QUEUE_POLL_INTERVAL
+        while True:
+            try:
+                self.queue.finish(job_id, **fields)
+                break
+            except Exception as e:
+                # Left 'running', the job would be downloaded again once this worker is gone
+                log_event('finish_failed', logging.WARNING, worker=self.id, job=job_id, error=str(e))
+                time.sleep(delay)
+                delay = min(delay * 2, QUEUE_ERROR_BACKOFF)
+        queue_jobs_total.inc(status=status)
+
+
+def download_video(url, quality, embed_subs=False, embed_thumb=False, audio_format='mp3', custom_filename=None, progress_callback=None,
+                   session=None, sub_langs=None, auto_subs=False):
+    """Download video using yt-dlp, queued through the download manager (or the queue workers)
+
+    progress_callback receives throttled ProgressEvent objects. session
+    identifies the user for bandwidth sharing. sub_langs and auto_subs
+    choose the subtitle tracks (see select_subtitles).
+    """
+    try:
+        job = submit_download(url, quality, embed_subs, embed_thumb, audio_format, custom_filename, session=session,
+                              sub_langs=sub_langs, auto_subs=auto_subs)
+    except QueueFullError as e:
+        return None, str(e)
+    return job.wait(progress_callback=progress_callback)
+
+
+def playlist_entry(entry, index):
+    """Reduce a flat playlist entry to what a batch download needs"""
+    return {
+        'index': index,
+        'id': entry.get('id'),
+        'title': entry.get('title') or entry.get('id') or f"Video {index}",
+        'url': entry.get('url') or entry.get('webpage_url'),
+        'duration': entry.get('duration'),
+    }
+
+
+def iter_playlist_entries(url, limit=None):
+    """Yield playlist or channel entries lazily, as yt-dlp discovers them page by page"""
+    if use_engine_pool():
+        items = queue.Queue()
+        done = object()
+        controls = []
+        
+        def enumerate_entries():
+            try:
+                _, error = get_engine_pool().call(('entries', PLAYLIST_ARGS, url, limit), on_item=items.put,
+                                                  on_control=controls.append)
+                if error:
+                    log_event('playlist_failed', logging.WARNING, url=url, error=error)
+            except EngineError as e:
+                log_event('playlist_failed', logging.WARNING, url=url, error=str(e))
+            finally:
+                items.put(done)
+        
+        threading.Thread(target=enumerate_entries, name='playlist-entries', daemon=True).start()
+        try:
+            while True:
+                item = items.get()
+                if item is done:
+                    return
+                yield item
+        finally:
+            # Stop paging through the rest of the playlist once the caller is done, freeing the worker
+            for send in controls:
+                send(('stop', None))
+    
+    cmd = _yt_dlp_command() + ['--dump-json'] + PLAYLIST_ARGS + [url]
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True)
+    try:
+        index = 0
+        for line in process.stdout:
+            if not line.strip():
+                continue
+            index += 1
+            yield playlist_entry(json.loads(line), index)
+            if limit and index >= limit:
+                break
+    finally:
+        # Stop paging through the rest of the playlist once the caller is done
+        if process.poll() is None:
+            process.kill()
+        process.wait()
+
+
+def _batch_item(entry, quality, options, session):
+    """Analyze then download one playlist entry, returns its result dict"""
+    result = dict(entry, file_path=None, error=None)
+    if not entry['url']:
+        result['error'] = "Entry has no URL"
+        return result
+    
+    # Analyze first, so broken entries never take a download slot
+    info, error = extract_info(entry['url'])
+    if error:
+        result['error'] = error
+        return result
+    result['title'] = info.get('title', result['title'])
+    
+    while True:
+        try:
+            job = submit_download(entry['url'], quality, priority=PRIORITY_LOW, session=session, **options)
+            break
+        except QueueFullError:
+            time.sleep(1)
+    result['job_id'] = job.id
+    result['file_path'], result['error'] = job.wait()
+    return result
+
+
+def download_batch(url, quality, embed_subs=False, embed_thumb=False, audio_format='mp3',
+                   max_items=None, max_parallel=BATCH_PARALLEL, session=None, sub_langs=None, auto_subs=False):
+    """Download every entry of a playlist or channel, yielding each result as it finishes
+
+    Entries are enumerated lazily and only max_parallel of them are in
+    flight at once, so results start arriving long before the whole
+    playlist has been listed. The entries share the bandwidth of one session.
+    """
+    options = {'embed_subs': embed_subs, 'embed_thumb': embed_thumb, 'audio_format': audio_format,
+               'sub_langs': sub_langs, 'auto_subs': auto_subs}
+    session = session or secrets.token_hex(8)
+    entries = iter_playlist_entries(url, max_items)
+    with ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix='batch') as executor:
+        in_flight = set()
+        exhausted = False
+        while in_flight or not exhausted:
+            while not exhausted and len(in_flight) < max_parallel:
+                entry = next(entries, None)
+                if entry is None:
+                    exhausted = True
+                    break
+                in_flight.add(executor.submit(_batch_item, entry, quality, options, session))
+            if not in_flight:
+                break
+            finished, in_flight = wait_futures(in_flight, return_when=FIRST_COMPLETED)
+            for future in finished:
+                yield future.result()
+
+
+def parse_languages(value):
+    """Normalize a language list ('en, ms' or ['en-US']) to lowercase codes, dropping duplicates"""
+    if isinstance(value, str):
+        value = value.split(',')
+    languages = []
+    for lang in value or []:
+        lang = lang.strip().replace('_', '-').lower()
+        if lang and lang not in languages:
+            languages.append(lang)
+    return languages
+
+
+def locale_languages(accept_language):
+    """Get the base language codes of an Accept-Language header, most preferred first"""
+    weighted = []
+    for i, item in enumerate((accept_language or '').split(',')):
+        lang, _, params = item.strip().partition(';')
+        quality = 1.0
+        if params.strip().startswith('q='):
+            try:
+                quality = float(params.strip()[2:])
+            except ValueError:
+                continue
+        if lang and lang != '*':
+            weighted.append((-quality, i, lang.split('-')[0]))
+    return parse_languages([lang for _, _, lang in sorted(weighted)])
+
+
+def default_subtitle_languages(info=None, accept_language=None):
+    """Subtitle languages offered for a video: its own language, then the user's locale (or SUBTITLE_LANGS)"""
+    source = [(info or {}).get('language') or '']
+    return parse_languages(source + (locale_languages(accept_language) or SUBTITLE_LANGS))
+
+
+def _match_track(tracks, lang):
+    """Find the track key of a language: exact ('en-us'), else the first regional variant of a base code ('en')"""
+    keys = {key.lower(): key for key in tracks if key != 'live_chat'}
+    if lang in keys:
+        return keys[lang]
+    base = lang.split('-')[0]
+    return next((key for lower, key in keys.items() if lower.split('-')[0] == base), None)
+
+
+def select_subtitles(info, languages=None, auto=False):
+    """Pick the subtitle tracks of a download, returns [{'lang', 'source', 'ext', 'url', 'http_headers'}]
+
+    languages defaults to the video's own language and SUBTITLE_LANGS. An
+    uploaded track is preferred, an auto-generated one is only taken with
+    auto. Without any match the first uploaded track is used, unless
+    languages were asked for explicitly.
+    """
+    manual = info.get('subtitles') or {}
+    generated = (info.get('automatic_captions') or {}) if auto else {}
+    wanted = parse_languages(languages) or default_subtitle_languages(info)
+    
+    picks = []
+    for lang in wanted:
+        for source, tracks in (('manual', manual), ('auto', generated)):
+            key = _match_track(tracks, lang)
+            if key and all(pick[0] != key for pick in picks):
+                picks.append((key, source, tracks[key]))
+                break
+    if not picks and not languages:
+        picks = [(key, 'manual', formats) for key, formats in manual.items() if key != 'live_chat'][:1]
+    
+    selected = []
+    for key, source, formats in picks[:SUBTITLE_MAX_TRACKS]:
+        by_ext = {f.get('ext'): f for f in formats if f.get('url')}
+        ext = next((ext for ext in SUBTITLE_EXTS if ext in by_ext), None)
+        if ext:
+            selected.append({'lang': key, 'source': source, 'ext': ext, 'url': by_ext[ext]['url'],
+                             'http_headers': by_ext[ext].get('http_headers')})
+    return selected
+
+
+def subtitle_lang_args(languages=None, auto=False):
+    """yt-dlp options fetching the subtitles of languages when the tracks are not known up front"""
+    wanted = parse_languages(languages) or SUBTITLE_LANGS
+    args = ['--sub-langs', ','.join(f'(?i){re.escape(lang)}(-.*)?' for lang in wanted)]
+    if auto:
+        args.append('--write-auto-subs')
+    return args
+
+
+@contextlib.contextmanager
+def _open_url(url, http_headers=None, timeout=30, logger=None):
+    """Open url with the network options of the downloads: cookies, proxy, certificate checks, headers
+
+    Goes through yt-dlp's request handlers, or urllib with the same cookies
+    and certificate options where only the yt-dlp executable is installed.
+    """
+    try:
+        import yt_dlp
+        from yt_dlp.networking import Request
+    except ImportError:
+        import http.cookiejar
+        import ssl
+        import urllib.request
+        handlers = [urllib.request.HTTPSHandler(context=ssl._create_unverified_context())]
+        if _cookies_path():
+            jar = http.cookiejar.MozillaCookieJar(_cookies_path())
+            jar.load(ignore_discard=True, ignore_expires=True)
+            handlers.append(urllib.request.HTTPCookieProcessor(jar))
+        headers = dict({'User-Agent': USER_AGENT}, **(http_headers or {}))
+        with urllib.request.build_opener(*handlers).open(urllib.request.Request(url, headers=headers),
+                                                           timeout=timeout) as response:
+            yield response
+        return
+    ydl_opts = dict(yt_dlp.parse_options(_request_args(url)).ydl_opts, quiet=True, socket_timeout=timeout,
+                    logger=logger)
+    with yt_dlp.YoutubeDL(ydl_opts) as ydl, ydl.urlopen(Request(url, headers=http_headers or {})) as response:
+        yield response
+
+
+def _fetch_url(url, path, http_headers=None, timeout=30, bucket=None, logger=None):
+    """Fetch url into path, atomically, returns its content type; bucket is a TokenBucket to read through"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    partial = f"{path}.{secrets.token_hex(4)}.tmp"
+    try:
+        with _open_url(url, http_headers, timeout, logger) as response, open(partial, 'wb') as f:
+            content_type = response.headers.get('Content-Type') or ''
+            while True:
+                chunk = response.read(64 * 1024)
+                if not chunk:
+                    break
+                if bucket:
+                    bucket.consume(len(chunk))
+                f.write(chunk)
+        os.replace(partial, path)
+    finally:
+        with contextlib.suppress(OSError):
+            os.remove(partial)
+    return content_type.split(';')[0].strip().lower()
+
+
+def fetch_to_file(url, path, http_headers=None, timeout=30, retries=FETCH_RETRIES):
+    """Fetch a subtitle, thumbnail or other small file into path, returns its content type
+
+    Runs on an engine worker when the pool is used (for its DNS cache and
+    shared connections) or through yt-dlp in this process, under a lease
+    from the bandwidth governor, and retries with backoff.
+    """
+    category = detect_website(url)['category']
+    with bandwidth_governor.acquire(f'fetch-{secrets.token_hex(6)}', category) as lease:
+        for attempt in range(retries + 1):
+            try:
+                if use_engine_pool():
+                    try:
+                        return _fetch_on_engine(url, path, http_headers, timeout, lease)
+                    except EngineError as e:
+                        log_event('engine_fallback', logging.WARNING, error=str(e))
+                return _fetch_url(url, path, http_headers, timeout, TokenBucket(lease.pin()))
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                log_event('fetch_retry', logging.INFO, url=url, attempt=attempt + 1, error=str(e))
+                time.sleep(2 ** attempt)
+
+
+def _fetch_on_engine(url, path, http_headers, timeout, lease):
+    try:
+        content_type, error = get_engine_pool().call(
+            ('fetch', url, path, http_headers, timeout), timeout=timeout * 4,
+            on_control=lambda send: lease.bind(lambda rate: send(('bandwidth', rate))))
+    finally:
+        lease.bind(None)
+    if error:
+        raise OSError(error)
+    return content_type
+
+
+class SubtitleCache:
+    """Subtitle files on disk keyed by video ID, language and source, aged out after max_age"""
+
+    def __init__(self, root=SUBTITLE_CACHE_DIR, max_age=SUBTITLE_CACHE_MAX_AGE):
+        self.root = root
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self._swept_at = 0.0
+        self._lock = threading.Lock()
+
+    def path(self, video_id, track):
+        digest = hashlib.sha1(video_id.encode()).hexdigest()[:20]
+        return os.path.join(self.root, digest, f"{track['source']}.{track['lang']}.{track['ext']}")
+
+    def get(self, video_id, track):
+        path = self.path(video_id, track)
+        fresh = os.path.exists(path) and time.time() - os.path.getmtime(path) < self.max_age
+        with self._lock:
+            if fresh:
+                self.hits += 1
+            else:
+                self.misses += 1
+        return path if fresh else None
+
+    def put(self, video_id, track, timeout=30):
+        """Fetch a subtitle track into the cache, returns its path"""
+        path = self.path(video_id, track)
+        fetch_to_file(track['url'], path, track.get('http_headers'), timeout)
+        if time.monotonic() - self._swept_at > SPOOL_JANITOR_INTERVAL * 60:
+            self._swept_at = time.monotonic()
+            self.sweep()
+        return path
+
+    def sweep(self):
+        """Delete subtitle files older than max_age"""
+        cutoff = time.time() - self.max_age
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                with contextlib.suppress(OSError):
+                    if os.path.getmtime(os.path.join(dirpath, name)) < cutoff:
+                        os.remove(os.path.join(dirpath, name))
+
+
+subtitle_cache = SubtitleCache()
+_part_executor = ThreadPoolExecutor(max_workers=SUBTITLE_PARALLEL, thread_name_prefix='parts')
+
+
+def fetch_subtitle(video_id, track, timeout=30):
+    """Get one subtitle track through the subtitle cache, returns its path"""
+    return subtitle_cache.get(video_id, track) or subtitle_cache.put(video_id, track, timeout)
+
+
+def _resize_image(source, dest_base, width):
+    """Downsize an image to width (never upscaling) as WebP, or JPEG without WebP support
+
+    Returns the written path, or None when Pillow is not installed.
+    """
+    try:
+        from PIL import Image, features
+    except ImportError:
+        return None
+    ext = 'webp' if features.check('webp') else 'jpg'
+    dest = f"{dest_base}.{ext}"
+    partial = f"{dest}.{secrets.token_hex(4)}.tmp"
+    with Image.open(source) as image:
+        image.thumbnail((width, width * 4))
+        if ext == 'jpg' and image.mode not in ('RGB', 'L'):
+            image = image.convert('RGB')
+        image.save(partial, 'WEBP' if ext == 'webp' else 'JPEG', quality=80)
+    os.replace(partial, dest)
+    return dest
+
+
+class ThumbnailCache:
+    """Thumbnails on disk keyed by video ID, the fetched original and its downsized copies, LRU within max_bytes"""
+
+    def __init__(self, root=THUMBNAIL_CACHE_DIR, max_bytes=THUMBNAIL_CACHE_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index = None  # entry -> {'size', 'accessed'}, loaded lazily from disk
+        self._fetching = {}  # entry -> Lock, so concurrent requests fetch a thumbnail once
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def entry(video_id):
+        return hashlib.sha1(video_id.encode()).hexdigest()[:20]
+
+    def _load_index(self):
+        if self._index is not None:
+            return self._index
+        self._index = {}
+        os.makedirs(self.root, exist_ok=True)
+        for item in os.scandir(self.root):
+            if item.is_dir():
+                self._index[item.name] = {'size': _dir_size(item.path), 'accessed': item.stat().st_mtime}
+        return self._index
+
+    def _touch(self, entry):
+        """Mark an entry used now (the directory mtime keeps the order across restarts) and account its size"""
+        path = os.path.join(self.root, entry)
+        now = time.time()
+        with contextlib.suppress(OSError):
+            os.utime(path, (now, now))
+        with self._lock:
+            self._load_index()[entry] = {'size': _dir_size(path), 'accessed': now}
+            self._evict(keep=entry)
+
+    def _evict(self, keep=None):
+        index = self._index
+        total = sum(meta['size'] for meta in index.values())
+        for entry in sorted(index, key=lambda e: index[e]['accessed']):
+            if total <= self.max_bytes:
+                break
+            if entry == keep:
+                continue
+            total -= index.pop(entry)['size']
+            shutil.rmtree(os.path.join(self.root, entry), ignore_errors=True)
+            self.evictions += 1
+
+    def _find(self, directory, stem):
+        with contextlib.suppress(OSError):
+            for name in os.listdir(directory):
+                if name.rsplit('.', 1)[0] == stem and name.rsplit('.', 1)[-1] in THUMBNAIL_MIMES:
+                    return os.path.join(directory, name)
+        return None
+
+    def original(self, video_id, url, http_headers=None, timeout=30):
+        """Get the full-size thumbnail of a video, fetching it on the first request, returns its path"""
+        entry = self.entry(video_id)
+        directory = os.path.join(self.root, entry)
+        with self._lock:
+            fetch_lock = self._fetching.setdefault(entry, threading.Lock())
+        with fetch_lock:
+            path = self._find(directory, 'original')
+            if path:
+                self.hits += 1
+                self._touch(entry)
+                return path
+            self.misses += 1
+            try:
+                path = self._fetch(directory, url, http_headers, timeout)
+            finally:
+                with self._lock:
+                    self._fetching.pop(entry, None)
+        self._touch(entry)
+        return path
+
+    def _fetch(self, directory, url, http_headers, timeout):
+        # The extension comes from the content type, so fetch under a neutral name first
+        fetched = os.path.join(directory, 'original.fetched')
+        content_type = fetch_to_file(url, fetched, http_headers, timeout)
+        ext = next((ext for ext, mime in THUMBNAIL_MIMES.items() if mime == content_type), None)
+        ext = ext or urlsplit(url).path.rsplit('.', 1)[-1].lower()
+        path = os.path.join(directory, f"original.{ext if ext in THUMBNAIL_MIMES else 'jpg'}")
+        os.replace(fetched, path)
+        return path
+
+    def resized(self, video_id, url, width=THUMBNAIL_WIDTH, http_headers=None):
+        """Get the thumbnail of a video downsized to width, the original when Pillow is not installed"""
+        entry = self.entry(video_id)
+        path = self._find(os.path.join(self.root, entry), f'w{width}')
+        if path:
+            self.hits += 1
+            self._touch(entry)
+            return path
+        original = self.original(video_id, url, http_headers)
+        path = _resize_image(original, os.path.join(self.root, entry, f'w{width}'), width)
+        if not path:
+            return original
+        self._touch(entry)
+        return path
+
+    def stats(self):
+        """Get hit/miss counters and disk usage"""
+        with self._lock:
+            index = self._load_index()
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(index),
+                'bytes': sum(meta['size'] for meta in index.values()),
+                'max_bytes': self.max_bytes,
+            }
+
+
+thumbnail_cache = ThumbnailCache()
+
+
+def get_thumbnail(info, width=THUMBNAIL_WIDTH):
+    """Get a local copy of a video's thumbnail (from get_video_info) downsized to width
+
+    Falls back to the remote URL when the thumbnail cannot be fetched, or
+    returns None for videos without one.
+    """
+    url = info.get('thumbnail')
+    if not url or not info.get('video_id'):
+        return url or None
+    try:
+        return thumbnail_cache.resized(info['video_id'], url, width)
+    except Exception as e:
+        log_event('thumbnail_failed', logging.WARNING, url=url, error=str(e))
+        return url
+
+
+def fetch_thumbnail(video_id, url):
+    """Get the full-size thumbnail of a video for embedding, through the thumbnail cache"""
+    return thumbnail_cache.original(video_id, url)
+
+
+def _start_part_fetches(plan):
+    """Start fetching the planned subtitle tracks and thumbnail in parallel, alongside the video download"""
+    pp = plan['postprocess'] or {}
+    if 'part_fetches' in plan:
+        return
+    fetches = [('subtitles', f"subtitle.{track['lang']}.{track['ext']}", track['lang'],
+                _part_executor.submit(fetch_subtitle, plan['video_id'], track))
+               for track in pp.get('subtitles') or []]
+    if pp.get('thumbnail'):
+        fetches.append(('thumbnail', 'cover', pp['thumbnail'],
+                        _part_executor.submit(fetch_thumbnail, plan['video_id'], pp['thumbnail'])))
+    plan['part_fetches'] = fetches
+
+
+def _collect_part_fetches(plan):
+    """Wait for the subtitle and thumbnail fetches and link them into the job's parts for the mux"""
+    for kind, name, source, future in plan.get('part_fetches') or []:
+        part_dir = os.path.join(plan['temp_dir'], PARTS_DIR, kind)
+        try:
+            path = future.result()
+        except Exception as e:
+            log_event(f'{kind}_failed', logging.WARNING, url=plan['url'], source=source, error=str(e))
+            if kind == 'subtitles':
+                track = next(t for t in plan['postprocess']['subtitles'] if t['lang'] == source)
+                _subtitle_with_yt_dlp(plan, track, part_dir)
+            continue
+        if kind == 'thumbnail':
+            name = f"{name}.{path.rsplit('.', 1)[-1]}"
+        os.makedirs(part_dir, exist_ok=True)
+        if not os.path.exists(os.path.join(part_dir, name)):
+            _link_or_copy(path, os.path.join(part_dir, name))
+
+
+def _subtitle_with_yt_dlp(plan, track, part_dir):
+    """Let yt-dlp fetch a subtitle track the direct fetch failed on, into the job's parts"""
+    args = ['--skip-download', '--write-auto-subs' if track['source'] == 'auto' else '--write-subs',
+            '--sub-langs', re.escape(track['lang']), '--sub-format', track['ext'],
+            '-o', 'subtitle:' + os.path.join(part_dir, 'subtitle.%(ext)s')] + _request_args(plan['url'])
+    with _info_json_file(plan['info']) as info_path:
+        output_log = run_yt_dlp(args + ['--load-info-json', info_path])
+    if not os.path.exists(os.path.join(part_dir, f"subtitle.{track['lang']}.{track['ext']}")):
+        log_event('subtitles_dropped', logging.WARNING, url=plan['url'], source=track['lang'],
+                  error=''.join(output_log)[-500:])
+
+
+def _plan_download(url, quality, embed_subs=False, embed_thumb=False, audio_format='mp3', custom_filename=None,
+                   temp_dir=None, sub_langs=None, auto_subs=False):
+    """Build the yt-dlp arguments, job directory and cache keys of a download, returns (plan, error)
+
+    Pass the temp_dir of an interrupted attempt to resume its partial files.
+    """
+    resumed = bool(temp_dir)
+    temp_dir = spool.resume(temp_dir) if resumed else spool.create_job()
+    try:
+        return _plan_in(temp_dir, url, quality, embed_subs, embed_thumb, audio_format, custom_filename,
+                        sub_langs, auto_subs)
+    except BaseException:
+        # Without a plan the caller cannot close the job: a new directory would stay 'active' for good
+        if not resumed:
+            spool.release(temp_dir)
+        raise
+
+
+def _plan_in(temp_dir, url, quality, embed_subs, embed_thumb, audio_format, custom_filename, sub_langs, auto_subs):
+    """Plan a download into the job directory temp_dir (see _plan_download)"""
+    ffmpeg_path = get_executable_path('ffmpeg')
+    
+    # Handle custom filename
+    if custom_filename:
+        # Sanitize filename
+        custom_filename = re.sub(r'[\\/*?:"<>|]', "", custom_filename)
+        output_template = f"{custom_filename}.%(ext)s"
+    else:
+        output_template = '%(title)s.%(ext)s'
+        
+    output_path = os.path.join(temp_dir, output_template)
+    
+    # Clean URL - remove list parameter to avoid playlist issues
+    url = re.sub(r'&list=[^&]*', '', url)
+    
+    # Validate YouTube URL
+    youtube_match = re.search(r'v=([\w-]{11})', url)
+    if youtube_match:
+        video_id = youtube_match.group(1)
+        if len(video_id) < 11:
+            spool.release(temp_dir)
+            return None, f"Invalid YouTube ID: '{video_id}' (length: {len(video_id)}). YouTube IDs must be 11 characters long."
+    
+    # Build quality format; '<=?' keeps formats of unknown height (e.g. direct files) eligible
+    height = _quality_height(quality)
+    if quality == 'Audio Only':
+        fmt = 'bestaudio/best'
+    elif height:
+        fmt = f'bestvideo[height<=?{height}]+bestaudio/best[height<=?{height}]'
+    else:
+        fmt = 'bestvideo+bestaudio/best'
+    
+    # Prefer the ranked pick from the extracted formats; the preset still
+    # applies when a fresh extraction hands out different format IDs
+    info = info_cache.get(url)
+    selected = select_formats(info, quality, audio_format)
+    if selected:
+        fmt = '+'.join(f['format_id'] for f in selected) + '/' + fmt
+    
+    # Build yt-dlp arguments
+    cmd = [
+        '-f', fmt,
+        '-o', output_path,
+        '--merge-output-format', MERGE_CONTAINER,
+        '--newline',
+        '--progress-template', f'download:{PROGRESS_TEMPLATE}',
+    ] + _request_args(url)
+    
+    # Force mp4 extension for video downloads unless custom filename is used
+    if not custom_filename and quality != 'Audio Only':
+        cmd.extend(['--remux-video', 'mp4'])
+    
+    # Add Subtitles, only the chosen tracks
+    subtitles = select_subtitles(info, sub_langs, auto_subs) if embed_subs and info else None
+    if subtitles:
+        cmd.extend(['--embed-subs', '--write-subs', '--sub-langs', ','.join(re.escape(track['lang']) for track in subtitles)])
+        if any(track['source'] == 'auto' for track in subtitles):
+            cmd.append('--write-auto-subs')
+    elif embed_subs and info is None:
+        cmd.extend(['--embed-subs', '--write-subs'] + subtitle_lang_args(sub_langs, auto_subs))
+        
+    # Add Thumbnail
+    if embed_thumb:
+        cmd.extend(['--embed-thumbnail'])
+    
+    # Add fragment concurrency and external downloader for this site
+    cmd.extend(downloader_args(url))
+    
+    # Add ffmpeg location if needed
+    if ffmpeg_path != 'ffmpeg':
+        cmd.extend(['--ffmpeg-location', os.path.dirname(ffmpeg_path)])
+    
+    # Add audio-only options
+    if quality == 'Audio Only':
+        cmd.extend(['-x', '--audio-format', audio_format])
+    
+    # Identify the finished file for the file cache
+    video_id = (info and info_video_id(info)) or url_video_id(url) or canonical_url(url)
+    cache_key = file_cache.key(video_id, fmt, {
+        'audio_format': audio_format if quality == 'Audio Only' else None,
+        'embed_subs': bool(embed_subs),
+        'sub_langs': [(track['lang'], track['source']) for track in subtitles] if subtitles else
+                     (parse_languages(sub_langs), bool(auto_subs)) if embed_subs else None,
+        'embed_thumb': bool(embed_thumb),
+        'remux': not custom_filename and quality != 'Audio Only',
+    })
+
+    # Download the parts unmerged for one ffmpeg pass (needs the formats up front)
+    postprocess = None
+    if SINGLE_PASS and selected and quality != 'Audio Only' and get_capabilities()['ffmpeg_version']:
+        parts_dir = os.path.join(temp_dir, PARTS_DIR)
+        single_pass_cmd = [
+            '-f', ','.join(f['format_id'] for f in selected),
+            '-o', os.path.join(parts_dir, '%(format_id)s', output_template),
+            '--fixup', 'never',
+            '--newline',
+            '--progress-template', f'download:{PROGRESS_TEMPLATE}',
+        ] + _request_args(url)
+        # Subtitles and the thumbnail are fetched by _start_part_fetches, in parallel and through the caches
+        if embed_thumb and not info.get('thumbnail'):
+            single_pass_cmd.extend(['--write-thumbnail',
+                                    '-o', 'thumbnail:' + os.path.join(parts_dir, 'thumbnail', output_template)])
+        single_pass_cmd.extend(downloader_args(url))
+        if ffmpeg_path != 'ffmpeg':
+            single_pass_cmd.extend(['--ffmpeg-location', os.path.dirname(ffmpeg_path)])
+        postprocess = {
+            'args': single_pass_cmd,
+            'formats': selected,
+            'remux': not custom_filename,
+            'subtitles': subtitles,
+            'thumbnail': info.get('thumbnail') if embed_thumb else None,
+        }
+
+    return {
+        'url': url,
+        'args': cmd,
+        'temp_dir': temp_dir,
+        'custom_filename': custom_filename,
+        'info': info,
+        'video_id': video_id,
+        'cache_key': cache_key,
+        'postprocess': postprocess,
+    }, None
+
+
+USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36'
+
+
+def _cookies_path():
+    """Get the cookies.txt next to the app directory, None when there is none"""
+    cookies_path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'cookies.txt')
+    return cookies_path if os.path.exists(cookies_path) else None
+
+
+def _request_args(url):
+    """yt-dlp network options shared by file downloads and streams"""
+    args = [
+        '--no-playlist',
+        '--force-ipv4',  # Force IPv4 to avoid IPv6 DNS issues
+        '--no-check-certificates', # Avoid SSL certificate issues
+        '--socket-timeout', '30',
+        '--extractor-args', 'generic:impersonate',
+        '--user-agent', USER_AGENT
+    ]
+    
+    # Check for cookies file
+    cookies_path = _cookies_path()
+    if cookies_path:
+        args.extend(['--cookies', cookies_path])
+    
+    # Add smart headers for video hosts
+    referer = get_video_host_referer(url)
+    if referer:
+        args.extend(['--referer', referer])
+        args.extend(['--add-header', f'Origin: {referer.rstrip("/")}'])
+    return args
+
+
+def _run_download(url, quality, embed_subs=False, embed_thumb=False, audio_format='mp3', custom_filename=None,
+                  progress_callback=None, temp_dir=None, keep_partial=False, lease=None, sub_langs=None, auto_subs=False,
+                  spool_wait=SPOOL_WAIT):
+    """Download video using yt-dlp, reporting raw output lines to progress_callback
+
+    With keep_partial a failed download leaves its partial files in
+    temp_dir for a retry, which the caller then resumes or releases.
+    lease is the job's BandwidthLease, if any. With spool_wait=0 a job
+    that has to wait for disk room raises SpoolBusyError instead, so the
+    caller can queue it again without holding a slot.
+    """
+    plan = file_path = None
+    try:
+        plan, error = _plan_download(url, quality, embed_subs, embed_thumb, audio_format, custom_filename, temp_dir,
+                                     sub_langs, auto_subs)
+        if error:
+            return None, error
+        
+        # Serve repeat requests straight from the finished-file cache
+        file_path = file_cache.get(plan['cache_key'], plan['temp_dir'], plan['custom_filename'])
+        if file_path:
+            return file_path, None
+        
+        # Wait for (or refuse when there is no) disk room for the expected size
+        spool.admit(plan['temp_dir'], estimate_download_size(plan['info'], quality), spool_wait)
+        
+        # Start from the info extracted by "Analisis" instead of extracting again
+        if plan['info']:
+            _start_part_fetches(plan)
+            with _info_json_file(plan['info']) as info_path:
+                if plan['postprocess']:
+                    output_log = run_yt_dlp(plan['postprocess']['args'] + ['--load-info-json', info_path], progress_callback, lease)
+                else:
+                    output_log = run_yt_dlp(plan['args'] + ['--load-info-json', info_path], progress_callback, lease)
+            file_path = _mux_parts(plan, progress_callback) if plan['postprocess'] else _take_output(plan)
+            if file_path:
+                return file_path, None
+            full_error = "".join(output_log)
+            if keep_partial and is_retryable(full_error):
+                # A dropped connection, not stale URLs: let the retry resume the partial files
+                return None, f"No file downloaded. Log: {full_error}"
+            # The cached format URLs were rejected, extract afresh
+            info_cache.invalidate(plan['url'])
+        
+        output_log = run_yt_dlp(plan['args'] + [plan['url']], progress_callback, lease)
+        
+        file_path = _take_output(plan)
+        if file_path:
+            return file_path, None
+            
+        full_error = "".join(output_log)
+        return None, f"No file downloaded. Log: {full_error}"
+        
+    except SpoolBusyError:
+        if not spool_wait:
+            raise
+        return None, "Server disk is full, please try again later"
+    except Exception as e:
+        return None, str(e)
+    finally:
+        if plan:
+            _close_job(plan, file_path, keep_partial)
+
+
+def _close_job(plan, file_path, keep_partial=False):
+    """Keep the job directory of a finished (or, with keep_partial, a resumable) download, delete it otherwise"""
+    if file_path:
+        spool.finish(plan['temp_dir'])
+    elif keep_partial:
+        spool.pause(plan['temp_dir'])
+    else:
+        spool.release(plan['temp_dir'])
+
+
+@contextlib.contextmanager
+def _info_json_file(info):
+    """Write an info dict to a temporary --load-info-json file"""
+    if info is None:
+        yield None
+        return
+    fd, info_path = tempfile.mkstemp(suffix='.info.json')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(info, f)
+        yield info_path
+    finally:
+        os.remove(info_path)
+
+
+def _take_output(plan):
+    """Find the finished file of a download and publish it to the file cache
+
+    Returns None when yt-dlp did not produce a complete file, leaving only
+    partial downloads (which the next attempt resumes) in the job directory.
+    """
+    files = [f for f in Path(plan['temp_dir']).iterdir() if f.is_file()]
+    finished = [f for f in files if not PARTIAL_FILE.search(f.name)]
+    if finished and len(finished) == len(files):
+        shutil.rmtree(os.path.join(plan['temp_dir'], PARTS_DIR), ignore_errors=True)
+        file_path = str(finished[0])
+        file_cache.put(plan['cache_key'], file_path)
+        return file_path
+    
+    for f in finished:
+        f.unlink()
+    return None
+
+
+def _part_files(directory):
+    """Finished files in a parts directory, sorted by name"""
+    if not os.path.isdir(directory):
+        return []
+    return sorted(str(f) for f in Path(directory).iterdir()
+                  if f.is_file() and not PARTIAL_FILE.search(f.name))
+
+
+def _iso639_2(lang):
+    """Three-letter language code for container metadata, as yt-dlp's EmbedSubtitle writes it"""
+    try:
+        from yt_dlp.utils import ISO639Utils
+    except ImportError:
+        return lang
+    return ISO639Utils.short2long(lang) or lang
+
+
+def _plan_mux(plan):
+    """Build the single ffmpeg pass over a job's downloaded parts
+
+    Returns None when a stream is missing, otherwise a dict with the
+    ffmpeg command (None when moving the only stream is enough), the
+    output path and the number of rewrites yt-dlp would have chained.
+    """
+    pp = plan['postprocess']
+    parts_dir = os.path.join(plan['temp_dir'], PARTS_DIR)
+    media = []
+    for f in pp['formats']:
+        files = _part_files(os.path.join(parts_dir, f['format_id']))
+        if len(files) != 1:
+            return None
+        media.append(files[0])
+
+    source = Path(media[0])
+    ext = source.suffix[1:].lower()
+    container = MERGE_CONTAINER if len(media) > 1 or pp['remux'] else ext
+    output = os.path.join(plan['temp_dir'], f"{source.stem}.{container}")
+
+    subtitles = [s for s in _part_files(os.path.join(parts_dir, 'subtitles'))
+                 if s.rsplit('.', 1)[-1].lower() in SUBTITLE_EXTS]
+    thumbnails = [t for t in _part_files(os.path.join(parts_dir, 'thumbnail'))
+                  if t.rsplit('.', 1)[-1].lower() in THUMBNAIL_MIMES]
+    if subtitles and container not in SUBTITLE_CODECS:
+        log_event('postprocess_skipped', logging.WARNING, url=plan['url'], item='subtitles', container=container)
+        subtitles = []
+    cover = 'attached_pic' if container in ('mp4', 'm4v', 'mov') else 'attachment' if container == 'mkv' else None
+    if thumbnails and not cover:
+        log_event('postprocess_skipped', logging.WARNING, url=plan['url'], item='thumbnail', container=container)
+        thumbnails = []
+
+    # The rewrites of the full file yt-dlp would chain: Merger, FixupM3u8 on a single
+    # HLS download, VideoRemuxer, EmbedSubtitle and EmbedThumbnail
+    single = len(media) == 1
+    passes = sum((not single,
+                  single and (pp['formats'][0].get('protocol') or '').startswith('m3u8'),
+                  single and ext != container,
+                  bool(subtitles),
+                  bool(thumbnails)))
+    mux = {'source': str(source), 'output': output, 'passes': passes, 'cmd': None,
+           'read': sum(os.path.getsize(path) for path in media + subtitles + thumbnails[:1])}
+    if not passes:
+        return mux
+
+    inputs = media + subtitles
+    maps, options, video_streams = [], ['-dn', '-ignore_unknown', '-c', 'copy'], 0
+    for i, f in enumerate(pp['formats']):
+        if f.get('vcodec') != 'none':
+            maps.extend(['-map', f'{i}:v:0?'])
+            video_streams += 1
+        if f.get('acodec') != 'none':
+            maps.extend(['-map', f'{i}:a?'])
+
+    for i, path in enumerate(subtitles):
+        maps.extend(['-map', f'{len(media) + i}:s:0'])
+        name = Path(path).name.rsplit('.', 2)
+        if len(name) == 3:
+            options.extend([f'-metadata:s:s:{i}', f'language={_iso639_2(name[1])}'])
+    if subtitles:
+        options.extend(['-c:s', SUBTITLE_CODECS[container]])
+
+    if thumbnails:
+        thumbnail = thumbnails[0]
+        thumb_ext = thumbnail.rsplit('.', 1)[-1].lower()
+        if cover == 'attached_pic':
+            # The cover goes after the video streams; MP4 covers must be JPEG or PNG
+            maps.extend(['-map', f'{len(inputs)}:v:0'])
+            inputs.append(thumbnail)
+            options.extend([f'-c:v:{video_streams}', 'copy' if thumb_ext in ('jpg', 'jpeg', 'png') else 'mjpeg',
+                            f'-disposition:v:{video_streams}', 'attached_pic'])
+        else:
+            options.extend(['-attach', thumbnail, '-metadata:s:t', f'mimetype={THUMBNAIL_MIMES[thumb_ext]}',
+                            '-metadata:s:t', f'filename=cover.{thumb_ext}'])
+    if container in ('mp4', 'm4v', 'mov'):
+        options.extend(['-movflags', '+faststart'])
+
+    cmd = [get_executable_path('ffmpeg'), '-hide_banner', '-nostdin', '-loglevel', 'error', '-y']
+    for path in inputs:
+        cmd.extend(['-i', path])
+    mux['cmd'] = cmd + maps + options + [output]
+    return mux
+
+
+def _finish_mux(plan, mux, error=None, seconds=0.0):
+    """Move or check the muxed output, drop the parts and report the I/O saved"""
+    if mux is None:
+        # The download is incomplete: keep the partial streams for a retry to resume
+        return None
+    if not error and mux['cmd'] is None:
+        os.replace(mux['source'], mux['output'])
+    shutil.rmtree(os.path.join(plan['temp_dir'], PARTS_DIR), ignore_errors=True)
+    if error:
+        log_event('postprocess_failed', logging.WARNING, url=plan['url'], error=error[-500:])
+        if os.path.exists(mux['output']):
+            os.remove(mux['output'])
+        return None
+
+    # yt-dlp's first rewrite reads the parts and writes the file, like the single
+    # pass; every further one reads and writes the whole file again
+    written = os.path.getsize(mux['output'])
+    saved = max(mux['passes'] - 1, 0) * 2 * written
+    postprocess_saved_bytes_total.inc(saved)
+    log_event('postprocess', url=plan['url'], passes_replaced=mux['passes'],
+              bytes_read=mux['read'] if mux['cmd'] else 0, bytes_written=written if mux['cmd'] else 0,
+              io_saved_bytes=saved, seconds=round(seconds, 3))
+    return _take_output(plan)
+
+
+def _mux_line(mux):
+    return f'[Postprocess] Writing "{mux["output"]}" in one pass, replacing {mux["passes"]} rewrites\n'
+
+
+def _mux_parts(plan, progress_callback=None):
+    """Run the single post-processing pass of a job, returns the finished file or None"""
+    _collect_part_fetches(plan)
+    mux = _plan_mux(plan)
+    error = None
+    started = time.monotonic()
+    if mux and mux['cmd']:
+        if progress_callback:
+            progress_callback(_mux_line(mux))
+        result = subprocess.run(mux['cmd'], capture_output=True, text=True, **_new_process_group())
+        if result.returncode:
+            error = result.stderr or f"ffmpeg exited with status {result.returncode}"
+    return _finish_mux(plan, mux, error, time.monotonic() - started)
+
+
+def _new_process_group():
+    """Popen options that put a child in its own process group"""
+    if sys.platform.startswith('win'):
+        return {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+    return {'start_new_session': True}
+
+
+def _kill_process_tree(process):
+    """Kill a yt-dlp process together with the ffmpeg children it started"""
+    if process.returncode is not None:
+        return
+    try:
+        if sys.platform.startswith('win'):
+            subprocess.run(['taskkill', '/F', '/T', '/PID', str(process.pid)], capture_output=True)
+        else:
+            os.killpg(process.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+@contextlib.asynccontextmanager
+async def _async_download_slot(url):
+    """Hold one of the DownloadManager's own slots, so async downloads share its global and per-host limits"""
+    manager = get_download_manager()
+    acquiring = asyncio.ensure_future(asyncio.to_thread(manager.acquire_slot, url))
+    try:
+        host = await asyncio.shield(acquiring)
+    except asyncio.CancelledError:
+        # The thread still gets the slot eventually: hand it back then
+        acquiring.add_done_callback(lambda done: done.cancelled() or done.exception() or manager.release_slot(done.result()))
+        raise
+    try:
+        yield
+    finally:
+        manager.release_slot(host)
+
+
+async def _aiter_yt_dlp(args, rate=None):
+    """Run yt-dlp as an asyncio subprocess limited to rate bytes/s, yielding its output lines"""
+    cmd = _yt_dlp_command() + _rate_limited(args, rate)
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        limit=1024 * 1024,
+        **_new_process_group()
+    )
+    try:
+        async for raw_line in process.stdout:
+            yield raw_line.decode('utf-8', 'replace')
+        await process.wait()
+    finally:
+        # Cancelled or abandoned: take ffmpeg down with yt-dlp
+        _kill_process_tree(process)
+
+
+async def aget_video_info(url, timeout=60):
+    """Async variant of get_video_info"""
+    started = time.monotonic()
+    try:
+        info = info_cache.get(url)
+        if info is None:
+            cmd = _yt_dlp_command() + ['--dump-json'] + INFO_ARGS + [url]
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.PIPE,
+                **_new_process_group()
+            )
+            try:
+                stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+            finally:
+                _kill_process_tree(process)
+            
+            if process.returncode != 0:
+                error = stderr.decode('utf-8', 'replace')
+                _record_extraction(url, started, 'extract', error)
+                return None, error
+            info = json.loads(stdout)
+            info_cache.put(url, info)
+            _record_extraction(url, started, 'extract')
+        else:
+            _record_extraction(url, started, 'cache')
+        
+        return summarize_info(info), None
+    except asyncio.TimeoutError:
+        return None, f"Timed out after {timeout} seconds"
+    except Exception as e:
+        return None, str(e)
+
+
+class AsyncDownload:
+    """Async iterator over the ProgressEvents of one download
+
+    file_path and error are set once iteration ends. Cancelling the task
+    that iterates kills yt-dlp together with its ffmpeg children. Transient
+    failures are retried in place (yielding a 'retrying' event) and the job
+    is recorded in the JobStore meanwhile, so a restart resumes it.
+    """
+
+    def __init__(self, url, quality, embed_subs=False, embed_thumb=False, audio_format='mp3',
+                 custom_filename=None, interval=PROGRESS_INTERVAL, session=None, sub_langs=None, auto_subs=False):
+        self.url = url
+        self.session = session
+        self.options = download_options(quality, embed_subs, embed_thumb, audio_format, custom_filename, sub_langs, auto_subs)
+        self.interval = interval
+        self.file_path = None
+        self.error = None
+        self.log = deque(maxlen=LOG_LINES)
+        self.id = secrets.token_hex(8)
+        self.attempts = 0
+
+    def __aiter__(self):
+        return self._events()
+
+    def _record(self, plan, status='running', not_before=None):
+        return {'id': self.id, 'url': self.url, 'options': self.options, 'temp_dir': plan['temp_dir'],
+                'status': status, 'attempts': self.attempts, 'next_attempt_at': not_before}
+
+    async def _events(self):
+        # Take over a job the DownloadManager resumed after a restart, with its partial files
+        resumed = _download_manager.take_resumed(self.url, self.options) if _download_manager else None
+        if resumed:
+            self.id, self.attempts = resumed.id, resumed.attempts
+        plan, error = _plan_download(self.url, temp_dir=resumed and resumed.temp_dir, **self.options)
+        if error:
+            self.error = error
+            yield ProgressEvent(phase='failed', line=error)
+            return
+        
+        host = download_host_key(plan['url'])[0]
+        self._timer = PhaseTimer(plan['url'], job_id=self.id)
+        try:
+            job_store.save(self._record(plan))
+            while True:
+                # Close the inner generator first so yt-dlp is dead before its directory goes
+                async with contextlib.aclosing(self._download(plan, host)) as events:
+                    async for event in events:
+                        yield event
+                if self.file_path or self.attempts >= RETRY_ATTEMPTS or not is_retryable(self.error):
+                    break
+                delay = host_backoff.failed(host)
+                self.attempts += 1
+                job_store.save(self._record(plan, 'retrying', time.time() + delay))
+                retries_total.inc(category=self._timer.category)
+                log_event('job_retrying', logging.WARNING, job=self.id, url=self.url, host=host,
+                          attempt=self.attempts, delay=round(delay, 1), error=self.error[-300:])
+                yield ProgressEvent(
+                    phase='retrying',
+                    line=f"Connection problem, retrying in {delay:.0f}s (attempt {self.attempts + 1} of {RETRY_ATTEMPTS + 1})")
+                await asyncio.sleep(delay)
+                self.error = None
+                self.log.clear()
+            
+            if self.file_path:
+                host_backoff.succeeded(host)
+                yield ProgressEvent(phase='finished', line=os.path.basename(self.file_path))
+            else:
+                yield ProgressEvent(phase='failed', line=self.error)
+        finally:
+            self._timer.finish('done' if self.file_path else 'failed' if self.error else 'cancelled', self.error)
+            job_store.delete(self.id)
+            _close_job(plan, self.file_path)
+
+    async def _download(self, plan, host):
+        """Run one attempt, yielding its progress; sets file_path, or error when it failed"""
+        cached_path = file_cache.get(plan['cache_key'], plan['temp_dir'], plan['custom_filename'])
+        if cached_path:
+            self._timer.start()
+            self.file_path = cached_path
+            return
+        
+        try:
+            expected = estimate_download_size(plan['info'], self.options['quality'])
+            await asyncio.to_thread(spool.admit, plan['temp_dir'], expected)
+        except SpoolFullError as e:
+            self.error = str(e)
+            return
+        
+        if plan['info']:
+            _start_part_fetches(plan)
+        
+        # Another download of the host may have failed since ours did
+        wait = host_backoff.retry_at(host) - time.time()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        
+        ready = deque()
+        throttle = ProgressThrottle(ready.append, self.interval)
+        event = ProgressEvent()
+        async with _async_download_slot(plan['url']):
+            with bandwidth_governor.acquire(self.id, self._timer.category, self.session) as lease:
+                if not self.attempts:
+                    self._timer.start()
+                # Cached info first (skips extraction), then a fresh extraction
+                for info in ([plan['info']] if plan['info'] else []) + [None]:
+                    single_pass = info is not None and plan['postprocess']
+                    with _info_json_file(info) as info_path:
+                        if info_path:
+                            args = (plan['postprocess'] if single_pass else plan)['args'] + ['--load-info-json', info_path]
+                        else:
+                            args = plan['args'] + [plan['url']]
+                        async with contextlib.aclosing(_aiter_yt_dlp(args, lease.pin())) as lines:
+                            async for line in lines:
+                                self.log.append(line)
+                                event = parse_progress_line(line, event)
+                                event.bandwidth = lease.rate
+                                if event.phase == 'download':
+                                    lease.observe(event.speed)
+                                self._timer(event)
+                                throttle(event)
+                                while ready:
+                                    yield ready.popleft()
+                    if single_pass:
+                        async with contextlib.aclosing(self._mux(plan)) as lines:
+                            async for line in lines:
+                                event = parse_progress_line(line, event)
+                                self._timer(event)
+                                throttle(event)
+                                while ready:
+                                    yield ready.popleft()
+                    else:
+                        self.file_path = _take_output(plan)
+                    if self.file_path or is_retryable(''.join(self.log)):
+                        # A dropped connection is retried with the partial files instead of a fresh extraction
+                        break
+                    if info:
+                        info_cache.invalidate(plan['url'])
+        
+        throttle.flush()
+        while ready:
+            yield ready.popleft()
+        
+        if not self.file_path:
+            self.error = f"No file downloaded. Log: {''.join(self.log)}"
+
+    async def _mux(self, plan):
+        """Run the single post-processing pass as an asyncio subprocess, yielding its progress line"""
+        await asyncio.to_thread(_collect_part_fetches, plan)
+        mux = _plan_mux(plan)
+        error = None
+        started = time.monotonic()
+        if mux and mux['cmd']:
+            yield _mux_line(mux)
+            process = await asyncio.create_subprocess_exec(
+                *mux['cmd'],
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE,
+                **_new_process_group()
+            )
+            try:
+                _, stderr = await process.communicate()
+            finally:
+                _kill_process_tree(process)
+            if process.returncode:
+                error = stderr.decode('utf-8', 'replace') or f"ffmpeg exited with status {process.returncode}"
+        self.file_path = _finish_mux(plan, mux, error, time.monotonic() - started)
+
+
+async def adownload_video(url, quality, embed_subs=False, embed_thumb=False, audio_format='mp3', custom_filename=None, progress_callback=None,
+                          session=None, sub_langs=None, auto_subs=False):
+    """Async variant of download_video
+
+    progress_callback may be a plain function or a coroutine function.
+    """
+    if queue_enabled():
+        return await _await_queued_download(url, quality, embed_subs, embed_thumb, audio_format, custom_filename,
+                                            progress_callback, session, sub_langs, auto_subs)
+    download = AsyncDownload(url, quality, embed_subs, embed_thumb, audio_format, custom_filename, session=session,
+                             sub_langs=sub_langs, auto_subs=auto_subs)
+    async for event in download:
+        if progress_callback:
+            result = progress_callback(event)
+            if inspect.isawaitable(result):
+                await result
+    return download.file_path, download.error
+
+
+async def _await_queued_download(url, quality, embed_subs, embed_thumb, audio_format, custom_filename,
+                                 progress_callback, session, sub_langs, auto_subs):
+    """Submit a download to the queue workers and poll it without blocking the event loop"""
+    try:
+        job = await asyncio.to_thread(submit_download, url, quality, embed_subs, embed_thumb, audio_format,
+                                      custom_filename, session=session, sub_langs=sub_langs, auto_subs=auto_subs)
+    except QueueFullError as e:
+        return None, str(e)
+    while True:
+        event = await asyncio.to_thread(job.poll)
+        if event and progress_callback:
+            result = progress_callback(event)
+            if inspect.isawaitable(result):
+                await result
+        if job.done:
+            return job.file_path, job.error
+        await asyncio.sleep(QUEUE_POLL_INTERVAL)
+
+
+def _stream_format(info, quality, audio_format):
+    """Pick a single-file format for streaming, returns (format, ffmpeg options) or (None, None)
+
+    Only streams when the top-ranked choice is one file: a merge would
+    reach a better quality than any pre-muxed format.
+    """
+    ranked = rank_formats(info, quality, audio_format)
+    if not ranked or len(ranked[0]) != 1 or (ranked[0][0].get('protocol') or 'https') not in STREAM_PROTOCOLS:
+        return None, None
+    best = ranked[0][0]
+    
+    if quality == 'Audio Only':
+        if audio_format not in STREAM_AUDIO_FORMATS:
+            return None, None
+        # Already in the requested container and without video: no conversion needed
+        if best.get('ext') == audio_format and best.get('vcodec') == 'none':
+            return best, None
+        return best, STREAM_AUDIO_FORMATS[audio_format][1]
+    return best, None
+
+
+def plan_stream(url, quality, embed_subs=False, embed_thumb=False, audio_format='mp3', custom_filename=None):
+    """Prepare a pipe-through stream of a download, returns a StreamDownload or None
+
+    Only single-file formats without on-disk postprocessing (subtitles,
+    thumbnails, merging) of an analyzed video (with fresh cached info, so
+    this never extracts) can be streamed; callers fall back to
+    download_video when this returns None.
+    """
+    if embed_subs or embed_thumb:
+        return None
+    url = re.sub(r'&list=[^&]*', '', url)
+    info = info_cache.get(url)
+    if not info or info.get('_type', 'video') != 'video':
+        return None
+    fmt, ffmpeg_args = _stream_format(info, quality, audio_format)
+    if not fmt:
+        return None
+    if ffmpeg_args and not get_capabilities()['ffmpeg_version']:
+        # Converting needs ffmpeg, and a stream cannot report failure once its headers are sent
+        return None
+    
+    if quality == 'Audio Only':
+        ext = audio_format
+        mime = STREAM_AUDIO_FORMATS[audio_format][0]
+    else:
+        ext = fmt.get('ext') or 'mp4'
+        mime = mimetypes.guess_type(f'x.{ext}')[0] or 'application/octet-stream'
+    title = re.sub(r'[\\/*?:"<>|]', "", custom_filename or info.get('title') or 'video')
+    return StreamDownload(url, info, fmt, f"{title}.{ext}", mime, ffmpeg_args)
+
+
+class StreamDownload:
+    """Chunked byte iterator over a download that never touches the disk
+
+    Without conversion the format is piped from yt-dlp's stdout (-o -).
+    With conversion ffmpeg reads the format URL itself instead: MP4/M4A
+    sources often keep their index at the end, which needs seeking a pipe
+    cannot offer. The process starts on first iteration, once a download
+    slot is free (streams count against the DownloadManager's limits), and
+    closing the iterator early kills it; error is set once iteration ends
+    if it failed.
+    """
+
+    def __init__(self, url, info, fmt, name, mime, ffmpeg_args=None, chunk_size=STREAM_CHUNK_SIZE):
+        self.url = url
+        self.info = info
+        self.format = fmt
+        self.name = name
+        self.mime = mime
+        self.ffmpeg_args = ffmpeg_args
+        self.chunk_size = chunk_size
+        self.bytes_sent = 0
+        self.error = None
+        self.log = deque(maxlen=LOG_LINES)
+
+    def __iter__(self):
+        return self._chunks()
+
+    def _drain(self, pipe):
+        for raw_line in pipe:
+            self.log.append(raw_line.decode('utf-8', 'replace'))
+
+    def _ffmpeg_command(self):
+        headers = dict(self.format.get('http_headers') or {})
+        referer = get_video_host_referer(self.url)
+        if referer:
+            headers.setdefault('Referer', referer)
+        cmd = [get_executable_path('ffmpeg'), '-loglevel', 'error']
+        if headers:
+            cmd.extend(['-headers', "".join(f"{key}: {value}\r\n" for key, value in headers.items())])
+        return cmd + ['-i', self.format['url'], '-vn'] + self.ffmpeg_args + ['pipe:1']
+
+    def _chunks(self):
+        with get_download_manager().slot(self.url), _info_json_file(None if self.ffmpeg_args else self.info) as info_path:
+            if self.ffmpeg_args:
+                cmd = self._ffmpeg_command()
+            else:
+                cmd = _yt_dlp_command() + ['-f', self.format['format_id'], '-o', '-', '--quiet', '--no-part'] \
+                    + _request_args(self.url) + ['--load-info-json', info_path]
+            try:
+                process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **_new_process_group())
+            except OSError as e:
+                # The response has started already: end it and leave the error for the caller
+                self.error = f"Could not start {os.path.basename(cmd[0])}: {e}"
+                log_event('stream_failed', logging.WARNING, url=self.url, error=self.error)
+                return
+            threading.Thread(target=self._drain, args=(process.stderr,), daemon=True).start()
+            
+            try:
+                while True:
+                    chunk = process.stdout.read1(self.chunk_size)
+                    if not chunk:
+                        break
+                    self.bytes_sent += len(chunk)
+                    yield chunk
+                if process.wait():
+                    self.error = "".join(self.log) or f"Stream failed with exit status {process.returncode}"
+            finally:
+                # Client went away: take the downloader down with the stream
+                _kill_process_tree(process)
+                process.wait()
+
+
+def parse_range(header, size):
+    """Parse an HTTP Range header into an inclusive (start, end), or None for the whole file"""
+    if not header or not header.startswith('bytes=') or ',' in header:
+        # Multi-range requests are answered with the whole file
+        return None
+    start, _, end = header[len('bytes='):].strip().partition('-')
+    try:
+        if not start:
+            # Suffix range: the last N bytes
+            length = int(end)
+            if length <= 0:
+                raise ValueError(header)
+            return max(0, size - length), size - 1
+        start = int(start)
+        end = int(end) if end else size - 1
+    except ValueError:
+        raise ValueError(f"Invalid range: {header}")
+    if start >= size or end < start:
+        raise ValueError(f"Unsatisfiable range: {header}")
+    return start, min(end, size - 1)
+
+
+def iter_file(path, start=0, end=None, chunk_size=STREAM_CHUNK_SIZE):
+    """Yield a file (or an inclusive byte range of it) in fixed-size chunks"""
+    with open(path, 'rb') as f:
+        f.seek(start)
+        remaining = (end - start + 1) if end is not None else None
+        while remaining is None or remaining > 0:
+            chunk = f.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not chunk:
+                break
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+
+def send_file(sock, path, offset, count):
+    """Send part of a file over a socket, zero-copy via sendfile where the OS supports it"""
+    with open(path, 'rb') as f:
+        # socket.sendfile falls back to a bounded read/send loop on its own
+        sock.sendfile(f, offset, count)
+
+
+def content_disposition(name):
+    """Build an attachment Content-Disposition header that survives non-ASCII titles"""
+    fallback = name.encode('ascii', 'replace').decode().replace('?', '_').replace('"', '')
+    return f"attachment; filename=\"{fallback}\"; filename*=UTF-8''{quote(name)}"
+
+
+def send_file_response(handler, path, name, mime, send_body=True):
+    """Answer a BaseHTTPRequestHandler request with a file, honouring its Range header"""
+    size = os.path.getsize(path)
+    try:
+        byte_range = parse_range(handler.headers.get('Range'), size)
+    except ValueError:
+        handler.send_response(416)
+        handler.send_header('Content-Range', f'bytes */{size}')
+        handler.end_headers()
+        return
+    
+    start, end = byte_range or (0, size - 1)
+    length = end - start + 1
+    handler.send_response(206 if byte_range else 200)
+    handler.send_header('Content-Type', mime)
+    handler.send_header('Content-Length', str(length))
+    handler.send_header('Accept-Ranges', 'bytes')
+    handler.send_header('Content-Disposition', content_disposition(name))
+    if byte_range:
+        handler.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+    handler.end_headers()
+    
+    if send_body and length > 0:
+        try:
+            send_file(handler.connection, path, start, length)
+        except (BrokenPipeError, ConnectionResetError):
+            # Browser cancelled or will come back with a Range request
+            pass
+
+
+class _NodeRequestHandler(BaseHTTPRequestHandler):
+    """Answers /healthz, /readyz and /metrics of the node"""
+
+    server_version = 'VideoDownloader'
+
+    def do_HEAD(self):
+        self._route(send_body=False)
+
+    def do_GET(self):
+        self._route(send_body=True)
+
+    def _route(self, send_body):
+        if not self._serve_node(send_body):
+            self.send_error(404)
+
+    def _serve_node(self, send_body):
+        """Answer a health or metrics request, returns False for any other path"""
+        path = urlsplit(self.path).path
+        if path == '/healthz':
+            self._send(200, 'application/json', json.dumps({'status': 'ok'}), send_body)
+        elif path == '/metrics':
+            self._send(200, 'text/plain; version=0.0.4; charset=utf-8', metrics.render(), send_body)
+        elif path == '/readyz':
+            capabilities = get_capabilities()
+            ready = capabilities['ytdlp_version'] is not None
+            payload = dict(capabilities, status='ready' if ready else 'not ready')
+            self._send(200 if ready else 503, 'application/json', json.dumps(payload), send_body)
+        else:
+            return False
+        return True
+
+    def _send(self, status, content_type, text, send_body):
+        body = text.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _FileRequestHandler(_NodeRequestHandler):
+
+    def _route(self, send_body):
+        if not self._serve_node(send_body):
+            self._serve_file(send_body)
+
+    def _serve_file(self, send_body):
+        entry = self.server.lookup(self.path, claim=send_body)
+        if entry and 'stream' in entry:
+            self._serve_stream(entry, send_body)
+            return
+        if not entry or not os.path.exists(entry['path']):
+            self.send_error(404)
+            return
+        send_file_response(self, entry['path'], entry['name'], entry['mime'], send_body)
+
+    def _serve_stream(self, entry, send_body):
+        # Length is unknown up front: the body ends when the connection closes
+        self.send_response(200)
+        self.send_header('Content-Type', entry['mime'])
+        self.send_header('Content-Disposition', content_disposition(entry['name']))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        if not send_body:
+            return
+        
+        chunks = iter(entry['stream'])
+        try:
+            for chunk in chunks:
+                self.wfile.write(chunk)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            chunks.close()
+            self.close_connection = True
+
+
+class FileLinks:
+    """Expiring download links of published files and streams, served by FileServer or an app's own web server"""
+
+    def __init__(self, base_url, ttl=FILE_LINK_TTL):
+        self.base_url = base_url.rstrip('/')
+        self.ttl = ttl
+        self._files = {}  # token -> entry
+        self._lock = threading.Lock()
+
+    def start_expiry(self):
+        """Expire links in a background thread, deleting the files handed over"""
+        
+        def expirer():
+            while True:
+                time.sleep(min(60, self.ttl))
+                self.expire()
+        
+        threading.Thread(target=expirer, name='file-link-expiry', daemon=True).start()
+        return self
+
+    def publish(self, path, name=None, mime=None, delete_after=True):
+        """Publish a file for download, returns its URL"""
+        name = name or os.path.basename(path)
+        token = secrets.token_urlsafe(16)
+        entry = {
+            'path': path,
+            'name': name,
+            'mime': mime or mimetypes.guess_type(name)[0] or 'application/octet-stream',
+            'expires': time.time() + self.ttl,
+            'delete_after': delete_after,
+        }
+        with self._lock:
+            self._files[token] = entry
+        self.expire()
+        return f"{self.base_url}/files/{token}/{quote(name)}"
+
+    def publish_stream(self, stream):
+        """Publish a StreamDownload, returns its single-use URL"""
+        token = secrets.token_urlsafe(16)
+        entry = {
+            'stream': stream,
+            'name': stream.name,
+            'mime': stream.mime,
+            'expires': time.time() + self.ttl,
+            'delete_after': False,
+        }
+        with self._lock:
+            self._files[token] = entry
+        self.expire()
+        return f"{self.base_url}/files/{token}/{quote(stream.name)}"
+
+    def lookup(self, request_path, claim=False):
+        """Find the published entry for a request path
+
+        claim=True removes a stream entry, since a stream can only be sent once.
+        """
+        parts = urlsplit(request_path).path.split('/')
+        if len(parts) < 3 or parts[1] != 'files':
+            return None
+        with self._lock:
+            entry = self._files.get(parts[2])
+            if entry and claim and 'stream' in entry:
+                del self._files[parts[2]]
+        if entry and entry['expires'] < time.time():
+            return None
+        return entry
+
+    def expire(self):
+        """Forget expired links and delete files that were handed over to the server"""
+        now = time.time()
+        with self._lock:
+            expired = [token for token, entry in self._files.items() if entry['expires'] < now]
+            entries = [self._files.pop(token) for token in expired]
+        for entry in entries:
+            if entry['delete_after']:
+                release_download(entry['path'])
+
+
+class FileServer(FileLinks, ThreadingHTTPServer):
+    """HTTP server that streams published files from disk"""
+
+    daemon_threads = True
+
+    def __init__(self, host=FILE_SERVER_HOST, port=FILE_SERVER_PORT, base_url=FILE_SERVER_URL, ttl=FILE_LINK_TTL):
+        ThreadingHTTPServer.__init__(self, (host, port), _FileRequestHandler)
+        FileLinks.__init__(self, base_url or f"http://localhost:{self.server_address[1]}", ttl)
+
+    def start(self):
+        """Serve in a background thread, expiring links in another"""
+        threading.Thread(target=self.serve_forever, name='file-server', daemon=True).start()
+        return self.start_expiry()
+
+
+def release_download(path):
+    """Delete a finished download together with its job directory"""
+    job_dir = os.path.dirname(path)
+    if spool.owns(job_dir):
+        spool.release(job_dir)
+        return
+    with contextlib.suppress(OSError):
+        os.remove(path)
+    # Also when the file was moved away already
+    with contextlib.suppress(OSError):
+        os.rmdir(job_dir)
+
+
+_file_server = None
+_file_server_lock = threading.Lock()
+_app_file_links = None  # links served by the UI's own web server, see serve_files_on_app
+
+
+def file_server_enabled():
+    """Check whether finished files are delivered as links (file server or the app's own port) instead of in memory"""
+    return FILE_SERVER_PORT > 0 or _app_file_links is not None
+
+
+def get_file_server():
+    """Get the process-wide file links: the file server (started on first use) or the app's own route"""
+    global _file_server
+    with _file_server_lock:
+        if FILE_SERVER_PORT <= 0 and _app_file_links is not None:
+            return _app_file_links
+        if _file_server is None:
+            _file_server = FileServer().start()
+        return _file_server
+
+
+def start_file_server():
+    """Start the file server when enabled"""
+    if FILE_SERVER_PORT > 0:
+        return get_file_server()
+    return None
+
+
+def serve_files_on_app(base_url):
+    """Deliver published files through a route of the app's own web server, for single-port deploys
+
+    The route answers base_url + '/files/<token>/<name>' by looking the
+    entry up in the returned FileLinks (with lookup('/files/<token>/<name>')).
+    A configured VD_FILE_SERVER_PORT still takes precedence.
+    """
+    global _app_file_links
+    with _file_server_lock:
+        if _app_file_links is None:
+            _app_file_links = FileLinks(base_url).start_expiry()
+        return _app_file_links
+
+
+_metrics_server = None
+_metrics_server_lock = threading.Lock()
+
+
+def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    """Serve /healthz, /readyz and /metrics on their own port once per process, None when disabled
+
+    A port that is taken (e.g. by another process of the node) is logged and skipped.
+    """
+    global _metrics_server
+    with _metrics_server_lock:
+        if _metrics_server is None and port > 0:
+            try:
+                _metrics_server = ThreadingHTTPServer((host, port), _NodeRequestHandler)
+            except OSError as e:
+                log_event('metrics_server_failed', logging.WARNING, port=port, error=str(e))
+                _metrics_server = False  # don't retry on every call
+                return None
+            _metrics_server.daemon_threads = True
+            threading.Thread(target=_metrics_server.serve_forever, name='metrics-server', daemon=True).start()
+        return _metrics_server or None
+
+
+def publish_file(path, mime=None):
+    """Publish a finished download on the file server, returns the download URL"""
+    return get_file_server().publish(path, mime=mime)
+
+
+def publish_stream(stream):
+    """Publish a StreamDownload on the file server, returns its single-use URL"""
+    return get_file_server().publish_stream(stream)
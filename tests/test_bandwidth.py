@@ -0,0 +1,42 @@
+import math
+
+import pytest
+
+from core import _fair_shares, _split_bandwidth
+
+
+def test_fair_shares_by_weight():
+    assert _fair_shares(300, {'a': (1, None), 'b': (2, None)}) == pytest.approx({'a': 100, 'b': 200})
+
+
+def test_fair_shares_redistributes_below_limit():
+    shares = _fair_shares(300, {'a': (1, 50), 'b': (1, None), 'c': (1, None)})
+    assert shares == pytest.approx({'a': 50, 'b': 125, 'c': 125})
+
+
+def test_fair_shares_all_capped_leaves_rest():
+    shares = _fair_shares(300, {'a': (1, 50), 'b': (1, 100)})
+    assert shares == {'a': 50, 'b': 100}
+
+
+def test_fair_shares_unlimited_total():
+    shares = _fair_shares(math.inf, {'a': (1, 10), 'b': (1, None)})
+    assert shares == {'a': 10, 'b': math.inf}
+
+
+def test_split_bandwidth_demand_then_cap():
+    # a only uses 40 of its share, b takes what it leaves
+    shares = _split_bandwidth(200, {'a': (1, 40, None), 'b': (1, None, None)})
+    assert shares == pytest.approx({'a': 40, 'b': 160})
+
+
+def test_split_bandwidth_gives_idle_back_up_to_cap():
+    # Both underestimated their demand: the leftover is shared again, within the caps
+    shares = _split_bandwidth(200, {'a': (1, 20, 80), 'b': (1, 30, None)})
+    assert sum(shares.values()) == pytest.approx(200)
+    assert shares['a'] == pytest.approx(80)
+    assert shares['b'] == pytest.approx(120)
+
+
+def test_split_bandwidth_unlimited_total():
+    assert _split_bandwidth(math.inf, {'a': (1, 10, 50), 'b': (1, None, None)}) == {'a': 50, 'b': math.inf}
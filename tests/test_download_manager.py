@@ -0,0 +1,59 @@
+import threading
+import time
+
+import core
+
+
+def test_cancelled_job_leaves_the_queue_and_never_starts(monkeypatch, tmp_path):
+    monkeypatch.setattr(core, 'spool', core.Spool(str(tmp_path / 'spool')))
+    gate = threading.Event()
+    started = []
+    
+    def fake_download(url, **kwargs):
+        started.append(url)
+        gate.wait(10)
+        return None, "Stopped"
+    
+    monkeypatch.setattr(core, '_run_download', fake_download)
+    manager = core.DownloadManager(max_workers=1, max_queued=1, store=core.JobStore(''))
+    running = manager.submit('https://example.com/a', 'Best')
+    deadline = time.time() + 5
+    while running.status != 'running' and time.time() < deadline:
+        time.sleep(0.01)
+    
+    queued = manager.submit('https://example.com/b', 'Best')
+    assert manager.stats()['queued'] == 1
+    assert queued.cancel()
+    assert manager.stats()['queued'] == 0
+    # The freed place takes a new job instead of raising QueueFullError
+    last = manager.submit('https://example.com/c', 'Best')
+    
+    gate.set()
+    last.wait(10)
+    assert queued.status == 'cancelled'
+    assert 'https://example.com/b' not in started
+
+
+def test_finished_and_cancelled_jobs_leave_no_store_rows(monkeypatch, tmp_path):
+    monkeypatch.setattr(core, 'spool', core.Spool(str(tmp_path / 'spool')))
+    monkeypatch.setattr(core, '_run_download', lambda url, **kwargs: (None, "Not found"))
+    store = core.JobStore(str(tmp_path / 'jobs.sqlite'))
+    save = store.save
+    
+    def slow_submit_save(record):
+        # Widen the window between queueing a job and recording it
+        if threading.current_thread() is threading.main_thread():
+            time.sleep(0.02)
+        save(record)
+    
+    monkeypatch.setattr(store, 'save', slow_submit_save)
+    manager = core.DownloadManager(max_workers=4, max_queued=100, store=store)
+    jobs = [manager.submit(f'https://example.com/{i}', 'Best') for i in range(20)]
+    for job in jobs[::2]:
+        job.cancel()
+    for job in jobs:
+        job.wait(10)
+    
+    assert all(job.done for job in jobs)
+    with store._lock:
+        assert store._connect().execute("SELECT COUNT(*) FROM jobs").fetchone()[0] == 0
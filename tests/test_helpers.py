@@ -0,0 +1,82 @@
+import pytest
+
+from core import SiteMatcher, parse_range, select_subtitles
+
+
+@pytest.mark.parametrize('header, expected', [
+    (None, None),
+    ('', None),
+    ('bytes=0-99', (0, 99)),
+    ('bytes=100-', (100, 999)),
+    ('bytes=-100', (900, 999)),
+    ('bytes=-5000', (0, 999)),
+    ('bytes=900-5000', (900, 999)),
+    ('bytes=0-1,5-6', None),
+    ('items=0-1', None),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize('header', ['bytes=1000-', 'bytes=50-10', 'bytes=abc-', 'bytes=-0'])
+def test_parse_range_invalid(header):
+    with pytest.raises(ValueError):
+        parse_range(header, 1000)
+
+
+def _track(lang, ext='vtt'):
+    return [{'ext': 'json3', 'url': f'https://example.com/{lang}.json3'},
+            {'ext': ext, 'url': f'https://example.com/{lang}.{ext}'}]
+
+
+INFO = {
+    'language': 'ms',
+    'subtitles': {'en-US': _track('en-US'), 'ms': _track('ms', 'srt'), 'live_chat': _track('live_chat')},
+    'automatic_captions': {'fr': _track('fr'), 'en': _track('en')},
+}
+
+
+def test_select_subtitles_languages():
+    tracks = select_subtitles(INFO, 'ms, en')
+    assert [(t['lang'], t['source'], t['ext']) for t in tracks] == [('ms', 'manual', 'srt'), ('en-US', 'manual', 'vtt')]
+
+
+def test_select_subtitles_prefers_uploaded_over_auto():
+    tracks = select_subtitles(INFO, ['en'], auto=True)
+    assert [(t['lang'], t['source']) for t in tracks] == [('en-US', 'manual')]
+
+
+def test_select_subtitles_auto_only_when_asked():
+    assert select_subtitles(INFO, ['fr']) == []
+    assert [(t['lang'], t['source']) for t in select_subtitles(INFO, ['fr'], auto=True)] == [('fr', 'auto')]
+
+
+def test_select_subtitles_defaults_to_video_language():
+    tracks = select_subtitles(INFO)
+    assert tracks[0]['lang'] == 'ms'
+
+
+def test_select_subtitles_falls_back_to_first_uploaded():
+    info = {'subtitles': {'de': _track('de')}}
+    assert [t['lang'] for t in select_subtitles(info)] == ['de']
+    assert select_subtitles(info, ['ja']) == []
+
+
+@pytest.mark.parametrize('url, expected', [
+    ('https://www.youtube.com/watch?v=x', 'YouTube'),
+    ('https://animepahe-gogoanime.com/anime', 'GogoAnime'),
+    ('https://gogoanime.animepahe.net/anime', 'GogoAnime'),
+    ('https://example.com/?next=youtube.com', 'Unknown'),
+])
+def test_site_matcher_keeps_rule_order(url, expected):
+    assert SiteMatcher().detect(url)['name'] == expected
+
+
+@pytest.mark.parametrize('url, expected', [
+    ('https://gogocdn.kwik.com/v.m3u8', 'https://animepahe.ru/'),
+    ('https://fembed.gogocdn.net/v.m3u8', 'https://gogoanimehd.to/'),
+    ('https://mixdrop.co/e/x', 'https://9animetv.to/'),
+    ('https://example.com/kwik', None),
+])
+def test_video_host_referer_priority(url, expected):
+    assert SiteMatcher().video_host_referer(url) == expected
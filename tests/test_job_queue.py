@@ -0,0 +1,142 @@
+import json
+import os
+import subprocess
+import sys
+import textwrap
+import threading
+import time
+
+import pytest
+
+import core
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CLAIM_LOOP = textwrap.dedent("""
+    import json, sys
+    import core
+    queue = core.SQLiteJobQueue(sys.argv[1], steal_after=0)
+    worker = sys.argv[2]
+    queue.heartbeat(worker)
+    claimed = []
+    while True:
+        job = queue.claim(worker)
+        if job is None:
+            break
+        claimed.append(job['id'])
+    print(json.dumps(claimed))
+""")
+
+
+def test_sqlite_claim_is_exclusive_across_processes(tmp_path):
+    db_path = str(tmp_path / 'queue.sqlite')
+    queue = core.SQLiteJobQueue(db_path, max_queued=1000)
+    submitted = {queue.submit(queue.new_job(f'https://example.com/v/{i}', {}))['id'] for i in range(200)}
+    
+    workers = [subprocess.Popen([sys.executable, '-c', CLAIM_LOOP, db_path, f'worker-{i}'],
+                                stdout=subprocess.PIPE, text=True, cwd=ROOT) for i in range(4)]
+    claims = [json.loads(worker.communicate(timeout=120)[0]) for worker in workers]
+    
+    claimed = [job_id for ids in claims for job_id in ids]
+    assert len(claimed) == len(set(claimed))
+    assert set(claimed) == submitted
+    assert queue.stats()['jobs'] == {'running': 200}
+
+
+def test_sqlite_claim_prefers_owned_shards(tmp_path):
+    queue = core.SQLiteJobQueue(str(tmp_path / 'queue.sqlite'), steal_after=3600)
+    queue.heartbeat('a')
+    queue.heartbeat('b')
+    job = queue.submit(queue.new_job('https://example.com/v/1', {}))
+    owner = core.shard_owner(job['shard'], ['a', 'b'])
+    other = 'b' if owner == 'a' else 'a'
+    assert queue.claim(other) is None
+    assert queue.claim(owner)['id'] == job['id']
+
+
+def test_cancel_only_queued(tmp_path):
+    queue = core.SQLiteJobQueue(str(tmp_path / 'queue.sqlite'), steal_after=0)
+    job = queue.submit(queue.new_job('https://example.com/v/1', {}))
+    assert queue.cancel(job['id'])
+    assert queue.get(job['id'])['status'] == 'cancelled'
+    assert queue.claim('a') is None
+    assert not queue.cancel(job['id'])
+
+
+def test_shard_owner_is_stable():
+    workers = [f'worker-{i}' for i in range(5)]
+    owners = {shard: core.shard_owner(shard, workers) for shard in range(core.QUEUE_SHARDS)}
+    assert set(owners.values()) <= set(workers)
+    assert core.shard_owner(3, []) is None
+    assert core.shard_owner(3, list(reversed(workers))) == owners[3]
+    
+    # Only the shards of the worker that left move
+    remaining = workers[:-1]
+    for shard, owner in owners.items():
+        if owner != workers[-1]:
+            assert core.shard_owner(shard, remaining) == owner
+        else:
+            assert core.shard_owner(shard, remaining) in remaining
+
+
+def test_job_queue_is_abstract():
+    with pytest.raises(TypeError):
+        core.JobQueue()
+
+
+class FlakyQueue(core.SQLiteJobQueue):
+    """SQLite queue whose claim() and finish() fail a few times first"""
+
+    def __init__(self, *args, failures=2, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.failures = {'claim': failures, 'finish': failures}
+
+    def _fail(self, name):
+        if self.failures[name]:
+            self.failures[name] -= 1
+            raise core.sqlite3.OperationalError("database is locked")
+
+    def claim(self, worker_id):
+        self._fail('claim')
+        return super().claim(worker_id)
+
+    def finish(self, job_id, **fields):
+        self._fail('finish')
+        super().finish(job_id, **fields)
+
+
+def _run_worker(worker):
+    thread = threading.Thread(target=worker.run, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_queue_worker_survives_backend_errors(monkeypatch, tmp_path):
+    monkeypatch.setattr(core, 'QUEUE_POLL_INTERVAL', 0.01)
+    monkeypatch.setattr(core, '_run_download', lambda url, **kwargs: (None, "Not found"))
+    queue = FlakyQueue(str(tmp_path / 'queue.sqlite'), steal_after=0)
+    job = queue.submit(queue.new_job('https://example.com/v/1', {'quality': 'Best'}))
+    worker = core.QueueWorker(queue, shared_dir=str(tmp_path / 'shared'), max_jobs=1)
+    thread = _run_worker(worker)
+    
+    deadline = time.time() + 10
+    while queue.get(job['id'])['status'] != 'failed' and time.time() < deadline:
+        time.sleep(0.05)
+    worker.stop()
+    thread.join(10)
+    assert queue.get(job['id'])['status'] == 'failed'
+    assert queue.failures == {'claim': 0, 'finish': 0}
+
+
+def test_stopped_queue_worker_stays_unregistered(monkeypatch, tmp_path):
+    monkeypatch.setattr(core, 'WORKER_HEARTBEAT', 0.05)
+    queue = core.SQLiteJobQueue(str(tmp_path / 'queue.sqlite'))
+    worker = core.QueueWorker(queue, shared_dir=str(tmp_path / 'shared'), max_jobs=1)
+    thread = _run_worker(worker)
+    time.sleep(0.2)
+    assert queue.workers() == [worker.id]
+    
+    worker.stop()
+    thread.join(10)
+    time.sleep(0.3)
+    assert queue.workers() == []
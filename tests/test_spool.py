@@ -0,0 +1,16 @@
+import os
+
+import core
+
+
+def test_failed_plan_releases_its_job_directory(monkeypatch, tmp_path):
+    spool = core.Spool(str(tmp_path / 'spool'))
+    monkeypatch.setattr(core, 'spool', spool)
+    
+    def broken(*args, **kwargs):
+        raise RuntimeError("probe failed")
+    
+    monkeypatch.setattr(core, 'select_formats', broken)
+    file_path, error = core._run_download('https://example.com/video.mp4', 'Best')
+    assert file_path is None and 'probe failed' in error
+    assert [name for name in os.listdir(spool.root) if not name.startswith('.')] == []
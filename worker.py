@@ -0,0 +1,76 @@
+"""Headless download worker for multi-node mode
+
+Runs the jobs front ends submit to VD_QUEUE_URL and publishes the finished
+files to VD_SHARED_DIR. Start one per node, or several on one machine to
+try the cluster locally; each local process then gets its own spool, job
+store and file cache, as separate nodes would.
+
+Usage: VD_QUEUE_URL=sqlite:///tmp/vd-queue.sqlite python worker.py [--processes 3] [--max-jobs 4]
+"""
+import argparse
+import multiprocessing
+import os
+import signal
+import sys
+import tempfile
+
+
+def run_worker(index=None, max_jobs=None):
+    """Run one worker in this process until SIGTERM/SIGINT, finishing its running jobs first"""
+    if index is not None:
+        # Node-local state of its own, so local processes behave like separate nodes
+        root = os.path.join(os.environ.get('VD_WORKER_ROOT', os.path.join(tempfile.gettempdir(), 'vd-workers')), str(index))
+        os.environ['VD_SPOOL_DIR'] = os.path.join(root, 'spool')
+        os.environ['VD_FILE_CACHE_DIR'] = os.path.join(root, 'file-cache')
+        os.environ['VD_FILE_SERVER_PORT'] = '0'
+    import core
+    
+    worker = core.QueueWorker(core.get_job_queue(), max_jobs=max_jobs or core.MAX_DOWNLOADS)
+    
+    def stop(signum, frame):
+        # A second signal exits right away, the queue requeues the running jobs
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        worker.stop()
+    
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    core.warm_up()
+    if index is None:
+        core.start_metrics_server()  # /metrics, /healthz and /readyz of the node
+        core.start_file_server()
+    worker.run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--processes', type=int, default=1, help="worker processes to run on this machine")
+    parser.add_argument('--max-jobs', type=int, default=None, help="jobs each worker runs at once (default VD_MAX_DOWNLOADS)")
+    args = parser.parse_args()
+    
+    if not os.environ.get('VD_QUEUE_URL'):
+        sys.exit("Set VD_QUEUE_URL, e.g. sqlite:///tmp/vd-queue.sqlite or redis://localhost:6379/0")
+    if args.processes <= 1:
+        run_worker(max_jobs=args.max_jobs)
+        return
+    
+    context = multiprocessing.get_context('spawn')
+    processes = [context.Process(target=run_worker, args=(index, args.max_jobs), name=f'vd-worker-{index}')
+                 for index in range(args.processes)]
+    for process in processes:
+        process.start()
+    
+    def forward(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signum)
+    
+    signal.signal(signal.SIGTERM, forward)
+    # Ctrl-C already reaches every process of the group
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    for process in processes:
+        process.join()
+
+
+if __name__ == "__main__":
+    main()